@@ -1,8 +1,14 @@
 import os
 import json
+import math
 import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 from dotenv import load_dotenv
 
 # --- CẤU HÌNH ---
@@ -23,78 +29,309 @@ genai.configure(api_key=GOOGLE_API_KEY)
 
 # Chọn mô hình embedding của Google
 EMBEDDING_MODEL = "models/text-embedding-004"
+# Phiên bản embedding được lưu cùng mỗi hàng (cột embedding_model); đổi giá trị này để buộc tạo lại embedding
+EMBEDDING_VERSION = EMBEDDING_MODEL
 
-def get_embedding(text):
-    """Hàm gọi API của Google để tạo embedding cho một đoạn văn bản."""
+# Các bảng cần tạo embedding và các cột văn bản được ghép lại để tạo embedding
+TABLES = {
+    'english_idioms': ['phrase', 'meaning', 'example'],
+    'english_grammar_rules': ['rule', 'explanation', 'example'],
+    'english_vocabulary': ['word', 'meaning', 'example'],
+    'english_common_mistakes': ['mistake', 'correction', 'example'],
+    'english_conversations': ['situation', 'dialogue', 'context'],
+}
+
+PAGE_SIZE = 1000          # Kích thước mỗi trang, khớp với giới hạn của Supabase
+MAX_BATCH_SIZE = 100      # Số văn bản tối đa trong một lệnh gọi embed_content
+CHECKPOINT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_checkpoint.json")
+
+
+class AdaptiveRateLimiter:
+    """
+    Giới hạn tốc độ gọi API dùng chung cho mọi worker (AIMD):
+    tăng dần tốc độ khi thành công, giảm một nửa và tạm dừng khi gặp lỗi 429.
+    """
+
+    def __init__(self, rate: float = 5.0, min_rate: float = 0.2, max_rate: float = 20.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Chờ tới lượt gọi API tiếp theo."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        time.sleep(max(0.0, slot - now))
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_rate_limited(self, cooldown: float):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._next_slot = max(self._next_slot, time.monotonic() + cooldown)
+        print(f"  -> Gặp lỗi 429, giảm tốc độ xuống {self.rate:.2f} lệnh gọi/giây và tạm dừng {cooldown:.0f} giây.")
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return "429" in str(error) or "quota" in str(error).lower() or "exhausted" in str(error).lower()
+
+
+def build_text(item, text_columns):
+    """Ghép các cột văn bản lại thành một chuỗi duy nhất."""
+    return ". ".join([f"{col.capitalize()}: {item[col]}" for col in text_columns if item.get(col)])
+
+
+def content_hash(item, text_columns):
+    """Mã băm SHA-256 của chuỗi văn bản dùng để tạo embedding."""
+    return hashlib.sha256(build_text(item, text_columns).encode("utf-8")).hexdigest()
+
+
+def stale_reason(item, text_columns, missing_embedding_ids):
+    """Lý do hàng cần tạo lại embedding ('missing', 'text_changed', 'model_changed'), hoặc None nếu đã mới nhất."""
+    if item['id'] in missing_embedding_ids:
+        return 'missing'
+    if item.get('content_hash') != content_hash(item, text_columns):
+        return 'text_changed'
+    if item.get('embedding_model') != EMBEDDING_VERSION:
+        return 'model_changed'
+    return None
+
+
+def get_embeddings(texts, limiter: AdaptiveRateLimiter, max_retries: int = 5):
+    """Gọi API của Google để tạo embedding cho NHIỀU đoạn văn bản trong một lệnh gọi."""
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            result = genai.embed_content(
+                model=EMBEDDING_MODEL,
+                content=texts,
+                task_type="RETRIEVAL_DOCUMENT", # Quan trọng: Dùng cho dữ liệu sẽ được truy vấn sau này
+                title="English Learning Data" # Tùy chọn nhưng nên có
+            )
+            limiter.on_success()
+            return result['embedding']
+        except Exception as e:
+            if is_rate_limit_error(e) and attempt < max_retries - 1:
+                limiter.on_rate_limited(cooldown=min(60, 5 * 2 ** attempt))
+                continue
+            print(f"Lỗi khi tạo embedding cho lô {len(texts)} văn bản: {e}")
+            return None
+    return None
+
+
+def process_batch(table_name, text_columns, items, limiter):
+    """Tạo embedding cho một lô hàng và ghi lại bằng một lệnh upsert hàng loạt. Trả về số hàng đã cập nhật."""
+    texts = [build_text(item, text_columns) for item in items]
+    vectors = get_embeddings(texts, limiter)
+    if not vectors or len(vectors) != len(items):
+        return 0
+
+    # Upsert kèm các cột văn bản đã đọc để thỏa các ràng buộc NOT NULL nếu có; chỉ các cột này bị ghi đè
+    rows = [
+        dict(item, embedding=vector, content_hash=content_hash(item, text_columns), embedding_model=EMBEDDING_VERSION)
+        for item, vector in zip(items, vectors)
+    ]
     try:
-        # Giảm thiểu khả năng lỗi "429: Resource has been exhausted"
-        time.sleep(1) 
-        embedding = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=text,
-            task_type="RETRIEVAL_DOCUMENT", # Quan trọng: Dùng cho dữ liệu sẽ được truy vấn sau này
-            title="English Learning Data" # Tùy chọn nhưng nên có
-        )
-        return embedding['embedding']
+        supabase.table(table_name).upsert(rows, on_conflict="id").execute()
+        return len(rows)
     except Exception as e:
-        print(f"Lỗi khi tạo embedding: {e}")
-        return None
+        print(f"  -> LỖI khi upsert {len(rows)} hàng (ID {items[0]['id']}..{items[-1]['id']}): {e}")
+        return 0
 
-def generate_and_update_embeddings(table_name, text_columns):
-    """Tạo và cập nhật embeddings cho một bảng cụ thể, có xử lý phân trang."""
-    print(f"--- Bắt đầu xử lý bảng: {table_name} ---")
 
-    offset = 0
-    page_size = 1000  # Kích thước mỗi trang, khớp với giới hạn của Supabase
-    total_updated = 0
+def load_checkpoint():
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(checkpoint):
+    # Ghi file tạm rồi đổi tên để checkpoint không bị hỏng nếu tiến trình bị dừng giữa chừng
+    with open(CHECKPOINT_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(CHECKPOINT_FILE + ".tmp", CHECKPOINT_FILE)
 
+
+def fetch_missing_embedding_ids(table_name, first_id, last_id):
+    """ID của các hàng chưa có embedding trong khoảng [first_id, last_id] (không tải cột embedding về)."""
+    response = (
+        supabase.table(table_name)
+        .select("id")
+        .is_("embedding", "null")
+        .gte("id", first_id)
+        .lte("id", last_id)
+        .execute()
+    )
+    return {row['id'] for row in response.data}
+
+
+def require_version_columns(table_names):
+    """Dừng với thông báo rõ ràng nếu bảng chưa có cột content_hash/embedding_model."""
+    for table_name in table_names:
+        try:
+            supabase.table(table_name).select("content_hash,embedding_model").limit(1).execute()
+        except APIError as e:
+            # 42703: cột không tồn tại
+            if e.code != "42703":
+                raise
+            raise SystemExit(
+                f"Lỗi: bảng {table_name} chưa có cột content_hash/embedding_model ({e.message}). "
+                "Hãy chạy Supabase/embedding_versioning.sql trong SQL Editor của Supabase rồi chạy lại script."
+            )
+
+
+def adopt_existing_embeddings(table_name, text_columns):
+    """
+    Gắn content_hash/embedding_model cho các hàng đã có embedding từ trước khi có cột phiên bản,
+    coi như embedding hiện tại khớp với văn bản hiện tại (không tốn lệnh gọi API).
+    """
+    adopted = 0
+    last_id = None
     while True:
-        print(f"\nĐang lấy dữ liệu từ hàng số {offset}...")
-        
-        # 1. Thêm .limit() và .offset() vào truy vấn
-        response = (
+        query = (
             supabase.table(table_name)
             .select("id," + ",".join(text_columns))
-            .is_("embedding", "null")
-            .limit(page_size)
-            .offset(offset)
-            .execute()
+            .is_("content_hash", "null")
+            .not_.is_("embedding", "null")
+            .order("id")
+            .limit(PAGE_SIZE)
         )
-        
-        data = response.data
-        
-        # 2. Điều kiện thoát vòng lặp: nếu không còn dữ liệu trả về
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        data = query.execute().data
         if not data:
-            print(f"✅ Không còn hàng nào cần cập nhật trong bảng {table_name}.")
             break
+        rows = [dict(item, content_hash=content_hash(item, text_columns), embedding_model=EMBEDDING_VERSION) for item in data]
+        supabase.table(table_name).upsert(rows, on_conflict="id").execute()
+        adopted += len(rows)
+        last_id = data[-1]['id']
+    print(f"  -> Đã gắn phiên bản cho {adopted} hàng có sẵn embedding trong bảng {table_name}.")
+
+
+def generate_and_update_embeddings(table_name, text_columns, limiter, checkpoint,
+                                   batch_size=MAX_BATCH_SIZE, workers=4, dry_run=False):
+    """
+    Tạo lại embedding cho các hàng của một bảng khi cần: chưa có embedding, văn bản đã thay đổi
+    (content_hash khác) hoặc mô hình đã thay đổi (embedding_model khác).
+    Phân trang theo khóa (id > last_id) và lưu checkpoint sau mỗi trang để có thể chạy tiếp nếu bị gián đoạn.
+    Với dry_run=True chỉ thống kê số hàng và số lệnh gọi API sẽ tốn, không ghi gì.
+    """
+    print(f"--- Bắt đầu xử lý bảng: {table_name}{' (dry-run)' if dry_run else ''} ---")
+
+    last_id = None if dry_run else checkpoint.get(table_name)
+    if last_id is not None:
+        print(f"Tiếp tục từ checkpoint: ID > {last_id}")
+    total_scanned = 0
+    total_updated = 0
+    total_failed = 0
+    reasons = {'missing': 0, 'text_changed': 0, 'model_changed': 0}
+    api_calls = 0
+    started_at = time.time()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            query = (
+                supabase.table(table_name)
+                .select("id,content_hash,embedding_model," + ",".join(text_columns))
+                .order("id")
+                .limit(PAGE_SIZE)
+            )
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            data = query.execute().data
+
+            # Điều kiện thoát vòng lặp: nếu không còn dữ liệu trả về
+            if not data:
+                break
+
+            total_scanned += len(data)
+            missing_ids = fetch_missing_embedding_ids(table_name, data[0]['id'], data[-1]['id'])
+            stale = []
+            for item in data:
+                reason = stale_reason(item, text_columns, missing_ids)
+                if reason:
+                    reasons[reason] += 1
+                    # Chỉ gửi các cột văn bản + id khi upsert, bỏ các giá trị phiên bản cũ
+                    stale.append({key: item[key] for key in ['id'] + text_columns})
+            batches = [stale[i:i + batch_size] for i in range(0, len(stale), batch_size)]
+            api_calls += len(batches)
+            last_id = data[-1]['id']
 
-        print(f"Tìm thấy {len(data)} hàng cần cập nhật trong trang này.")
-
-        for item in data:
-            # Ghép các cột văn bản lại thành một chuỗi duy nhất
-            combined_text = ". ".join([f"{col.capitalize()}: {item[col]}" for col in text_columns if item.get(col)])
-            
-            # Tạo embedding
-            embedding_vector = get_embedding(combined_text)
-            
-            # Cập nhật lại vào Supabase nếu tạo embedding thành công
-            if embedding_vector:
-                try:
-                    supabase.table(table_name).update({'embedding': embedding_vector}).eq('id', item['id']).execute()
-                    print(f"  -> Đã cập nhật embedding cho ID: {item['id']}")
-                    total_updated += 1
-                except Exception as e:
-                    print(f"  -> LỖI khi cập nhật embedding cho ID {item['id']}: {e}")
-
-        # 3. Cập nhật offset cho trang tiếp theo
-        offset += page_size
+            if dry_run or not stale:
+                continue
+
+            print(f"\nTìm thấy {len(stale)}/{len(data)} hàng cần cập nhật (ID {data[0]['id']}..{data[-1]['id']}).")
+            updated = sum(executor.map(lambda items: process_batch(table_name, text_columns, items, limiter), batches))
+            total_updated += updated
+            total_failed += len(stale) - updated
+
+            checkpoint[table_name] = last_id
+            save_checkpoint(checkpoint)
+
+            elapsed = time.time() - started_at
+            print(f"  -> Đã cập nhật {total_updated} hàng ({total_updated / max(elapsed, 1e-6):.1f} hàng/giây), "
+                  f"lỗi {total_failed} hàng, tốc độ hiện tại {limiter.rate:.2f} lệnh gọi/giây.")
+
+    stale_total = sum(reasons.values())
+    print(f"Đã quét {total_scanned} hàng: {stale_total} hàng cần tạo embedding "
+          f"(chưa có: {reasons['missing']}, văn bản thay đổi: {reasons['text_changed']}, "
+          f"mô hình thay đổi: {reasons['model_changed']}), {api_calls} lệnh gọi API.")
+    if dry_run:
+        estimate = api_calls / max(limiter.rate, 1e-6)
+        print(f"📋 Dry-run: ước tính khoảng {math.ceil(estimate)} giây ở tốc độ {limiter.rate:.1f} lệnh gọi/giây.")
+        return {"scanned": total_scanned, "stale": stale_total, "api_calls": api_calls, **reasons}
+
+    # Bảng đã xử lý xong: xóa checkpoint để lần chạy sau quét lại từ đầu (và thử lại các hàng bị lỗi)
+    checkpoint.pop(table_name, None)
+    save_checkpoint(checkpoint)
 
     print(f"\n🎉 Hoàn tất xử lý bảng: {table_name}. Tổng cộng đã cập nhật {total_updated} hàng.")
+    if total_failed:
+        print(f"⚠️ Có {total_failed} hàng chưa tạo được embedding, hãy chạy lại script để thử lại.")
+    return {"scanned": total_scanned, "stale": stale_total, "api_calls": api_calls, **reasons}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tạo embedding hàng loạt cho các bảng dữ liệu trong Supabase.")
+    parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=list(TABLES), help="Các bảng cần xử lý")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="Số văn bản trong mỗi lệnh gọi embed_content (tối đa 100)")
+    parser.add_argument("--workers", type=int, default=4, help="Số worker chạy song song")
+    parser.add_argument("--rate", type=float, default=5.0, help="Tốc độ khởi đầu (lệnh gọi/giây), tự điều chỉnh khi gặp 429")
+    parser.add_argument("--reset", action="store_true", help="Bỏ qua checkpoint cũ và quét lại từ đầu")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo số hàng và số lệnh gọi API sẽ tốn, không ghi gì")
+    parser.add_argument("--adopt-existing", action="store_true",
+                        help="Gắn content_hash/embedding_model cho các hàng đã có embedding trước khi có cột phiên bản")
+    args = parser.parse_args()
+
+    checkpoint = {} if args.reset else load_checkpoint()
+    limiter = AdaptiveRateLimiter(rate=args.rate)
+    batch_size = max(1, min(args.batch_size, MAX_BATCH_SIZE))
+
+    require_version_columns(args.tables)
+
+    # --- Chạy script cho từng bảng ---
+    summary = {}
+    for table_name in args.tables:
+        if args.adopt_existing and not args.dry_run:
+            adopt_existing_embeddings(table_name, TABLES[table_name])
+        summary[table_name] = generate_and_update_embeddings(
+            table_name, TABLES[table_name], limiter, checkpoint, batch_size, args.workers, args.dry_run
+        )
+
+    if args.dry_run:
+        print("\n📋 Tổng kết dry-run:")
+        for table_name, stats in summary.items():
+            print(f"  - {table_name}: {stats['stale']}/{stats['scanned']} hàng, {stats['api_calls']} lệnh gọi API")
+        print(f"  => Tổng cộng {sum(s['stale'] for s in summary.values())} hàng, "
+              f"{sum(s['api_calls'] for s in summary.values())} lệnh gọi API.")
 
 
-# --- Chạy script cho từng bảng ---
-generate_and_update_embeddings('english_idioms', ['phrase', 'meaning', 'example'])
-generate_and_update_embeddings('english_grammar_rules', ['rule', 'explanation', 'example'])
-generate_and_update_embeddings('english_vocabulary', ['word', 'meaning', 'example'])
-generate_and_update_embeddings('english_common_mistakes', ['mistake', 'correction', 'example'])
-generate_and_update_embeddings('english_conversations', ['situation', 'dialogue', 'context'])
\ No newline at end of file
+if __name__ == "__main__":
+    main()
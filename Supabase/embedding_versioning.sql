@@ -0,0 +1,20 @@
+-- Thêm cột phiên bản embedding cho 5 bảng kiến thức.
+-- content_hash: SHA-256 của chuỗi văn bản (ghép từ các text_columns) đã dùng để tạo embedding.
+-- embedding_model: mô hình/phiên bản embedding (EMBEDDING_VERSION trong Supabase/embedding.py).
+-- Sau khi chạy file này, dùng `python Supabase/embedding.py --adopt-existing` một lần để gắn phiên bản
+-- cho các embedding đã có, sau đó script chỉ tạo lại embedding cho các hàng có văn bản hoặc mô hình thay đổi.
+
+alter table english_vocabulary add column if not exists content_hash text;
+alter table english_vocabulary add column if not exists embedding_model text;
+
+alter table english_grammar_rules add column if not exists content_hash text;
+alter table english_grammar_rules add column if not exists embedding_model text;
+
+alter table english_idioms add column if not exists content_hash text;
+alter table english_idioms add column if not exists embedding_model text;
+
+alter table english_common_mistakes add column if not exists content_hash text;
+alter table english_common_mistakes add column if not exists embedding_model text;
+
+alter table english_conversations add column if not exists content_hash text;
+alter table english_conversations add column if not exists embedding_model text;
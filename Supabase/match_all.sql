@@ -0,0 +1,59 @@
+-- Hàm match_all: tìm kiếm trên cả 5 bảng kiến thức trong MỘT round trip.
+-- Ngữ nghĩa giống các hàm match_* hiện có: độ tương đồng cosine = 1 - (embedding <=> query_embedding),
+-- chỉ giữ các hàng có độ tương đồng > match_threshold, tối đa match_count hàng cho MỖI bảng.
+-- Mỗi hàng trả về được gắn nhãn bảng nguồn (source_table) và toàn bộ dữ liệu của hàng (payload, không gồm embedding
+-- và các cột phiên bản content_hash/embedding_model của Supabase/embedding_versioning.sql).
+-- Chạy file này trong SQL Editor của Supabase, sau đó đặt RETRIEVER_USE_MATCH_ALL=1 cho backend.
+
+create or replace function match_all (
+  query_embedding vector(768),
+  match_threshold float,
+  match_count int
+)
+returns table (
+  source_table text,
+  payload jsonb,
+  similarity float
+)
+language sql stable
+as $$
+  (
+    select 'vocabulary', to_jsonb(t) - 'embedding' - 'content_hash' - 'embedding_model', 1 - (t.embedding <=> query_embedding)
+    from english_vocabulary t
+    where t.embedding is not null and 1 - (t.embedding <=> query_embedding) > match_threshold
+    order by t.embedding <=> query_embedding
+    limit match_count
+  )
+  union all
+  (
+    select 'grammar', to_jsonb(t) - 'embedding' - 'content_hash' - 'embedding_model', 1 - (t.embedding <=> query_embedding)
+    from english_grammar_rules t
+    where t.embedding is not null and 1 - (t.embedding <=> query_embedding) > match_threshold
+    order by t.embedding <=> query_embedding
+    limit match_count
+  )
+  union all
+  (
+    select 'idioms', to_jsonb(t) - 'embedding' - 'content_hash' - 'embedding_model', 1 - (t.embedding <=> query_embedding)
+    from english_idioms t
+    where t.embedding is not null and 1 - (t.embedding <=> query_embedding) > match_threshold
+    order by t.embedding <=> query_embedding
+    limit match_count
+  )
+  union all
+  (
+    select 'common_mistakes', to_jsonb(t) - 'embedding' - 'content_hash' - 'embedding_model', 1 - (t.embedding <=> query_embedding)
+    from english_common_mistakes t
+    where t.embedding is not null and 1 - (t.embedding <=> query_embedding) > match_threshold
+    order by t.embedding <=> query_embedding
+    limit match_count
+  )
+  union all
+  (
+    select 'conversations', to_jsonb(t) - 'embedding' - 'content_hash' - 'embedding_model', 1 - (t.embedding <=> query_embedding)
+    from english_conversations t
+    where t.embedding is not null and 1 - (t.embedding <=> query_embedding) > match_threshold
+    order by t.embedding <=> query_embedding
+    limit match_count
+  );
+$$;
@@ -0,0 +1,148 @@
+import json
+import hashlib
+
+import numpy as np
+
+from .embedding_cache import normalize_key_text
+from .cache_backend import CacheBackend, MemoryCacheBackend, run_cache_io
+
+# Số câu trả lời tối đa được ghi nhớ cho mỗi ngôn ngữ ở tầng ngữ nghĩa
+MAX_GROUP_SIZE = 64
+
+
+def hash_context(context: str) -> str:
+    """Băm nội dung ngữ cảnh đã truy xuất; dữ liệu gốc thay đổi thì mã băm cũng thay đổi."""
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+
+def context_items(context: str) -> set:
+    """
+    Mã băm của từng mục kiến thức trong ngữ cảnh (mỗi mục bắt đầu bằng "- ", các dòng thụt lề sau đó
+    thuộc cùng mục; tiêu đề bảng bị bỏ qua). Sửa một hàng trong Supabase thì mã băm của mục đó thay đổi.
+    """
+    items, current = [], None
+    for line in context.splitlines():
+        if line.startswith("- "):
+            current = [line]
+            items.append(current)
+        elif current is not None and line.startswith(" "):
+            current.append(line)
+        else:
+            current = None
+    return {hashlib.sha256("\n".join(item).encode("utf-8")).hexdigest()[:16] for item in items}
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời RAG cuối cùng, gồm hai tầng:
+    - Tầng chính xác: khóa (từ khóa đã chuẩn hóa, ngôn ngữ, mã băm ngữ cảnh).
+    - Tầng ngữ nghĩa: dùng lại câu trả lời cùng ngôn ngữ khi embedding của từ khóa mới nằm trong khoảng
+      cách cosine max_distance so với một từ khóa đã cache, và mọi mục kiến thức mà câu trả lời đó dựa vào
+      vẫn có nguyên vẹn trong ngữ cảnh vừa truy xuất (cách diễn đạt khác thường kéo theo ngữ cảnh hơi khác,
+      nên không đòi hỏi trùng toàn bộ ngữ cảnh).
+    Vì mã băm ngữ cảnh nằm trong khóa, mọi thay đổi ở các hàng kiến thức được truy xuất sẽ tự động
+    làm cache cũ không còn được dùng; invalidate() xóa toàn bộ cache khi cần làm mới thủ công.
+    Dữ liệu nằm trong một CacheBackend nên có thể dùng chung giữa các worker (xem backend/cache_backend.py):
+    câu trả lời, embedding đơn vị (float32) của từ khóa, mã băm các mục ngữ cảnh và danh sách câu trả lời
+    theo ngôn ngữ được lưu ở bốn namespace riêng.
+    """
+
+    NAMESPACE = "answer"
+    VECTOR_NAMESPACE = "answer_vector"
+    ITEMS_NAMESPACE = "answer_items"
+    GROUP_NAMESPACE = "answer_group"
+
+    def __init__(self, backend: CacheBackend = None, ttl_seconds: float = 24 * 3600, max_distance: float = 0.08):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(embedding):
+        if embedding is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    @staticmethod
+    def _keys(search_term: str, language: str, context: str):
+        """(khóa của câu trả lời, khóa của nhóm ngữ nghĩa = ngôn ngữ)."""
+        term = normalize_key_text(search_term)
+        return f"{term}\x1f{language}\x1f{hash_context(context)}", language
+
+    def _group_keys(self, group_key: str):
+        value = self.backend.get(self.GROUP_NAMESPACE, group_key)
+        return json.loads(value) if value else []
+
+    def _covered(self, candidate_key: str, items: set) -> bool:
+        """Các mục kiến thức của câu trả lời đã cache còn nằm nguyên trong ngữ cảnh hiện tại không."""
+        value = self.backend.get(self.ITEMS_NAMESPACE, candidate_key)
+        return value is not None and set(json.loads(value)) <= items
+
+    def get(self, search_term: str, language: str, context: str, query_embedding=None):
+        """Trả về câu trả lời đã cache (tầng chính xác trước, sau đó tầng ngữ nghĩa) hoặc None."""
+        key, group_key = self._keys(search_term, language, context)
+        answer = self.backend.get(self.NAMESPACE, key)
+        if answer is not None:
+            self.hits += 1
+            return answer.decode("utf-8")
+
+        query = self._unit(query_embedding)
+        if query is not None:
+            items = context_items(context)
+            for candidate_key in self._group_keys(group_key):
+                vector = self.backend.get(self.VECTOR_NAMESPACE, candidate_key)
+                if vector is None or 1.0 - float(np.frombuffer(vector, dtype=np.float32) @ query) > self.max_distance:
+                    continue
+                if not self._covered(candidate_key, items):
+                    continue
+                answer = self.backend.get(self.NAMESPACE, candidate_key)
+                if answer is not None:
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return answer.decode("utf-8")
+
+        self.misses += 1
+        return None
+
+    def set(self, search_term: str, language: str, context: str, answer: str, query_embedding=None):
+        key, group_key = self._keys(search_term, language, context)
+        self.backend.set(self.NAMESPACE, key, answer.encode("utf-8"), self.ttl_seconds)
+        unit = self._unit(query_embedding)
+        if unit is None:
+            return
+        items = context_items(context)
+        if not items:
+            return
+        self.backend.set(self.VECTOR_NAMESPACE, key, unit.astype(np.float32).tobytes(), self.ttl_seconds)
+        self.backend.set(self.ITEMS_NAMESPACE, key, json.dumps(sorted(items)).encode("utf-8"), self.ttl_seconds)
+        # Ghi đè danh sách của nhóm (đọc–sửa–ghi): hai worker ghi cùng lúc chỉ làm mất một ứng viên ngữ nghĩa
+        keys = [existing for existing in self._group_keys(group_key) if existing != key]
+        keys = (keys + [key])[-MAX_GROUP_SIZE:]
+        self.backend.set(self.GROUP_NAMESPACE, group_key, json.dumps(keys, ensure_ascii=False).encode("utf-8"),
+                         self.ttl_seconds)
+
+    async def aget(self, search_term: str, language: str, context: str, query_embedding=None):
+        """get() cho code async: không chặn event loop khi backend là SQLite."""
+        return await run_cache_io(self.backend, self.get, search_term, language, context, query_embedding)
+
+    async def aset(self, search_term: str, language: str, context: str, answer: str, query_embedding=None):
+        await run_cache_io(self.backend, self.set, search_term, language, context, answer, query_embedding)
+
+    def invalidate(self):
+        """Xóa toàn bộ câu trả lời đã cache (ví dụ sau khi nạp lại dữ liệu kiến thức)."""
+        for namespace in (self.NAMESPACE, self.VECTOR_NAMESPACE, self.ITEMS_NAMESPACE, self.GROUP_NAMESPACE):
+            self.backend.clear(namespace)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "backend": self.backend.name,
+        }
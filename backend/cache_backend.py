@@ -0,0 +1,338 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from .observability import get_logger
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+load_dotenv()
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cache.sqlite3")
+# Chỉ ghi lại thời điểm truy cập (phục vụ LRU trên SQLite) nếu lần ghi trước đã cũ hơn khoảng này,
+# để các lượt đọc "nóng" không biến thành lượt ghi
+TOUCH_INTERVAL_SECONDS = 60
+# Số lượt ghi giữa hai lần dọn dẹp (xóa hàng hết hạn, cắt theo giới hạn) trên SQLite
+PRUNE_EVERY_WRITES = 200
+
+
+class CacheBackend(ABC):
+    """
+    Giao diện chung của tầng lưu trữ cache: khóa là (namespace, key), giá trị là bytes, mỗi mục có TTL.
+    Các cache cụ thể (embedding, câu trả lời, chỉ mục âm thanh) tự tuần tự hóa giá trị của mình.
+    blocking = True nghĩa là thao tác có thể chạm đĩa hoặc chờ khóa: code async gọi qua run_cache_io().
+    """
+
+    name = "base"
+    blocking = False
+
+    @abstractmethod
+    def get_entry(self, namespace: str, key: str):
+        """Trả về (value, expires_at) nếu còn hạn, ngược lại None."""
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry else None
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: bytes, ttl: float, expires_at: float = None):
+        """Ghi một mục, hết hạn sau ttl giây (hoặc tại expires_at nếu có)."""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str):
+        """Xóa một mục (không báo lỗi nếu không có)."""
+
+    @abstractmethod
+    def clear(self, namespace: str):
+        """Xóa mọi mục của một namespace."""
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """LRU + TTL trong bộ nhớ của tiến trình, giới hạn theo số mục và tổng số byte."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 20000, max_bytes: int = 128 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (namespace, key) -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get_entry(self, namespace, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._remove((namespace, key))
+                return None
+            self._entries.move_to_end((namespace, key))
+            return entry[1], entry[0]
+
+    def set(self, namespace, key, value, ttl, expires_at=None):
+        expires_at = expires_at or time.time() + ttl
+        with self._lock:
+            self._remove((namespace, key))
+            self._entries[(namespace, key)] = (expires_at, value)
+            self._bytes += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                old_key, (_, old_value) = self._entries.popitem(last=False)
+                self._bytes -= len(old_value)
+                self.evictions += 1
+
+    def _remove(self, full_key):
+        entry = self._entries.pop(full_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._remove((namespace, key))
+
+    def clear(self, namespace):
+        with self._lock:
+            for full_key in [full_key for full_key in self._entries if full_key[0] == namespace]:
+                self._remove(full_key)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, "entries": len(self._entries), "bytes": self._bytes,
+                    "max_entries": self.max_entries, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Cache dùng chung giữa các worker uvicorn trên cùng một máy: một file SQLite ở chế độ WAL
+    (nhiều tiến trình đọc đồng thời, một tiến trình ghi tại một thời điểm). Dữ liệu còn lại sau khi khởi động lại.
+    Giới hạn theo số mục và tổng số byte; khi vượt thì xóa các mục ít được truy cập gần đây nhất.
+    """
+
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, max_entries: int = 200000,
+                 max_bytes: int = 512 * 1024 * 1024, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()  # mỗi thread một kết nối
+        self._writes = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._connection()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries (accessed_at)")
+        db.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            self._local.db = db
+        return db
+
+    def get_entry(self, namespace, key):
+        now = time.time()
+        db = self._connection()
+        row = db.execute(
+            "SELECT value, expires_at, accessed_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key),
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        if now - row[2] > TOUCH_INTERVAL_SECONDS:
+            try:
+                db.execute("UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                           (now, namespace, key))
+                db.commit()
+            except sqlite3.OperationalError as e:
+                # Đang có tiến trình khác ghi: bỏ qua, lần đọc sau sẽ cập nhật
+                logger.debug("Bỏ qua cập nhật thời điểm truy cập cache: %s", e)
+        return bytes(row[0]), row[1]
+
+    def set(self, namespace, key, value, ttl, expires_at=None):
+        now = time.time()
+        db = self._connection()
+        db.execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, expires_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, key, value, len(value), expires_at or now + ttl, now),
+        )
+        db.commit()
+        self._writes += 1
+        if self._writes % PRUNE_EVERY_WRITES == 0:
+            self.prune()
+
+    def prune(self):
+        """Xóa các mục hết hạn, sau đó các mục ít được truy cập gần đây nhất cho tới khi nằm trong giới hạn."""
+        db = self._connection()
+        deleted = db.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),)).rowcount
+        count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        if count > self.max_entries or total > self.max_bytes:
+            # Dọn xuống 90% giới hạn (số byte quy ra số mục theo kích thước trung bình)
+            # để không phải dọn lại ngay ở lần ghi sau
+            keep = int(0.9 * min(self.max_entries, count * self.max_bytes / total))
+            evicted = db.execute(
+                "DELETE FROM cache_entries WHERE (namespace, key) IN (SELECT namespace, key FROM cache_entries"
+                " ORDER BY accessed_at LIMIT ?)",
+                (count - keep,),
+            ).rowcount
+            self.evictions += evicted
+            deleted += evicted
+        db.commit()
+        return deleted
+
+    def delete(self, namespace, key):
+        db = self._connection()
+        db.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+        db.commit()
+
+    def clear(self, namespace):
+        db = self._connection()
+        db.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+        db.commit()
+
+    def stats(self):
+        count, total = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        return {"backend": self.name, "path": self.path, "entries": count, "bytes": total,
+                "max_entries": self.max_entries, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+
+class TieredCacheBackend(CacheBackend):
+    """
+    Tầng đệm nhỏ trong bộ nhớ (local) phía trước tầng dùng chung (shared).
+    Mục lấy từ tầng dùng chung chỉ được giữ ở tầng local tối đa local_ttl giây, nên thay đổi
+    (ghi đè, xóa) từ worker khác được nhìn thấy sau nhiều nhất local_ttl giây.
+    """
+
+    name = "tiered"
+    blocking = True
+
+    def __init__(self, local: MemoryCacheBackend, shared: CacheBackend, local_ttl: float = 60):
+        self.local = local
+        self.shared = shared
+        self.local_ttl = local_ttl
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+    def get_entry(self, namespace, key):
+        entry = self.local.get_entry(namespace, key)
+        if entry is not None:
+            self.local_hits += 1
+            return entry
+        try:
+            entry = self.shared.get_entry(namespace, key)
+        except sqlite3.Error as e:
+            self.shared_errors += 1
+            logger.warning("Không đọc được cache dùng chung: %s", e)
+            return None
+        if entry is not None:
+            self.shared_hits += 1
+            value, expires_at = entry
+            self.local.set(namespace, key, value, 0, expires_at=min(expires_at, time.time() + self.local_ttl))
+        return entry
+
+    def set(self, namespace, key, value, ttl, expires_at=None):
+        expires_at = expires_at or time.time() + ttl
+        self.local.set(namespace, key, value, 0, expires_at=min(expires_at, time.time() + self.local_ttl))
+        try:
+            self.shared.set(namespace, key, value, ttl, expires_at=expires_at)
+        except sqlite3.Error as e:
+            self.shared_errors += 1
+            logger.warning("Không ghi được cache dùng chung: %s", e)
+
+    def delete(self, namespace, key):
+        self.local.delete(namespace, key)
+        try:
+            self.shared.delete(namespace, key)
+        except sqlite3.Error as e:
+            self.shared_errors += 1
+            logger.warning("Không xóa được mục trong cache dùng chung: %s", e)
+
+    def clear(self, namespace):
+        self.local.clear(namespace)
+        try:
+            self.shared.clear(namespace)
+        except sqlite3.Error as e:
+            self.shared_errors += 1
+            logger.warning("Không xóa được namespace '%s' trong cache dùng chung: %s", namespace, e)
+
+    def stats(self):
+        return {"backend": self.name, "local_hits": self.local_hits, "shared_hits": self.shared_hits,
+                "shared_errors": self.shared_errors, "local": self.local.stats(), "shared": self.shared.stats()}
+
+
+async def run_cache_io(backend: CacheBackend, func, *args, **kwargs):
+    """
+    Gọi func(*args) (một thao tác đọc/ghi cache) từ code async: với backend chạm đĩa (SQLite), chạy trong
+    thread pool để một lượt ghi đang chờ busy_timeout không chặn event loop; cache trong bộ nhớ gọi trực tiếp.
+    """
+    if backend.blocking:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def create_cache_backend() -> CacheBackend:
+    """
+    Tạo tầng lưu trữ cache theo biến môi trường:
+    - CACHE_BACKEND=memory (mặc định): LRU trong tiến trình, giới hạn bởi CACHE_MAX_ENTRIES và CACHE_MAX_MB.
+    - CACHE_BACKEND=sqlite: file SQLite dùng chung giữa các worker (CACHE_SQLITE_PATH, CACHE_SQLITE_MAX_ENTRIES,
+      CACHE_SQLITE_MAX_MB), phía trước là một tầng đệm nhỏ trong bộ nhớ (CACHE_MAX_ENTRIES, CACHE_MAX_MB,
+      CACHE_LOCAL_TTL giây).
+    EMBEDDING_CACHE_PATH (cấu hình cũ) vẫn được nhận như CACHE_SQLITE_PATH.
+    """
+    sqlite_path = os.environ.get("CACHE_SQLITE_PATH") or os.environ.get("EMBEDDING_CACHE_PATH")
+    kind = os.environ.get("CACHE_BACKEND") or ("sqlite" if sqlite_path else "memory")
+    if kind not in ("memory", "sqlite"):
+        raise ValueError(f"CACHE_BACKEND không hợp lệ: '{kind}' (chỉ nhận 'memory' hoặc 'sqlite').")
+
+    memory_megabytes = float(os.environ.get("CACHE_MAX_MB", "128" if kind == "memory" else "32"))
+    local = MemoryCacheBackend(
+        max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "20000" if kind == "memory" else "2000")),
+        max_bytes=int(memory_megabytes * 1024 * 1024),
+    )
+    if kind == "memory":
+        return local
+
+    shared = SQLiteCacheBackend(
+        path=sqlite_path or DEFAULT_SQLITE_PATH,
+        max_entries=int(os.environ.get("CACHE_SQLITE_MAX_ENTRIES", "200000")),
+        max_bytes=int(float(os.environ.get("CACHE_SQLITE_MAX_MB", "512")) * 1024 * 1024),
+    )
+    logger.info("Dùng cache dùng chung SQLite tại '%s'.", shared.path)
+    return TieredCacheBackend(local, shared, local_ttl=float(os.environ.get("CACHE_LOCAL_TTL", "60")))
+
+
+_cache_backend = None
+_cache_backend_lock = threading.Lock()
+
+def get_cache_backend() -> CacheBackend:
+    """Tầng lưu trữ cache dùng chung cho cả tiến trình (tạo ở lần gọi đầu tiên)."""
+    global _cache_backend
+    with _cache_backend_lock:
+        if _cache_backend is None:
+            _cache_backend = create_cache_backend()
+        return _cache_backend
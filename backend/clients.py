@@ -0,0 +1,101 @@
+import os
+import asyncio
+import threading
+
+import httpx
+import google.generativeai as genai
+from dotenv import load_dotenv
+from supabase import create_client, acreate_client, Client, AsyncClient, ClientOptions, AsyncClientOptions
+
+from .observability import get_logger
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+load_dotenv()
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+REQUIRED_SETTINGS = {"SUPABASE_URL": SUPABASE_URL, "SUPABASE_SERVICE_KEY": SUPABASE_KEY, "GOOGLE_API_KEY": GOOGLE_API_KEY}
+# Mỗi client Supabase (đồng bộ / async) dùng MỘT connection pool cho cả PostgREST và Storage
+HTTP_MAX_CONNECTIONS = int(os.environ.get("SUPABASE_MAX_CONNECTIONS", "20"))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("SUPABASE_HTTP_TIMEOUT", "20"))
+
+
+class ClientNotConfigured(RuntimeError):
+    """Thiếu biến môi trường cần thiết để tạo client."""
+
+
+def missing_settings() -> list:
+    return [name for name, value in REQUIRED_SETTINGS.items() if not value]
+
+
+def http_pool_options() -> dict:
+    return {
+        "limits": httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        "timeout": HTTP_TIMEOUT_SECONDS,
+        "follow_redirects": True,
+        "http2": True,
+    }
+
+
+def configure_genai():
+    """Cấu hình SDK Gemini (chỉ lưu khóa, không gọi mạng); thiếu khóa thì chỉ cảnh báo, lỗi sẽ xuất hiện khi gọi API."""
+    if not GOOGLE_API_KEY:
+        logger.warning("Chưa đặt GOOGLE_API_KEY: các lệnh gọi Gemini sẽ thất bại.")
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+
+# Client được tạo ở lần dùng đầu tiên (không phải lúc import): thiếu cấu hình hoặc lỗi mạng tạm thời
+# không làm tiến trình dừng khi khởi động, /readyz sẽ báo lỗi thay vào đó
+_supabase: Client = None
+_supabase_lock = threading.Lock()
+_async_supabase: AsyncClient = None
+_async_supabase_lock = asyncio.Lock()
+
+
+def _require_supabase_settings():
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ClientNotConfigured("Chưa đặt SUPABASE_URL hoặc SUPABASE_SERVICE_KEY.")
+
+
+def get_supabase() -> Client:
+    """Trả về client Supabase đồng bộ dùng chung (Storage, script), khởi tạo nếu chưa có."""
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                _require_supabase_settings()
+                options = ClientOptions(httpx_client=httpx.Client(**http_pool_options()))
+                _supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+                logger.info("Đã khởi tạo client Supabase.")
+    return _supabase
+
+
+async def get_async_supabase() -> AsyncClient:
+    """Trả về client Supabase async dùng chung (một connection pool cho mọi request), khởi tạo nếu chưa có."""
+    global _async_supabase
+    if _async_supabase is None:
+        async with _async_supabase_lock:
+            if _async_supabase is None:
+                _require_supabase_settings()
+                options = AsyncClientOptions(httpx_client=httpx.AsyncClient(**http_pool_options()))
+                _async_supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+                logger.info("Đã khởi tạo client Supabase async.")
+    return _async_supabase
+
+
+def clients_status() -> dict:
+    return {"supabase": _supabase is not None, "supabase_async": _async_supabase is not None}
+
+
+async def close_clients():
+    """Đóng các connection pool khi tắt ứng dụng."""
+    global _supabase, _async_supabase
+    for client, close in ((_supabase, "close"), (_async_supabase, "aclose")):
+        http_client = getattr(getattr(client, "options", None), "httpx_client", None)
+        if http_client is not None:
+            result = getattr(http_client, close)()
+            if asyncio.iscoroutine(result):
+                await result
+    _supabase = _async_supabase = None
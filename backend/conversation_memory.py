@@ -0,0 +1,213 @@
+import re
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List
+
+from .ranking import estimate_tokens
+from .observability import get_logger
+
+logger = get_logger(__name__)
+
+# Câu trả lời của bot được cắt bớt khi lưu vào lịch sử (bản đầy đủ đã hiển thị cho người dùng)
+MAX_ANSWER_CHARS = 600
+# Độ dài tối đa của bản tóm tắt dự phòng (khi không gọi được LLM để tóm tắt)
+MAX_FALLBACK_SUMMARY_CHARS = 800
+
+
+@dataclass
+class Exchange:
+    """Một lượt hỏi–đáp."""
+    question: str
+    answer: str
+
+    def render(self) -> str:
+        return f"User: {self.question}\nTutor: {self.answer}"
+
+    @property
+    def size(self) -> int:
+        return len(self.question) + len(self.answer)
+
+
+@dataclass
+class Session:
+    summary: str = ""
+    exchanges: List[Exchange] = field(default_factory=list)  # các lượt gần nhất, giữ nguyên văn
+    pending: List[Exchange] = field(default_factory=list)    # các lượt cũ đang chờ được gộp vào summary
+    last_active: float = field(default_factory=time.time)
+    compacting: bool = False
+
+    @property
+    def size(self) -> int:
+        return len(self.summary) + sum(exchange.size for exchange in self.exchanges + self.pending)
+
+
+def clean_answer(answer: str) -> str:
+    """Bỏ thẻ HTML và markdown thừa, cắt ngắn câu trả lời trước khi đưa vào lịch sử."""
+    text = re.sub(r"<[^>]+>", "", answer or "")
+    text = re.sub(r"\s+", " ", text.replace("**", "")).strip()
+    if len(text) > MAX_ANSWER_CHARS:
+        text = text[:MAX_ANSWER_CHARS].rsplit(" ", 1)[0] + " ..."
+    return text
+
+
+def fallback_summary(summary: str, exchanges: List[Exchange]) -> str:
+    """Tóm tắt không cần LLM: nối các câu hỏi cũ vào summary, chỉ giữ phần mới nhất."""
+    questions = "; ".join(exchange.question for exchange in exchanges)
+    text = f"{summary.rstrip('.')}; {questions}." if summary else f"Earlier questions: {questions}."
+    return text[-MAX_FALLBACK_SUMMARY_CHARS:]
+
+
+class ConversationMemory:
+    """
+    Lịch sử hội thoại theo session, có giới hạn:
+    - Giữ nguyên văn recent_exchanges lượt gần nhất; các lượt cũ hơn được gộp (trong nền) vào một bản tóm tắt
+      bằng summarizer(summary, exchanges) -> str, nhưng chỉ khi đã dồn đủ compact_turns lượt cũ hoặc các lượt
+      này đã chiếm hết token_budget, để không tốn thêm một lệnh gọi LLM cho mỗi câu trả lời.
+    - render() không bao giờ vượt quá token_budget token.
+    - Session không hoạt động quá idle_ttl giây bị xóa; khi vượt max_sessions hoặc tổng max_chars ký tự
+      thì xóa các session ít được dùng gần đây nhất (LRU).
+    """
+
+    def __init__(self, summarizer=None, max_sessions: int = 1000, idle_ttl: float = 1800,
+                 recent_exchanges: int = 3, token_budget: int = 500, max_chars: int = 5_000_000,
+                 compact_turns: int = 4):
+        self.summarizer = summarizer
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.recent_exchanges = recent_exchanges
+        self.token_budget = token_budget
+        self.max_chars = max_chars
+        self.compact_turns = compact_turns
+        self._sessions = OrderedDict()  # session_id -> Session, cũ nhất ở đầu
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self.evictions = 0
+
+    def render(self, session_id: str) -> str:
+        """Lịch sử dạng văn bản để chèn vào prompt: tóm tắt + các lượt gần nhất, trong giới hạn token_budget."""
+        if not session_id:
+            return ""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or time.time() - session.last_active > self.idle_ttl:
+                return ""
+            session.last_active = time.time()
+            self._sessions.move_to_end(session_id)
+            summary = session.summary
+            exchanges = list(session.pending + session.exchanges)
+
+        # Ưu tiên các lượt mới nhất, sau đó mới đến bản tóm tắt
+        parts, used = [], 0
+        for exchange in reversed(exchanges):
+            text = exchange.render()
+            cost = estimate_tokens(text)
+            if used + cost > self.token_budget:
+                break
+            parts.insert(0, text)
+            used += cost
+        if summary and used + estimate_tokens(summary) <= self.token_budget:
+            parts.insert(0, f"Summary of earlier conversation: {summary}")
+        return "\n".join(parts)
+
+    def append(self, session_id: str, question: str, answer: str):
+        """Ghi lại một lượt hỏi–đáp; lượt cũ vượt quá recent_exchanges được đưa đi tóm tắt."""
+        if not session_id:
+            return
+        exchange = Exchange(question=question.strip(), answer=clean_answer(answer))
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session()
+            session.exchanges.append(exchange)
+            session.last_active = time.time()
+            self._sessions.move_to_end(session_id)
+            if len(session.exchanges) > self.recent_exchanges:
+                overflow = len(session.exchanges) - self.recent_exchanges
+                session.pending.extend(session.exchanges[:overflow])
+                del session.exchanges[:overflow]
+            needs_compaction = self._needs_compaction(session)
+            if needs_compaction:
+                session.compacting = True
+            self._evict()
+
+        if needs_compaction:
+            self._schedule_compaction(session_id, session)
+
+    def _needs_compaction(self, session: Session) -> bool:
+        """Có nên tóm tắt các lượt cũ ngay bây giờ không (gọi khi đang giữ _lock)."""
+        if not session.pending or session.compacting:
+            return False
+        if len(session.pending) >= self.compact_turns:
+            return True
+        # Các lượt chờ tóm tắt đã chiếm hết ngân sách lịch sử: để lâu hơn thì chúng bị cắt khỏi prompt
+        pending_tokens = sum(estimate_tokens(exchange.render()) for exchange in session.pending)
+        return pending_tokens >= self.token_budget
+
+    def _schedule_compaction(self, session_id: str, session: Session):
+        try:
+            task = asyncio.get_running_loop().create_task(self._compact(session_id, session))
+        except RuntimeError:
+            # Không có event loop (ví dụ gọi từ script đồng bộ): tóm tắt ngay bằng cách dự phòng
+            with self._lock:
+                session.summary = fallback_summary(session.summary, session.pending)
+                session.pending = []
+                session.compacting = False
+            return
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, session_id: str, session: Session):
+        """Gộp các lượt đang chờ vào bản tóm tắt; lặp lại nếu có thêm lượt mới trong lúc đang tóm tắt."""
+        try:
+            while True:
+                with self._lock:
+                    batch = list(session.pending)
+                    summary = session.summary
+                if not batch:
+                    return
+                new_summary = None
+                if self.summarizer is not None:
+                    try:
+                        new_summary = (await self.summarizer(summary, batch)).strip()
+                    except Exception as e:
+                        logger.warning("Không thể tóm tắt lịch sử hội thoại, dùng cách dự phòng: %s", e)
+                if not new_summary:
+                    new_summary = fallback_summary(summary, batch)
+                with self._lock:
+                    session.summary = new_summary
+                    del session.pending[:len(batch)]
+                logger.info("Đã gộp %s lượt cũ vào tóm tắt của session '%s'.", len(batch), session_id)
+        finally:
+            with self._lock:
+                session.compacting = False
+
+    def _evict(self):
+        """Xóa session hết hạn và session LRU cho tới khi nằm trong giới hạn (gọi khi đang giữ _lock)."""
+        now = time.time()
+        total = 0
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_active > self.idle_ttl:
+                del self._sessions[session_id]
+                self.evictions += 1
+            else:
+                total += session.size
+        while self._sessions and (len(self._sessions) > self.max_sessions or total > self.max_chars):
+            _, session = self._sessions.popitem(last=False)
+            total -= session.size
+            self.evictions += 1
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "chars": sum(session.size for session in self._sessions.values()),
+                "evictions": self.evictions,
+                "max_sessions": self.max_sessions,
+            }
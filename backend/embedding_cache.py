@@ -0,0 +1,62 @@
+import re
+from array import array
+
+from .cache_backend import CacheBackend, MemoryCacheBackend, run_cache_io
+
+
+def normalize_key_text(text: str) -> str:
+    """Chuẩn hóa từ khóa trước khi làm khóa cache: viết thường, bỏ ngoặc kép và gộp khoảng trắng."""
+    text = text.strip().strip("\"'“”‘’").casefold()
+    return re.sub(r"\s+", " ", text)
+
+
+class EmbeddingCache:
+    """
+    Cache embedding của câu truy vấn, khóa theo (model, từ khóa đã chuẩn hóa).
+    Dữ liệu nằm trong một CacheBackend (xem backend/cache_backend.py): LRU trong tiến trình,
+    hoặc SQLite dùng chung giữa các worker và còn lại sau khi khởi động lại.
+    """
+
+    NAMESPACE = "query_embedding"
+
+    def __init__(self, backend: CacheBackend = None, ttl_seconds: float = 7 * 24 * 3600):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return f"{model}\x1f{normalize_key_text(text)}"
+
+    def get(self, model: str, text: str):
+        """Trả về embedding (list[float]) nếu có trong cache và chưa hết hạn, ngược lại trả về None."""
+        value = self.backend.get(self.NAMESPACE, self.make_key(model, text))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        vector = array("f")
+        vector.frombytes(value)
+        return vector.tolist()
+
+    def set(self, model: str, text: str, embedding):
+        """Lưu embedding dưới dạng float32 (4 byte mỗi chiều)."""
+        self.backend.set(self.NAMESPACE, self.make_key(model, text), array("f", embedding).tobytes(), self.ttl_seconds)
+
+    async def aget(self, model: str, text: str):
+        """get() cho code async: không chặn event loop khi backend là SQLite."""
+        return await run_cache_io(self.backend, self.get, model, text)
+
+    async def aset(self, model: str, text: str, embedding):
+        await run_cache_io(self.backend, self.set, model, text, embedding)
+
+    def stats(self) -> dict:
+        """Các bộ đếm hit/miss (của tiến trình này) để theo dõi hiệu quả của cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "backend": self.backend.name,
+        }
@@ -0,0 +1,138 @@
+import re
+import unicodedata
+
+# --- CẤU HÌNH ---
+# Dưới ngưỡng này, kết quả nhận diện cục bộ được coi là không chắc chắn và cần hỏi LLM
+CONFIDENCE_THRESHOLD = 0.8
+
+# Các ký tự có dấu đặc trưng của tiếng Việt (không tính các nguyên âm không dấu a, e, i, o, u, y)
+VIETNAMESE_CHARS = set(
+    "àáảãạăằắẳẵặâầấẩẫậđèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵ"
+)
+
+# Các âm tiết tiếng Việt phổ biến (đã bỏ dấu) cho trường hợp người dùng gõ không dấu
+VIETNAMESE_SYLLABLES = {
+    "la", "gi", "nghia", "cua", "cho", "toi", "ban", "vi", "du", "ve", "mot", "cac", "nhung",
+    "khong", "co", "duoc", "nay", "kia", "nao", "sao", "tai", "vay", "nhe", "nha",
+    "tu", "cau", "ngu", "phap", "thanh", "hoi", "thoai", "phan", "biet", "giai", "thich",
+    "xin", "chao", "cam", "hay", "dung", "cach", "trong", "voi", "va", "thi", "hien",
+}
+
+# Các từ chức năng tiếng Anh phổ biến
+ENGLISH_WORDS = {
+    "what", "does", "do", "is", "are", "the", "a", "an", "of", "mean", "meaning", "how",
+    "why", "when", "which", "can", "you", "me", "give", "example", "examples", "use",
+    "difference", "between", "and", "or", "in", "to", "please", "explain", "tell", "about",
+    "i", "my", "should", "say", "word", "idiom", "grammar", "rule", "sentence",
+    "hi", "hello", "hey", "there", "thanks", "thank", "bye", "goodbye", "good", "morning", "okay",
+}
+
+# Câu chào / cảm ơn / tạm biệt (so khớp trên văn bản đã bỏ dấu, viết thường)
+SMALL_TALK_PATTERN = re.compile(
+    r"^(hi|hello|hey|helo|alo|xin chao|chao|cam on|thanks|thank you|thank|tam biet|bye|goodbye"
+    r"|good (morning|afternoon|evening|night)|ok|okay)"
+    r"( (ban|nhe|nha|a|you|there|bot|tutor|nhieu|lam|so much|very much))*$"
+)
+
+# Từ khóa hợp lệ cho fast path: từ/cụm từ tiếng Anh ngắn (tối đa 6 từ)
+_KEYWORD = r"[\"'“‘]?(?P<keyword>[A-Za-z][A-Za-z\-’']*(?: [A-Za-z][A-Za-z\-’']*){0,5}?)[\"'”’]?"
+
+# Các mẫu câu hỏi định nghĩa rõ ràng, ví dụ "X nghĩa là gì", "What does X mean?"
+DEFINITION_PATTERNS = [
+    re.compile(rf"^(?:y )?nghia cua (?:tu |cum tu |thanh ngu )?{_KEYWORD} la gi\b", re.IGNORECASE),
+    re.compile(rf"^(?:tu |cum tu |thanh ngu )?{_KEYWORD} (?:co )?(?:y )?nghia la gi\b", re.IGNORECASE),
+    re.compile(rf"^(?:tu |cum tu |thanh ngu )?{_KEYWORD} la gi\b", re.IGNORECASE),
+    re.compile(rf"^what does {_KEYWORD} mean\b", re.IGNORECASE),
+    re.compile(rf"^what is the meaning of {_KEYWORD}$", re.IGNORECASE),
+    re.compile(rf"^(?:define|meaning of) {_KEYWORD}$", re.IGNORECASE),
+]
+
+# Đại từ / từ chỉ định: "it" trong "what does it mean" trỏ tới chủ đề của lượt trước, không phải từ khóa
+# (so khớp trên văn bản đã bỏ dấu, viết thường)
+DEICTIC_KEYWORDS = {
+    "it", "this", "that", "these", "those", "they", "them", "its", "this one", "that one",
+    "this word", "that word", "this phrase", "that phrase", "this idiom", "that idiom",
+    "no", "cai nay", "cai do", "cai kia", "tu nay", "tu do", "tu kia", "cau nay", "cau do", "cum tu nay", "cum tu do",
+}
+
+
+def strip_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt (giữ nguyên chữ hoa/thường), ví dụ 'Nghĩa là gì' -> 'Nghia la gi'."""
+    decomposed = unicodedata.normalize("NFD", text)
+    stripped = "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+    return stripped.replace("đ", "d").replace("Đ", "D")
+
+
+def normalize_text(text: str) -> str:
+    """Bỏ dấu, bỏ dấu câu ở hai đầu và gộp khoảng trắng."""
+    text = strip_diacritics(text).strip()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .,!?;:…")
+
+
+def detect_language_local(text: str):
+    """
+    Nhận diện ngôn ngữ (Vietnamese/English) hoàn toàn cục bộ dựa trên ký tự có dấu
+    và các âm tiết/từ phổ biến. Trả về (language, confidence) với confidence trong [0, 1].
+    """
+    tokens = re.findall(r"[^\W\d_]+", text.lower())
+    if not tokens:
+        return "Vietnamese", 0.0
+
+    accented = [token for token in tokens if any(ch in VIETNAMESE_CHARS for ch in token)]
+    if len(accented) >= 2:
+        return "Vietnamese", 0.99
+
+    plain_tokens = [strip_diacritics(token) for token in tokens if token not in accented]
+    vi_hits = sum(1 for token in plain_tokens if token in VIETNAMESE_SYLLABLES)
+    en_hits = sum(1 for token in plain_tokens if token in ENGLISH_WORDS)
+    if accented:
+        # Một từ có dấu có thể là từ mượn trong câu tiếng Anh ("What is a café?"):
+        # chỉ chắc chắn là tiếng Việt khi các từ còn lại không nghiêng về tiếng Anh
+        if en_hits > vi_hits:
+            return "English", 0.85 if en_hits >= 2 else 0.6
+        return "Vietnamese", 0.9 if vi_hits else 0.7
+    if vi_hits == en_hits:
+        return "Vietnamese", 0.5 if vi_hits else 0.0
+
+    language = "Vietnamese" if vi_hits > en_hits else "English"
+    margin = abs(vi_hits - en_hits) / len(plain_tokens)
+    # Cần ít nhất 2 tín hiệu (hoặc mọi từ đều là tín hiệu) để đạt độ tin cậy cao
+    if max(vi_hits, en_hits) >= 2:
+        confidence = min(0.95, 0.5 + margin)
+    else:
+        confidence = 0.85 if margin == 1.0 else min(0.7, 0.5 + margin)
+    return language, confidence
+
+
+def is_deictic(keyword: str) -> bool:
+    """Từ khóa chỉ là đại từ/từ chỉ định ("it", "this", "nó", "cái này"), cần lịch sử để biết nó trỏ tới đâu."""
+    return normalize_text(keyword).lower() in DEICTIC_KEYWORDS
+
+
+def match_intent_rules(text: str):
+    """
+    Fast path cho các câu hỏi hiển nhiên, không cần gọi LLM.
+    Trả về (intent, keyword) nếu khớp luật, hoặc None nếu cần để LLM quyết định.
+    """
+    normalized = normalize_text(text)
+    if not normalized:
+        return None
+
+    if SMALL_TALK_PATTERN.match(normalized.lower()):
+        return "Conversational", ""
+
+    for pattern in DEFINITION_PATTERNS:
+        match = pattern.match(normalized)
+        if not match:
+            continue
+        keyword = match.group("keyword").strip("'’")
+        if is_deictic(keyword):
+            # "What does it mean?": để LLM xác định chủ đề từ lịch sử hội thoại
+            return None
+        # Từ khóa phải xuất hiện nguyên văn trong câu gốc (loại trừ cụm tiếng Việt đã bị bỏ dấu)
+        if keyword.lower() in text.lower():
+            return "Q&A", keyword
+        return None
+
+    return None
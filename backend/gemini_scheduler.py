@@ -0,0 +1,320 @@
+import os
+import re
+import time
+import heapq
+import enum
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from .observability import (
+    get_logger, registry, Counter, Histogram, GaugeCallback, LLM_CALLS, LLM_RATE_LIMITED, LLM_CALL_SECONDS,
+)
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+load_dotenv()
+# Gemini thường gợi ý thời gian chờ trong thông báo lỗi 429, ví dụ "Please retry in 37.5s"
+# hoặc "retry_delay { seconds: 37 }"
+RETRY_HINT_PATTERN = re.compile(r"retry in ([\d.]+)s|retry_delay\s*{\s*seconds:\s*(\d+)", re.IGNORECASE)
+
+SCHEDULER_ENABLED = os.environ.get("GEMINI_SCHEDULER_ENABLED", "1") == "1"
+# Giới hạn số lệnh gọi/phút mặc định cho mỗi mô hình. Giới hạn tính cho MỘT tiến trình: quota của Google
+# tính theo project, nên chạy N worker thì phải chia quota cho N. GEMINI_RATE_LIMITS ghi đè từng mô hình
+# (ví dụ "gemini-2.5-flash=15" khi chạy 4 worker), GEMINI_DEFAULT_RPM áp dụng cho mô hình không có trong danh sách
+DEFAULT_RATE_LIMITS = {"gemini-2.5-flash": 60, "gemini-2.5-flash-preview-tts": 10, "models/text-embedding-004": 600}
+DEFAULT_RPM = 60
+# Khi gặp 429: tốc độ giảm theo hệ số này; mỗi lệnh gọi thành công tăng lại một phần của tốc độ tối đa
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_FRACTION = 0.05
+MIN_RATE_FRACTION = 0.05
+# Thời gian tạm dừng tối đa sau một lỗi 429 (kể cả khi API gợi ý chờ lâu hơn)
+MAX_PAUSE_SECONDS = 60
+# Phần dung lượng bucket được giữ lại cho các lớp ưu tiên cao hơn (TTS phải chừa 1 phần, batch chừa 2 phần)
+RESERVE_FRACTION = 0.2
+
+
+class Priority(enum.IntEnum):
+    """Lớp ưu tiên: số nhỏ hơn được phục vụ trước."""
+    INTERACTIVE = 0  # trả lời chat: phân tích câu hỏi, embedding truy vấn, sinh câu trả lời
+    TTS = 1          # tạo âm thanh khi người dùng bấm nghe
+    BATCH = 2        # việc nền: tóm tắt lịch sử, tạo trước âm thanh hàng loạt
+
+
+# Lớp ưu tiên mặc định của các lệnh gọi trong request hiện tại (ví dụ /answer/batch chạy ở lớp batch)
+priority_var = contextvars.ContextVar("gemini_priority", default=Priority.INTERACTIVE)
+
+
+def parse_pairs(text: str, cast=float) -> dict:
+    """'a=1,b=2' -> {'a': 1.0, 'b': 2.0}; bỏ qua phần tử rỗng."""
+    pairs = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            name, value = item.rsplit("=", 1)
+            pairs[name.strip()] = cast(value)
+    return pairs
+
+
+def priority_settings(env_name: str, defaults: dict) -> dict:
+    values = {**defaults, **parse_pairs(os.environ.get(env_name, ""))}
+    return {Priority[name.upper()]: value for name, value in values.items()}
+
+
+# Số request tối đa được xếp hàng cho mỗi lớp, và thời gian chờ tối đa trước khi bị từ chối (giây)
+QUEUE_LIMITS = priority_settings("GEMINI_QUEUE_LIMITS", {"interactive": 50, "tts": 100, "batch": 1000})
+MAX_WAIT_SECONDS = priority_settings("GEMINI_MAX_WAIT", {"interactive": 10, "tts": 30, "batch": 600})
+
+
+def is_rate_limited(error) -> bool:
+    """Lỗi 429/hết quota của Gemini (hoặc GeminiOverloaded); nhận cả exception lẫn thông báo lỗi dạng chuỗi."""
+    return "429" in str(error) or "quota" in str(error).lower()
+
+
+def retry_after_seconds(error):
+    """Thời gian chờ (giây) mà API gợi ý trong thông báo lỗi 429, hoặc None nếu không có."""
+    hint = RETRY_HINT_PATTERN.search(str(error))
+    return float(hint.group(1) or hint.group(2)) if hint else None
+
+
+class GeminiOverloaded(Exception):
+    """
+    Hàng đợi của một mô hình đã đầy hoặc thời gian chờ ước tính vượt giới hạn của lớp ưu tiên.
+    Thông báo có dạng giống lỗi 429 của Gemini ("quota", "retry in Xs") để các đoạn mã thử lại hiện có
+    xử lý như nhau; API trả về 503 kèm header Retry-After.
+    """
+
+    def __init__(self, model: str, priority: Priority, retry_after: float):
+        self.model, self.priority, self.retry_after = model, priority, retry_after
+        super().__init__(f"Local quota scheduler for {model} is saturated ({priority.name.lower()}). "
+                         f"Please retry in {retry_after:.1f}s.")
+
+
+QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "chatbot_llm_queue_wait_seconds", "Thời gian chờ trong hàng đợi quota trước khi gọi Gemini.", ["model", "priority"]))
+SHED_REQUESTS = registry.register(Counter(
+    "chatbot_llm_shed_total", "Số lệnh gọi Gemini bị từ chối ngay vì hàng đợi quota đầy.", ["model", "priority"]))
+
+
+class ModelLimiter:
+    """
+    Token bucket của một mô hình, có hàng đợi theo ưu tiên:
+    - Token được cấp cho request ưu tiên cao nhất (cùng lớp thì theo thứ tự đến); lớp thấp hơn chỉ được lấy
+      token khi bucket còn dư phần dành cho các lớp cao hơn.
+    - Tốc độ tự điều chỉnh: giảm một nửa và tạm dừng (theo gợi ý "retry in Xs" nếu có) khi gặp 429,
+      tăng dần lại tới rate_per_minute sau mỗi lệnh gọi thành công. Các lỗi 429 khác trong cùng thời gian
+      tạm dừng (thường là các lệnh gọi đang chạy song song) chỉ kéo dài thời gian dừng, không giảm tốc độ thêm.
+    - Việc tạm dừng chỉ áp dụng cho lớp đã gặp 429 và các lớp thấp hơn: 429 của việc nền không chặn
+      câu hỏi chat.
+    """
+
+    def __init__(self, model: str, rate_per_minute: float, burst: float = None):
+        self.model = model
+        self.max_rate = rate_per_minute / 60
+        self.rate = self.max_rate
+        self.capacity = burst or max(1.0, rate_per_minute / 6)  # mặc định: lượng token của 10 giây
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.paused_priority = Priority.INTERACTIVE  # lớp cao nhất bị tạm dừng
+        self.rate_limited = 0
+        self.shed = 0
+        self._waiters = []  # heap (priority, seq, future)
+        self._queued = {priority: 0 for priority in Priority}
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._wakeup = None  # asyncio.Event: có request mới vào hàng đợi
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def _required(self, priority: Priority) -> float:
+        # Không vượt quá dung lượng bucket, nếu không lớp thấp sẽ không bao giờ được cấp lượt
+        return min(self.capacity, 1.0 + int(priority) * RESERVE_FRACTION * self.capacity)
+
+    def _time_until(self, needed: float, priority: Priority) -> float:
+        now = self._refill()
+        pause = max(0.0, self.paused_until - now) if priority >= self.paused_priority else 0.0
+        return max(pause, (needed - self.tokens) / self.rate) if self.tokens < needed else pause
+
+    def estimate_wait(self, priority: Priority, pending: int = 0) -> float:
+        """
+        Thời gian chờ ước tính cho một request mới của lớp priority, tính cả các request đứng trước
+        và pending request đang chờ ở hàng đợi khác (ví dụ các job TTS chưa tới lượt worker).
+        """
+        ahead = pending + sum(count for level, count in self._queued.items() if level <= priority)
+        return self._time_until(ahead + self._required(priority), priority)
+
+    def admit(self, priority: Priority, pending: int = 0):
+        """Từ chối ngay (GeminiOverloaded) nếu hàng đợi của lớp đã đầy hoặc phải chờ quá lâu."""
+        retry_after = self.estimate_wait(priority, pending)
+        if self._queued[priority] + pending >= QUEUE_LIMITS[priority] or retry_after > MAX_WAIT_SECONDS[priority]:
+            self._shed(priority, retry_after)
+
+    async def acquire(self, priority: Priority):
+        self.admit(priority)
+        max_wait = MAX_WAIT_SECONDS[priority]
+
+        if not self._waiters and self._time_until(self._required(priority), priority) == 0:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._queued[priority] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            self._wakeup.set()
+        try:
+            await asyncio.wait_for(future, max_wait)
+        except asyncio.TimeoutError:
+            self._shed(priority, self.estimate_wait(priority))
+        finally:
+            self._queued[priority] -= 1
+
+    def _shed(self, priority: Priority, retry_after: float):
+        self.shed += 1
+        SHED_REQUESTS.inc(self.model, priority.name.lower())
+        raise GeminiOverloaded(self.model, priority, max(1.0, retry_after))
+
+    async def _dispatch(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():  # request đã hết thời gian chờ hoặc bị hủy
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._time_until(self._required(priority), priority)
+            if delay > 0:
+                # Ngủ tới khi đủ token, hoặc dậy sớm nếu có request (có thể ưu tiên cao hơn) mới vào hàng đợi
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            future.set_result(None)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_FRACTION)
+
+    def on_rate_limited(self, retry_after: float = None, priority: Priority = Priority.INTERACTIVE):
+        now = self._refill()
+        self.rate_limited += 1
+        if now < self.paused_until:
+            # Cùng một đợt quá tải: chỉ kéo dài / mở rộng việc tạm dừng, tốc độ đã được giảm một lần
+            self.paused_until = max(self.paused_until, now + min(MAX_PAUSE_SECONDS, retry_after or 0.0))
+            self.paused_priority = min(self.paused_priority, priority)
+            return
+        self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate * RATE_DECREASE_FACTOR)
+        self.tokens *= RATE_DECREASE_FACTOR
+        self.paused_until = now + min(MAX_PAUSE_SECONDS, retry_after or 1 / self.rate)
+        self.paused_priority = priority
+        logger.warning("Gemini '%s' trả về 429 (%s): giảm tốc độ còn %.1f lệnh/phút, tạm dừng lớp %s trở xuống %.1f giây.",
+                       self.model, priority.name.lower(), self.rate * 60, priority.name.lower(), self.paused_until - now)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "rate_per_minute": round(self.rate * 60, 2),
+            "max_rate_per_minute": round(self.max_rate * 60, 2),
+            "tokens": round(self.tokens, 2),
+            "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 2),
+            "queued": {priority.name.lower(): count for priority, count in self._queued.items()},
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+        }
+
+
+class GeminiScheduler:
+    """Điểm đi qua duy nhất của mọi lệnh gọi Gemini (sinh văn bản, TTS, embedding) trong tiến trình."""
+
+    def __init__(self, rate_limits: dict = None, default_rpm: float = DEFAULT_RPM, enabled: bool = True):
+        self.rate_limits = rate_limits or {}
+        self.default_rpm = default_rpm
+        self.enabled = enabled
+        self._limiters = {}
+
+    @classmethod
+    def from_env(cls):
+        """Giới hạn của tiến trình này: DEFAULT_RATE_LIMITS, ghi đè theo từng mô hình bằng GEMINI_RATE_LIMITS."""
+        return cls(
+            rate_limits={**DEFAULT_RATE_LIMITS, **parse_pairs(os.environ.get("GEMINI_RATE_LIMITS", ""))},
+            default_rpm=float(os.environ.get("GEMINI_DEFAULT_RPM", str(DEFAULT_RPM))),
+            enabled=SCHEDULER_ENABLED,
+        )
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limiter = self._limiters[model] = ModelLimiter(model, self.rate_limits.get(model, self.default_rpm))
+        return limiter
+
+    async def run(self, model: str, priority: Priority, call, purpose: str = "", stream: bool = False):
+        """
+        Chờ tới lượt theo quota của model rồi thực hiện call() (hàm trả về coroutine lệnh gọi Gemini).
+        Ném GeminiOverloaded nếu không được cấp lượt trong thời gian chờ tối đa của lớp ưu tiên.
+        Với stream=True, call() trả về phản hồi stream và run() trả về async iterator chuyển tiếp từng phần:
+        kết quả chỉ được ghi nhận sau phần cuối cùng, nên lỗi 429 giữa chừng vẫn làm giảm tốc độ.
+        """
+        limiter = self.limiter(model)
+        if self.enabled:
+            started = time.perf_counter()
+            await limiter.acquire(priority)
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, model, priority.name.lower())
+        if stream:
+            return self._stream(limiter, model, priority, purpose, call)
+        with self._track(limiter, model, priority, purpose):
+            return await call()
+
+    @staticmethod
+    @contextmanager
+    def _track(limiter: ModelLimiter, model: str, priority: Priority, purpose: str):
+        """
+        Đếm và đo thời gian lệnh gọi (lỗi 429 được đếm riêng), đồng thời điều chỉnh tốc độ theo kết quả:
+        giảm khi gặp 429, tăng dần lại khi thành công. Lệnh gọi bị hủy (client ngắt kết nối, stream bị đóng
+        giữa chừng) được đếm là "cancelled" và không ảnh hưởng tới tốc độ.
+        """
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            outcome = "rate_limited" if is_rate_limited(e) else "error"
+            if outcome == "rate_limited":
+                LLM_RATE_LIMITED.inc(model, purpose)
+                limiter.on_rate_limited(retry_after_seconds(e), priority)
+            raise
+        finally:
+            LLM_CALLS.inc(model, purpose, outcome)
+            LLM_CALL_SECONDS.observe(time.perf_counter() - started, model, purpose)
+        limiter.on_success()
+
+    async def _stream(self, limiter: ModelLimiter, model: str, priority: Priority, purpose: str, call):
+        with self._track(limiter, model, priority, purpose):
+            response = await call()
+            async for chunk in response:
+                yield chunk
+
+    def stats(self) -> dict:
+        return {model: limiter.stats() for model, limiter in self._limiters.items()}
+
+
+gemini_scheduler = GeminiScheduler.from_env()
+
+registry.register(GaugeCallback(
+    "chatbot_llm_rate_per_minute", "Tốc độ gọi Gemini hiện được phép (sau khi tự điều chỉnh theo 429).", ["model"],
+    lambda: {(model,): limiter.rate * 60 for model, limiter in gemini_scheduler._limiters.items()},
+))
@@ -0,0 +1,229 @@
+import os
+import re
+import csv
+import json
+import bisect
+import hashlib
+import itertools
+import threading
+
+from .fast_path import strip_diacritics
+from .observability import get_logger
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Supabase")
+
+# Khóa trong retrieved_data -> (file CSV, cột dùng làm khóa tra cứu)
+LEXICAL_SOURCES = {
+    "vocabulary": ("english_vocabulary.csv", "word"),
+    "grammar": ("english_grammar_rules.csv", "rule"),
+    "idioms": ("english_idioms.csv", "phrase"),
+    "common_mistakes": ("english_common_mistakes.csv", "mistake"),
+    "conversations": ("english_conversations.csv", "situation"),
+}
+
+# Khóa trong retrieved_data -> (bảng trong Supabase, các cột nội dung): cùng các bảng mà tìm kiếm vector truy vấn
+LEXICAL_TABLES = {
+    "vocabulary": ("english_vocabulary", "id,word,phonetic,meaning,example"),
+    "grammar": ("english_grammar_rules", "id,rule,explanation,example"),
+    "idioms": ("english_idioms", "id,phrase,meaning,example"),
+    "common_mistakes": ("english_common_mistakes", "id,mistake,correction,example"),
+    "conversations": ("english_conversations", "id,situation,dialogue,context"),
+}
+PAGE_SIZE = 1000
+
+# Khoảng thời gian giữa hai lần kiểm tra (trong nền) dữ liệu nguồn có thay đổi hay không:
+# file CSV chỉ cần so mtime, bảng Supabase phải tải lại toàn bộ nên kiểm tra thưa hơn
+REFRESH_CHECK_SECONDS = 30
+SUPABASE_REFRESH_SECONDS = 300
+
+# Độ tương đồng gán cho các kiểu khớp: chính xác, dạng biến đổi của từ ("idioms" -> "idiom"),
+# và tiền tố duy nhất theo ranh giới từ ("break a" -> "break a leg")
+EXACT_SIMILARITY = 1.0
+INFLECTED_SIMILARITY = 0.97
+PREFIX_SIMILARITY = 0.9
+# Khớp tiền tố cần từ khóa đủ dài để không trùng ngẫu nhiên
+MIN_PREFIX_LENGTH = 4
+# Đuôi biến đổi tiếng Anh -> phần thay thế để về dạng gốc, thử theo thứ tự
+INFLECTION_SUFFIXES = [("ies", "y"), ("ied", "y"), ("es", ""), ("s", ""), ("ed", "e"), ("ed", ""),
+                       ("ing", "e"), ("ing", "")]
+
+
+def normalize_term(text: str) -> str:
+    """Chuẩn hóa để so khớp: bỏ dấu, viết thường, thống nhất dấu nháy, bỏ dấu câu và gộp khoảng trắng."""
+    text = strip_diacritics(text or "").casefold().replace("’", "'").replace("‘", "'")
+    text = re.sub(r"[^\w\s']", " ", text)
+    return re.sub(r"\s+", " ", text).strip(" '")
+
+
+class LexicalIndex:
+    """
+    Chỉ mục tra cứu (không cần embedding) cho word/phrase/rule/mistake/situation: hash map theo khóa
+    đã chuẩn hóa, cùng danh sách khóa đã sắp xếp để tìm theo tiền tố.
+    Dữ liệu lấy từ chính các bảng Supabase mà tìm kiếm vector truy vấn (client_factory trả về client đồng bộ),
+    nên hàng được sửa trong Supabase không bị phục vụ bản cũ; file CSV trong data_dir chỉ là dự phòng khi
+    chưa nạp được từ Supabase (hoặc là nguồn chính khi không có client_factory).
+    refresh()/refresh_if_changed() đọc dữ liệu nguồn nên được gọi khi khởi động hoặc trong nền,
+    không phải trên đường xử lý request; lookup() chỉ đọc bộ nhớ.
+    """
+
+    def __init__(self, data_dir=DEFAULT_DATA_DIR, client_factory=None):
+        self.data_dir = data_dir
+        self.client_factory = client_factory
+        self.source = None       # "supabase" | "csv": nguồn của lần dựng gần nhất
+        self._terms = {}         # khóa chuẩn hóa -> {table_key: [row, ...]}
+        self._sorted_terms = []  # dùng cho tra cứu tiền tố (bisect)
+        self._source_version = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._terms)
+
+    @property
+    def refresh_seconds(self) -> float:
+        return SUPABASE_REFRESH_SECONDS if self.client_factory else REFRESH_CHECK_SECONDS
+
+    def _current_mtimes(self):
+        mtimes = {}
+        for file_name, _ in LEXICAL_SOURCES.values():
+            path = os.path.join(self.data_dir, file_name)
+            mtimes[path] = os.path.getmtime(path) if os.path.exists(path) else None
+        return mtimes
+
+    def _read_csv_rows(self):
+        """{table_key: [row, ...]} từ các file CSV đi kèm."""
+        rows = {}
+        for table_key, (file_name, _) in LEXICAL_SOURCES.items():
+            path = os.path.join(self.data_dir, file_name)
+            if not os.path.exists(path):
+                logger.warning("Không tìm thấy file '%s' cho chỉ mục từ vựng.", path)
+                continue
+            with open(path, encoding="utf-8", newline="") as f:
+                rows[table_key] = list(csv.DictReader(f))
+        return rows
+
+    def _fetch_supabase_rows(self):
+        """{table_key: [row, ...]} từ các bảng Supabase, phân trang theo id (keyset), không tải cột embedding."""
+        client = self.client_factory()
+        rows = {}
+        for table_key, (table_name, columns) in LEXICAL_TABLES.items():
+            table_rows, last_id = [], None
+            while True:
+                query = client.table(table_name).select(columns).order("id").limit(PAGE_SIZE)
+                if last_id is not None:
+                    query = query.gt("id", last_id)
+                data = query.execute().data
+                if not data:
+                    break
+                table_rows.extend(data)
+                last_id = data[-1]["id"]
+            rows[table_key] = table_rows
+        return rows
+
+    def _load_rows(self):
+        """(nguồn, dữ liệu, phiên bản của dữ liệu nguồn để phát hiện thay đổi)."""
+        if self.client_factory:
+            try:
+                rows = self._fetch_supabase_rows()
+                digest = hashlib.sha256(json.dumps(rows, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+                return "supabase", rows, digest.hexdigest()
+            except Exception as e:
+                if self.loaded:
+                    raise
+                logger.warning("Không tải được dữ liệu từ Supabase cho chỉ mục từ vựng, tạm dùng file CSV: %s", e)
+        return "csv", self._read_csv_rows(), self._current_mtimes()
+
+    def _build(self, source, rows, version):
+        terms = {}
+        for table_key, table_rows in rows.items():
+            key_column = LEXICAL_SOURCES[table_key][1]
+            for row in table_rows:
+                term = normalize_term(row.get(key_column))
+                if not term:
+                    continue
+                bucket = terms.setdefault(term, {}).setdefault(table_key, [])
+                # Bộ dữ liệu có nhiều hàng trùng lặp hoàn toàn (khác id), chỉ giữ một bản
+                content = {k: v for k, v in row.items() if k != "id"}
+                if all({k: v for k, v in existing.items() if k != "id"} != content for existing in bucket):
+                    bucket.append(row)
+
+        with self._lock:
+            self._terms = terms
+            self._sorted_terms = sorted(terms)
+            self.source = source
+            self._source_version = version
+        logger.info("Đã dựng chỉ mục từ vựng (%s) với %s khóa.", source, len(terms))
+        return self
+
+    def refresh(self):
+        """Đọc lại toàn bộ dữ liệu nguồn và dựng lại chỉ mục."""
+        return self._build(*self._load_rows())
+
+    def refresh_if_changed(self):
+        """Dựng lại chỉ mục nếu chưa nạp được hoặc dữ liệu nguồn đã thay đổi."""
+        if not self.loaded:
+            return self.refresh()
+        if self.client_factory is None:
+            if self._current_mtimes() != self._source_version:
+                logger.info("Dữ liệu nguồn đã thay đổi, đang dựng lại chỉ mục từ vựng...")
+                return self.refresh()
+            return self
+        # Bảng Supabase không có mtime: tải lại và so sánh mã băm (lỗi mạng giữ nguyên chỉ mục hiện tại,
+        # kể cả khi đang dùng CSV dự phòng)
+        source, rows, version = self._load_rows()
+        if (source, version) != (self.source, self._source_version):
+            logger.info("Dữ liệu nguồn đã thay đổi, đang dựng lại chỉ mục từ vựng...")
+            self._build(source, rows, version)
+        return self
+
+    def _match(self, term: str):
+        """(các hàng theo bảng, độ tương đồng) của khóa khớp tốt nhất, hoặc None."""
+        hits = self._terms.get(term)
+        if hits:
+            return hits, EXACT_SIMILARITY
+
+        # Dạng biến đổi của từ cuối: "idioms" -> "idiom", "running" -> "run", "studied" -> "study"
+        for suffix, replacement in INFLECTION_SUFFIXES:
+            if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+                stem = term[:-len(suffix)] + replacement
+                candidates = [stem]
+                if suffix in ("ing", "ed") and not replacement and len(stem) > 3 and stem[-1] == stem[-2]:
+                    candidates.append(stem[:-1])  # phụ âm gấp đôi: "running" -> "run"
+                for candidate in candidates:
+                    hits = self._terms.get(candidate)
+                    if hits:
+                        return hits, INFLECTED_SIMILARITY
+
+        # Tiền tố theo ranh giới từ, chỉ khi có đúng một khóa khớp: "break a" -> "break a leg"
+        if len(term) >= MIN_PREFIX_LENGTH:
+            prefix = term + " "
+            start = bisect.bisect_left(self._sorted_terms, prefix)
+            matches = [key for key in itertools.islice(self._sorted_terms, start, start + 2) if key.startswith(prefix)]
+            if len(matches) == 1:
+                return self._terms[matches[0]], PREFIX_SIMILARITY
+        return None
+
+    def lookup(self, search_term: str, match_count: int = 1):
+        """
+        Tra cứu sau khi chuẩn hóa hoa/thường, dấu và dấu câu: khớp chính xác (similarity 1.0), nếu không có thì
+        dạng biến đổi của từ hoặc tiền tố duy nhất (similarity thấp hơn, xem is_confident()).
+        Trả về dict giống retrieved_data nếu có kết quả, ngược lại trả về None.
+        """
+        term = normalize_term(search_term)
+        match = self._match(term) if term else None
+        if not match:
+            return None
+
+        hits, similarity = match
+        return {
+            table_key: [dict(row, similarity=similarity) for row in rows[:match_count]]
+            for table_key, rows in hits.items()
+        }
+
+
+def is_confident(lexical_data, min_similarity: float = INFLECTED_SIMILARITY) -> bool:
+    """Kết quả tra cứu đủ chắc chắn để bỏ qua tìm kiếm vector (khớp chính xác hoặc dạng biến đổi của từ)."""
+    return any(row.get("similarity", 0) >= min_similarity for rows in lexical_data.values() for row in rows)
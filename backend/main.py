@@ -1,29 +1,196 @@
 import os
 import google.generativeai as genai
+from google.generativeai.types import generation_types
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Request, Header
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Literal
 from fastapi.middleware.cors import CORSMiddleware
-import base64
-import re
-import wave
-import io
+import math
 import time
+import asyncio
+import json
+import secrets
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 
 # Sử dụng relative import để đảm bảo hoạt động chính xác
-from .retriever import search_context, supabase
+from .retriever import (
+    retrieve, retrieve_many, RetrievalResult, embed_query, search_many, vector_index, query_embedding_cache,
+    lexical_index, RETRIEVER_BACKEND,
+)
+from .clients import get_supabase, configure_genai, missing_settings, clients_status, close_clients
+from .answer_cache import AnswerCache
+from .cache_backend import get_cache_backend
+from .tts_cache import AudioCacheIndex, DiskAudioCache, audio_file_name, AUDIO_BUCKET
+from .tts import synthesize_wav, upload_audio, TTS_MODEL_NAME
+from .tts_jobs import TTSJobQueue
+from .fast_path import detect_language_local, match_intent_rules, is_deictic, CONFIDENCE_THRESHOLD
+from .conversation_memory import ConversationMemory
+from .static_assets import StaticAssets, StaticAssetsApp
+from .gemini_scheduler import gemini_scheduler, priority_var, Priority, GeminiOverloaded, is_rate_limited
+from .observability import (
+    get_logger, configure_logging, span, observe_stage, registry, register_cache_metrics, Counter, TraceMiddleware,
+)
 
 # --- CẤU HÌNH ---
 load_dotenv()
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
+configure_logging()
+logger = get_logger(__name__)
 
-GENERATION_MODEL = genai.GenerativeModel('gemini-2.5-flash')
-TTS_MODEL = genai.GenerativeModel('gemini-2.5-flash-preview-tts')
+configure_genai()
 
+GENERATION_MODEL_NAME = 'gemini-2.5-flash'
+GENERATION_MODEL = genai.GenerativeModel(GENERATION_MODEL_NAME)
 
-app = FastAPI()
+# Cache câu trả lời RAG cuối cùng (chính xác + ngữ nghĩa)
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+answer_cache = AnswerCache(
+    backend=get_cache_backend(),
+    ttl_seconds=float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600))),
+    max_distance=float(os.environ.get("ANSWER_CACHE_MAX_DISTANCE", "0.08")),
+)
+register_cache_metrics({"query_embedding": query_embedding_cache.stats, "answer": answer_cache.stats})
+# Token cho các endpoint quản trị (POST /cache/invalidate); không đặt thì các endpoint này bị tắt
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Task nền ghi embedding cho câu trả lời đã cache (giữ tham chiếu để task không bị thu gom giữa chừng)
+answer_cache_tasks = set()
+
+# Lịch sử hội thoại theo session (bộ nhớ trong tiến trình, có giới hạn)
+CONVERSATION_MEMORY_ENABLED = os.environ.get("CONVERSATION_MEMORY_ENABLED", "1") == "1"
+
+# Chỉ mục các file âm thanh đã có trong Storage (thay cho lệnh list() ở mỗi request);
+# tên file mới tải lên được ghi vào cache dùng chung để các worker khác thấy ngay, không chờ lần làm mới sau
+audio_index = AudioCacheIndex(get_supabase, refresh_seconds=float(os.environ.get("TTS_INDEX_REFRESH_SECONDS", "300")),
+                              shared=get_cache_backend())
+# Tầng cache WAV cục bộ (tùy chọn) để phục vụ trực tiếp khi Storage gặp sự cố
+TTS_DISK_CACHE_DIR = os.environ.get("TTS_DISK_CACHE_DIR")
+disk_audio_cache = DiskAudioCache(
+    TTS_DISK_CACHE_DIR, max_bytes=int(os.environ.get("TTS_DISK_CACHE_MAX_MB", "200")) * 1024 * 1024
+) if TTS_DISK_CACHE_DIR else None
+# Ưu tiên trả về file trên đĩa (qua /audio/...) thay vì URL của Storage
+TTS_SERVE_FROM_DISK = os.environ.get("TTS_SERVE_FROM_DISK", "0") == "1"
+# Thời gian tối đa một request /synthesize-speech được phép chờ job TTS trước khi trả về "pending"
+TTS_MAX_WAIT_SECONDS = float(os.environ.get("TTS_MAX_WAIT_SECONDS", "25"))
+
+# /answer/batch: số mục tối đa trong một request và số câu trả lời được sinh đồng thời
+BATCH_MAX_ITEMS = int(os.environ.get("ANSWER_BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("ANSWER_BATCH_CONCURRENCY", "4"))
+
+# Phục vụ giao diện ngay trên app FastAPI (thay cho run_frontend.py), ví dụ khi triển khai một server duy nhất
+SERVE_FRONTEND = os.environ.get("SERVE_FRONTEND", "0") == "1"
+FRONTEND_DIR = os.environ.get("FRONTEND_DIR", "frontend")
+
+# Chu kỳ kiểm tra dữ liệu nguồn của chỉ mục từ vựng (dựng lại trong nền khi có thay đổi);
+# mặc định 300 giây với bảng Supabase, 30 giây với file CSV
+LEXICAL_REFRESH_CHECK_SECONDS = float(os.environ.get("LEXICAL_REFRESH_SECONDS") or lexical_index.refresh_seconds)
+# Chu kỳ kiểm tra snapshot vector index (RETRIEVER_BACKEND=local): nạp lại khi manifest được ghi lại
+VECTOR_INDEX_REFRESH_SECONDS = float(os.environ.get("VECTOR_INDEX_REFRESH_SECONDS", "60"))
+# Làm nóng khi khởi động (nạp index, mở kết nối, một lệnh gọi embedding) trong nền; /readyz trả về 503 tới khi xong
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "0") == "1"
+WARMUP_QUERY = os.environ.get("WARMUP_QUERY", "hello")
+# status: "disabled" | "running" | "done"; steps: tên bước -> kết quả và thời gian
+warmup_state = {"status": "disabled", "steps": {}}
+
+
+async def refresh_audio_index_periodically():
+    """Làm mới chỉ mục cache âm thanh định kỳ trong nền."""
+    while True:
+        try:
+            await asyncio.to_thread(audio_index.refresh)
+        except Exception as e:
+            logger.warning("Không thể làm mới chỉ mục cache âm thanh: %s", e)
+        await asyncio.sleep(audio_index.refresh_seconds)
+
+
+async def refresh_lexical_index_periodically():
+    """Dựng lại chỉ mục từ vựng trong nền khi dữ liệu nguồn thay đổi, để request không phải đọc dữ liệu."""
+    while True:
+        await asyncio.sleep(LEXICAL_REFRESH_CHECK_SECONDS)
+        try:
+            await asyncio.to_thread(lexical_index.refresh_if_changed)
+        except Exception as e:
+            logger.warning("Không thể làm mới chỉ mục từ vựng: %s", e)
+
+
+async def refresh_vector_index_periodically():
+    """Nạp lại snapshot vector index trong nền khi có snapshot mới (chưa nạp được thì thử lại ở lần sau)."""
+    while True:
+        await asyncio.sleep(VECTOR_INDEX_REFRESH_SECONDS)
+        try:
+            await asyncio.to_thread(vector_index.reload_if_changed)
+        except Exception as e:
+            logger.warning("Không thể nạp vector index, dùng Supabase thay thế: %s", e)
+
+
+async def run_warmup_step(name: str, step):
+    """Chạy một bước làm nóng; lỗi chỉ được ghi lại (request vẫn có đường dự phòng), không chặn các bước khác."""
+    started = time.perf_counter()
+    try:
+        await step()
+        warmup_state["steps"][name] = {"ok": True}
+    except Exception as e:
+        logger.warning("Bước làm nóng '%s' thất bại: %s", name, e)
+        warmup_state["steps"][name] = {"ok": False, "error": str(e)}
+    warmup_state["steps"][name]["seconds"] = round(time.perf_counter() - started, 3)
+
+async def load_vector_index():
+    await asyncio.to_thread(vector_index.reload_if_changed)
+
+async def warm_retrieval():
+    # Embedding (được lưu vào cache) và một lượt tìm kiếm: mở sẵn kết nối tới Google và Supabase
+    query_embedding = await embed_query(WARMUP_QUERY)
+    await search_many([query_embedding])
+
+async def warm_up():
+    """Làm nóng tiến trình để replica mới phục vụ request đầu tiên với độ trễ như lúc đã chạy ổn định."""
+    warmup_state["status"] = "running"
+    started = time.perf_counter()
+    with span("warmup"):
+        steps = [run_warmup_step("lexical_index", lambda: asyncio.to_thread(lexical_index.refresh))]
+        if missing_settings():
+            logger.warning("Thiếu cấu hình %s, bỏ qua các bước làm nóng cần gọi mạng.", missing_settings())
+        else:
+            steps += [run_warmup_step("supabase", lambda: asyncio.to_thread(get_supabase)),
+                      run_warmup_step("retrieval", warm_retrieval)]
+        if RETRIEVER_BACKEND == "local":
+            steps.append(run_warmup_step("vector_index", load_vector_index))
+        await asyncio.gather(*steps)
+    warmup_state["status"] = "done"
+    logger.info("Đã làm nóng xong sau %.2f giây: %s", time.perf_counter() - started, warmup_state["steps"])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = None
+    if WARMUP_ON_STARTUP:
+        warmup_task = asyncio.create_task(warm_up())
+    else:
+        # Dựng chỉ mục tra cứu chính xác (và nạp vector index) ngay khi khởi động để request đầu tiên không phải chờ
+        try:
+            await asyncio.to_thread(lexical_index.refresh)
+        except Exception as e:
+            logger.warning("Không thể dựng chỉ mục từ vựng khi khởi động: %s", e)
+        if RETRIEVER_BACKEND == "local":
+            try:
+                await load_vector_index()
+            except Exception as e:
+                logger.warning("Không thể nạp vector index, dùng Supabase thay thế: %s", e)
+    index_tasks = [asyncio.create_task(refresh_audio_index_periodically()),
+                   asyncio.create_task(refresh_lexical_index_periodically())]
+    if RETRIEVER_BACKEND == "local":
+        index_tasks.append(asyncio.create_task(refresh_vector_index_periodically()))
+    yield
+    for task in index_tasks:
+        task.cancel()
+    if warmup_task is not None:
+        await cancel_pending([warmup_task])
+    await tts_jobs.stop()
+    await close_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # --- Thêm CORS Middleware ---
 app.add_middleware(
@@ -32,20 +199,118 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
+# Gán mã trace cho mỗi request và đo thời gian xử lý (đặt sau cùng để bao ngoài CORS)
+app.add_middleware(TraceMiddleware)
+
+# Kết quả của /synthesize-speech: disk_hit | storage_hit | queued | shed | error
+TTS_REQUESTS = registry.register(Counter(
+    "chatbot_tts_requests_total", "Số request /synthesize-speech theo kết quả tra cache.", ["result"]))
+
+@app.exception_handler(GeminiOverloaded)
+async def gemini_overloaded_handler(request: Request, exc: GeminiOverloaded):
+    """Hàng đợi quota Gemini đã đầy: trả 503 kèm Retry-After để client thử lại sau."""
+    logger.warning("Từ chối %s vì hết lượt gọi Gemini: %s", request.url.path, exc)
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(math.ceil(exc.retry_after))})
 
 # --- Các Model Dữ liệu ---
 class Query(BaseModel):
     text: str
+    # Mã phiên do frontend tạo; có mã phiên thì bot nhớ các lượt trước để trả lời câu hỏi nối tiếp
+    session_id: Optional[str] = Field(default=None, max_length=128)
+
+class BatchQuery(BaseModel):
+    items: List[str] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+    # "keyword": mỗi mục là một từ/thành ngữ/chủ đề ngữ pháp, bỏ qua bước phân tích bằng LLM;
+    # "query": mỗi mục là một câu hỏi tự do, được phân tích như ở /answer
+    mode: Literal["keyword", "query"] = "keyword"
+    # Ngôn ngữ trả lời ở chế độ "keyword" (chế độ "query" tự phát hiện theo từng câu hỏi)
+    language: Literal["Vietnamese", "English"] = "Vietnamese"
+    # true: trả về NDJSON, mỗi dòng là kết quả của một mục (kèm "index") ngay khi mục đó xong
+    stream: bool = False
 
 class TTSRequest(BaseModel):
     text: str
+    # Số giây chờ job TTS hoàn tất trước khi trả về "pending" (0 = trả về ngay)
+    wait: float = Field(default=0, ge=0)
+
+class QueryAnalysis(BaseModel):
+    """Kết quả phân tích câu hỏi (ý định + ngôn ngữ + từ khóa) trong một lần gọi LLM."""
+    intent: Literal["Q&A", "Conversational"]
+    language: Literal["Vietnamese", "English"]
+    # Không đặt giá trị mặc định: SDK google-generativeai từ chối schema có "default"
+    # (ValueError: Unknown field for Schema: default); câu trò chuyện dùng chuỗi rỗng
+    keyword: str
+
+@dataclass
+class AnswerPlan:
+    """Kết quả của các bước chuẩn bị: prompt cần sinh, hoặc câu trả lời lấy từ cache."""
+    source_context: str
+    prompt: Optional[str] = None
+    cached_answer: Optional[str] = None
+    cache_args: Optional[tuple] = None
+
+# Yêu cầu Gemini trả về JSON đúng schema của QueryAnalysis
+ANALYSIS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": QueryAnalysis,
+}
+
+def sdk_accepts_generation_config(config: dict) -> bool:
+    """
+    Dựng thử generation_config bằng SDK (không gọi mạng), để cấu hình bị SDK từ chối được báo ngay khi khởi động
+    thay vì mọi request âm thầm chuyển sang đường dự phòng.
+    """
+    try:
+        generation_types.to_generation_config_dict(config)
+        return True
+    except Exception as e:
+        logger.error("SDK không chấp nhận cấu hình phân tích có cấu trúc, sẽ dùng các prompt riêng lẻ: %s", e)
+        return False
+
+STRUCTURED_ANALYSIS_ENABLED = sdk_accepts_generation_config(ANALYSIS_GENERATION_CONFIG)
 
 # --- CÁC HÀM XỬ LÝ LOGIC ---
 
-def detect_language(user_query: str) -> str:
-    """Sử dụng Gemini để phát hiện ngôn ngữ của câu hỏi."""
-    print(f"--- [LOG] Bắt đầu phát hiện ngôn ngữ cho: '{user_query}' ---")
+async def generate(prompt, purpose: str, priority: Optional[Priority] = None, **kwargs):
+    """
+    Gọi GENERATION_MODEL qua bộ điều phối quota (xem backend/gemini_scheduler.py);
+    mặc định dùng lớp ưu tiên của request hiện tại (priority_var).
+    """
+    return await gemini_scheduler.run(
+        GENERATION_MODEL_NAME, priority if priority is not None else priority_var.get(),
+        lambda: GENERATION_MODEL.generate_content_async(prompt, **kwargs),
+        purpose=purpose, stream=kwargs.get("stream", False),
+    )
+
+async def gather_bounded(coroutines, limit: int):
+    """Như asyncio.gather (giữ thứ tự kết quả) nhưng chỉ chạy tối đa limit coroutine cùng lúc."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+async def cancel_pending(tasks):
+    """Hủy các task chưa hoàn thành và đợi chúng dừng hẳn."""
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def detect_language(user_query: str) -> str:
+    """Phát hiện ngôn ngữ của câu hỏi: thử bộ nhận diện cục bộ trước, chỉ gọi Gemini khi không chắc chắn."""
+    logger.debug("Bắt đầu phát hiện ngôn ngữ cho: '%s'", user_query)
+    language, confidence = detect_language_local(user_query)
+    if confidence >= CONFIDENCE_THRESHOLD:
+        logger.info("Ngôn ngữ được phát hiện cục bộ: '%s' (độ tin cậy %.2f)", language, confidence)
+        return language
+
     prompt = f"""
     Detect the language of the following text. Respond with ONLY 'Vietnamese' or 'English'. 
     If unsure, default to 'Vietnamese'.
@@ -53,24 +318,30 @@ def detect_language(user_query: str) -> str:
     Language:
     """
     try:
-        response = GENERATION_MODEL.generate_content(prompt)
+        with span("analysis.language"):
+            response = await generate(prompt, "language")
         language = response.text.strip().replace("'", "").replace('"', '')
         
         if "english" in language.lower():
-            print(f"--- [LOG] Ngôn ngữ được phát hiện: 'English' ---")
+            logger.info("Ngôn ngữ được phát hiện: 'English'")
             return "English"
         
-        print(f"--- [LOG] Ngôn ngữ được phát hiện: 'Vietnamese' ---")
+        logger.info("Ngôn ngữ được phát hiện: 'Vietnamese'")
         return "Vietnamese"
     except Exception as e:
-        print(f"--- [LỖI] Khi phát hiện ngôn ngữ: {e} ---")
+        logger.warning("Khi phát hiện ngôn ngữ: %s", e)
         return "Vietnamese"
 
-def determine_intent(user_query: str) -> str:
+async def determine_intent(user_query: str) -> str:
     """
     Sử dụng LLM để phân loại ý định của người dùng một cách đáng tin cậy.
     """
-    print(f"--- [LOG] Bắt đầu phân loại ý định cho: '{user_query}' ---")
+    logger.debug("Bắt đầu phân loại ý định cho: '%s'", user_query)
+    rule_match = match_intent_rules(user_query)
+    if rule_match:
+        logger.info("Đã xác định ý định bằng luật: '%s'", rule_match[0])
+        return rule_match[0]
+
     # Thêm các ví dụ dễ nhầm lẫn để huấn luyện AI
     prompt = f"""
     Classify the user's query into "Q&A" (asking for knowledge) or "Conversational" (small talk).
@@ -92,20 +363,32 @@ def determine_intent(user_query: str) -> str:
     Classification:
     """
     try:
-        response = GENERATION_MODEL.generate_content(prompt)
+        with span("analysis.intent"):
+            response = await generate(prompt, "intent")
         intent = response.text.strip()
-        print(f"--- [LOG] Đã xác định ý định: '{intent}' ---")
+        logger.info("Đã xác định ý định: '%s'", intent)
         return intent if intent in ["Q&A", "Conversational"] else "Q&A"
     except Exception as e:
-        print(f"--- [LỖI] Khi xác định ý định: {e} ---")
+        logger.warning("Khi xác định ý định: %s", e)
         return "Q&A"
 
-def extract_keyword(user_query: str) -> str:
+def history_block(history: str) -> str:
+    """Phần lịch sử hội thoại chèn vào prompt (rỗng nếu không có lịch sử)."""
+    if not history:
+        return ""
+    return f"""
+    Conversation so far (oldest first):
+    {history}
+    """
+
+async def extract_keyword(user_query: str, history: str = "") -> str:
     """Trích xuất từ khóa/chủ đề chính từ một câu hỏi Q&A (cả tiếng Anh và tiếng Việt)."""
-    print(f"--- [LOG] Bắt đầu trích xuất từ khóa từ: '{user_query}' ---")
+    logger.debug("Bắt đầu trích xuất từ khóa từ: '%s'", user_query)
     prompt = f"""
     Extract the main keyword or topic from the following query. Return only the keyword/topic.
     If the query is conversational, return an empty string.
+    If the query is a follow-up (e.g. "cho thêm ví dụ", "what about its synonyms?"), use the topic from the conversation so far.
+    {history_block(history)}
 
     Examples:
     - "Flagrant nghĩa là gì và cho câu ví dụ" -> Flagrant
@@ -118,197 +401,584 @@ def extract_keyword(user_query: str) -> str:
     Keyword:
     """
     try:
-        response = GENERATION_MODEL.generate_content(prompt)
+        with span("analysis.keyword"):
+            response = await generate(prompt, "keyword")
         keyword = response.text.strip().replace('"', '')
-        print(f"--- [LOG] Đã trích xuất từ khóa: '{keyword}' ---")
+        logger.info("Đã trích xuất từ khóa: '%s'", keyword)
         return keyword
     except Exception as e:
-        print(f"--- [LỖI] Khi trích xuất từ khóa: {e}")
+        logger.warning("Khi trích xuất từ khóa: %s", e)
+        return ""
+
+async def analyze_query_fallback(user_query: str, history: str = "") -> QueryAnalysis:
+    """Phương án dự phòng: gọi lại 3 prompt riêng lẻ (song song) khi phản hồi JSON không hợp lệ."""
+    intent_task = asyncio.ensure_future(determine_intent(user_query))
+    language_task = asyncio.ensure_future(detect_language(user_query))
+    keyword_task = asyncio.ensure_future(extract_keyword(user_query, history))
+    tasks = [intent_task, language_task, keyword_task]
+    try:
+        intent = await intent_task
+        if intent == "Conversational":
+            # Không cần từ khóa cho câu trò chuyện
+            await cancel_pending([keyword_task])
+            return QueryAnalysis(intent=intent, language=await language_task, keyword="")
+        return QueryAnalysis(intent=intent, language=await language_task, keyword=await keyword_task)
+    finally:
+        await cancel_pending(tasks)
+
+async def analyze_query(user_query: str, history: str = "") -> QueryAnalysis:
+    """
+    Phân tích câu hỏi trong MỘT lần gọi Gemini: ý định, ngôn ngữ và từ khóa,
+    trả về dưới dạng JSON có cấu trúc và được kiểm tra bằng pydantic.
+    history (nếu có) giúp xác định từ khóa cho các câu hỏi nối tiếp như "cho thêm ví dụ".
+    """
+    logger.debug("Bắt đầu phân tích câu hỏi: '%s'", user_query)
+    # Fast path: các trường hợp hiển nhiên ("hi", "cảm ơn", "X nghĩa là gì") không cần gọi LLM
+    rule_match = match_intent_rules(user_query)
+    if rule_match:
+        intent, keyword = rule_match
+        analysis = QueryAnalysis(intent=intent, language=await detect_language(user_query), keyword=keyword)
+        logger.info("Kết quả phân tích (fast path): %s", analysis.model_dump())
+        return analysis
+    if not STRUCTURED_ANALYSIS_ENABLED:
+        return await analyze_query_fallback(user_query, history)
+
+    prompt = f"""
+    Analyze the user's query for an English tutor chatbot and return a JSON object with:
+    - "intent": "Q&A" (asking for knowledge) or "Conversational" (small talk).
+    - "language": the language of the query, "Vietnamese" or "English". If unsure, use "Vietnamese".
+    - "keyword": the main keyword or topic of a Q&A query. Use an empty string for conversational queries.
+      If the query is a follow-up (e.g. "cho thêm ví dụ", "what about its synonyms?"), it is "Q&A"
+      and the keyword is the topic from the conversation so far.
+
+    Examples:
+    - "What does ubiquitous mean?" -> {{"intent": "Q&A", "language": "English", "keyword": "ubiquitous"}}
+    - "Flagrant nghĩa là gì và cho câu ví dụ" -> {{"intent": "Q&A", "language": "Vietnamese", "keyword": "Flagrant"}}
+    - "cho tôi ví dụ về 'a piece of cake'" -> {{"intent": "Q&A", "language": "Vietnamese", "keyword": "a piece of cake"}}
+    - "thì hiện tại đơn" -> {{"intent": "Q&A", "language": "Vietnamese", "keyword": "thì hiện tại đơn"}}
+    - "hội thoại đặt đồ ăn" -> {{"intent": "Q&A", "language": "Vietnamese", "keyword": "hội thoại đặt đồ ăn"}}
+    - "phân biệt advice và advise" -> {{"intent": "Q&A", "language": "Vietnamese", "keyword": "advice advise"}}
+    - "xin chào" -> {{"intent": "Conversational", "language": "Vietnamese", "keyword": ""}}
+    - "hello" -> {{"intent": "Conversational", "language": "English", "keyword": ""}}
+    - "cảm ơn bạn" -> {{"intent": "Conversational", "language": "Vietnamese", "keyword": ""}}
+    - "bạn là ai?" -> {{"intent": "Conversational", "language": "Vietnamese", "keyword": ""}}
+    - "tôi muốn học tiếng anh" -> {{"intent": "Conversational", "language": "Vietnamese", "keyword": ""}}
+    {history_block(history)}
+    Query: "{user_query}"
+    """
+    try:
+        with span("analysis.llm"):
+            response = await generate(prompt, "analysis", generation_config=ANALYSIS_GENERATION_CONFIG)
+        analysis = QueryAnalysis.model_validate_json(response.text)
+    except GeminiOverloaded:
+        # Hết lượt gọi: các prompt dự phòng cũng sẽ bị từ chối, trả lỗi 503 ngay
+        raise
+    except ValidationError as e:
+        logger.warning("Phản hồi phân tích không hợp lệ, chuyển sang các prompt riêng lẻ: %s", e)
+        return await analyze_query_fallback(user_query, history)
+    except Exception as e:
+        logger.warning("Phân tích có cấu trúc thất bại (%s), chuyển sang các prompt riêng lẻ: %s", type(e).__name__, e)
+        return await analyze_query_fallback(user_query, history)
+
+    analysis.keyword = analysis.keyword.strip().replace('"', '')
+    if analysis.intent == "Conversational":
+        analysis.keyword = ""
+    logger.info("Kết quả phân tích: %s", analysis.model_dump())
+    return analysis
+
+def build_sse_event(event: str, data: dict) -> str:
+    """Đóng gói một sự kiện Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def is_follow_up(user_query: str, keyword: str) -> bool:
+    """
+    Câu hỏi phụ thuộc lịch sử hội thoại: từ khóa không có trong chính câu hỏi (ví dụ "cho thêm ví dụ"),
+    hoặc chỉ là đại từ/từ chỉ định ("what does it mean").
+    """
+    if is_deictic(keyword):
+        return True
+    query = user_query.casefold()
+    return not all(word in query for word in keyword.casefold().split())
+
+async def plan_answer(user_query: str, history: str = "") -> AnswerPlan:
+    """
+    Chạy toàn bộ các bước trước khi sinh câu trả lời (phân tích, truy xuất, tra cache)
+    và trả về prompt cần gửi cho Gemini, hoặc câu trả lời đã cache.
+    Dùng chung cho /answer và /answer/stream.
+    """
+    # === Bước 1: phân tích ý định, ngôn ngữ và từ khóa trong một lần gọi ===
+    with span("analysis"):
+        analysis = await analyze_query(user_query, history)
+    return await plan_from_analysis(user_query, analysis, history)
+
+async def plan_from_analysis(user_query: str, analysis: QueryAnalysis, history: str = "",
+                             retrieval: Optional[RetrievalResult] = None) -> AnswerPlan:
+    """Các bước sau phân tích; /answer/batch truyền sẵn retrieval đã truy xuất theo lô."""
+    intent = analysis.intent
+    detected_language = analysis.language
+    
+    # === KỊCH BẢN 1: Người dùng đang trò chuyện (ƯU TIÊN HÀNG ĐẦU) ===
+    if intent == "Conversational":
+        logger.debug("Xử lý yêu cầu dạng: Conversational.")
+        prompt = f"You are a friendly English tutor chatbot named English AI Tutor. Respond conversationally to the user's message in {detected_language}. Keep it natural and brief. {history_block(history)}User message: '{user_query}'"
+        return AnswerPlan(prompt=prompt, source_context="Conversational")
+
+    # === KỊCH BẢN 2: Người dùng đang hỏi kiến thức (Q&A) ===
+    logger.debug("Xử lý yêu cầu dạng: Q&A.")
+    search_term = analysis.keyword
+    
+    if not search_term:
+        # Nếu là Q&A nhưng không có từ khóa (ví dụ: câu hỏi quá chung chung)
+        logger.info("Ý định Q&A nhưng không tìm thấy từ khóa. Chuyển sang Fallback.")
+        prompt = f"You are a friendly English tutor. The user asked: '{user_query}'. Respond helpfully in {detected_language}, guiding them to ask about a specific English word, grammar rule, or idiom. Answer in {detected_language}."
+        return AnswerPlan(prompt=prompt, source_context="Conversational Fallback")
+
+    # Nếu có từ khóa, tiến hành tìm kiếm
+    if retrieval is None:
+        logger.debug("Đang tìm kiếm ngữ cảnh cho: '%s'", search_term)
+        with span("retrieval"):
+            retrieval = await retrieve(search_term)
+    context_string = retrieval.context
+    
+    if not context_string:
+        logger.info("Không tìm thấy ngữ cảnh cho '%s'. Đang tạo phản hồi Fallback.", search_term)
+        prompt = f"You are a friendly English tutor. Inform the user you couldn't find info for '{search_term}'. Respond in {detected_language}."
+        return AnswerPlan(prompt=prompt, source_context="Fallback")
+
+    cache_args = (search_term, detected_language, context_string, retrieval.query_embedding)
+    if history and is_follow_up(user_query, search_term):
+        # Câu hỏi nối tiếp (ví dụ "cho thêm ví dụ"): câu trả lời phụ thuộc lịch sử nên không dùng cache
+        cache_args = None
+    else:
+        # Câu hỏi tự đứng được: trả lời giống như khi không có lịch sử, để dùng chung cache
+        history = ""
+    if cache_args and ANSWER_CACHE_ENABLED:
+        cached_answer = await answer_cache.aget(*cache_args)
+        if cached_answer is not None:
+            logger.info("CACHE HIT: Dùng lại câu trả lời đã cache cho '%s'.", search_term)
+            return AnswerPlan(source_context=context_string, cached_answer=cached_answer)
+
+    logger.debug("Đã tìm thấy ngữ cảnh. Đang tạo phản hồi RAG.")
+    prompt = f"""
+    You are an expert English tutor. Your task is to provide a comprehensive, bilingual answer based on the context, following a strict format.
+
+    **CRITICAL RULES:**
+    1.  Preserve HTML tags (e.g., `<span class="tts-word">...</span>`) EXACTLY as they appear in the context.
+    2.  DO NOT add new `tts-word` tags.
+    3.  Provide bilingual format (English and Vietnamese) for meanings/examples.
+    4.  Include phonetics if available.
+    5.  Start with a simple intro sentence.
+    6.  Respond in {detected_language}.
+
+    **REQUIRED RESPONSE STRUCTURE EXAMPLE:**
+    Chào bạn! Từ "Superfluous" có ý nghĩa như sau:
+
+    - **Word:** <span class="tts-word">Superfluous</span>
+    - **Phonetic:** /suːˈpɜː.flu.əs/
+    - **Meaning:** Unnecessary, especially through being more than enough. (Không cần thiết, đặc biệt là khi nó nhiều hơn mức đủ.)
+    - **Example:** The report contained superfluous information that confused readers. (Bản báo cáo chứa thông tin thừa thãi làm độc giả bối rối.)
+    ---
+    **Context:**
+    {context_string}
+    ---{history_block(history)}
+    **User's question:**
+    {user_query}
+    ---
+    **Your answer (in {detected_language}, following all rules and structure):**
+    """
+    return AnswerPlan(prompt=prompt, source_context=context_string, cache_args=cache_args)
+
+async def remember_answer(plan: AnswerPlan, answer: str):
+    """Lưu câu trả lời RAG vừa sinh vào cache (chỉ áp dụng cho câu trả lời có ngữ cảnh)."""
+    if plan.cache_args and ANSWER_CACHE_ENABLED:
+        search_term, language, context, query_embedding = plan.cache_args
+        await answer_cache.aset(search_term, language, context, answer, query_embedding)
+        if query_embedding is None:
+            # Ngữ cảnh lấy thẳng từ chỉ mục từ vựng nên chưa có embedding: tạo ở lớp nền (không làm chậm
+            # phản hồi) để câu trả lời này cũng được dùng lại ở tầng ngữ nghĩa
+            task = asyncio.create_task(remember_answer_embedding(search_term, language, context, answer))
+            answer_cache_tasks.add(task)
+            task.add_done_callback(answer_cache_tasks.discard)
+
+async def remember_answer_embedding(search_term: str, language: str, context: str, answer: str):
+    priority_var.set(Priority.BATCH)
+    try:
+        query_embedding = await embed_query(search_term)
+    except Exception as e:
+        logger.debug("Bỏ qua embedding cho câu trả lời đã cache '%s': %s", search_term, e)
+        return
+    await answer_cache.aset(search_term, language, context, answer, query_embedding)
+
+async def summarize_history(summary: str, exchanges) -> str:
+    """Gộp các lượt hội thoại cũ vào bản tóm tắt ngắn (chạy nền, không nằm trên đường trả lời)."""
+    transcript = "\n".join(exchange.render() for exchange in exchanges)
+    prompt = f"""
+    Update the running summary of a conversation between a learner and an English tutor chatbot.
+    Keep it under 80 words, in English. Keep the words, idioms and grammar topics that were discussed
+    and anything the learner said about themselves.
+
+    Current summary: "{summary}"
+    New turns:
+    {transcript}
+
+    Updated summary:
+    """
+    with span("memory.summarize"):
+        response = await generate(prompt, "summary", priority=Priority.BATCH)
+    return response.text
+
+conversation_memory = ConversationMemory(
+    summarizer=summarize_history,
+    max_sessions=int(os.environ.get("MEMORY_MAX_SESSIONS", "1000")),
+    idle_ttl=float(os.environ.get("MEMORY_IDLE_TTL", "1800")),
+    recent_exchanges=int(os.environ.get("MEMORY_RECENT_TURNS", "3")),
+    token_budget=int(os.environ.get("MEMORY_TOKEN_BUDGET", "500")),
+    max_chars=int(os.environ.get("MEMORY_MAX_CHARS", "5000000")),
+    compact_turns=int(os.environ.get("MEMORY_COMPACT_TURNS", "4")),
+)
+
+def conversation_history(session_id: Optional[str]) -> str:
+    if not CONVERSATION_MEMORY_ENABLED:
         return ""
+    return conversation_memory.render(session_id)
 
-def pcm_to_wav_bytes(pcm_data, sample_rate):
-    """Chuyển đổi dữ liệu PCM thô thành định dạng WAV trong bộ nhớ."""
-    print("--- [LOG] Đang chuyển đổi PCM sang WAV... ---")
-    wav_buffer = io.BytesIO()
-    with wave.open(wav_buffer, 'wb') as wf:
-        wf.setnchannels(1)
-        wf.setsampwidth(2)
-        wf.setframerate(sample_rate)
-        wf.writeframes(pcm_data)
-    print("--- [LOG] Đã chuyển đổi PCM sang WAV thành công. ---")
-    return wav_buffer.getvalue()
+def remember_turn(query: Query, answer: str):
+    """Ghi lượt hỏi–đáp vừa xong vào lịch sử của session (nếu có)."""
+    if CONVERSATION_MEMORY_ENABLED:
+        conversation_memory.append(query.session_id, query.text, answer)
 
 # --- API ENDPOINTS ---
 @app.post("/answer")
-def get_answer(query: Query):
-    print(f"\n--- [LOG] Nhận được yêu cầu /answer: '{query.text}' ---")
+async def get_answer(query: Query):
+    logger.info("Nhận được yêu cầu /answer: '%s'", query.text)
     try:
-        # === THAY ĐỔI LOGIC: Bước 1 là phân loại ý định ===
-        intent = determine_intent(query.text)
-        detected_language = detect_language(query.text)
-        
-        # === KỊCH BẢN 1: Người dùng đang trò chuyện (ƯU TIÊN HÀNG ĐẦU) ===
-        if intent == "Conversational":
-            print("--- [LOG] Xử lý yêu cầu dạng: Conversational. ---")
-            prompt = f"You are a friendly English tutor chatbot named English AI Tutor. Respond conversationally to the user's message in {detected_language}. Keep it natural and brief. User message: '{query.text}'"
-            response = GENERATION_MODEL.generate_content(prompt)
-            print("--- [LOG] Đã tạo phản hồi 'Conversational'. ---")
-            return {"answer": response.text, "source_context": "Conversational"}
-
-        # === KỊCH BẢN 2: Người dùng đang hỏi kiến thức (Q&A) ===
-        print("--- [LOG] Xử lý yêu cầu dạng: Q&A. ---")
-        search_term = extract_keyword(query.text)
-        
-        if not search_term:
-            # Nếu là Q&A nhưng không có từ khóa (ví dụ: câu hỏi quá chung chung)
-            print("--- [LOG] Ý định Q&A nhưng không tìm thấy từ khóa. Chuyển sang Fallback. ---")
-            prompt = f"You are a friendly English tutor. The user asked: '{query.text}'. Respond helpfully in {detected_language}, guiding them to ask about a specific English word, grammar rule, or idiom. Answer in {detected_language}."
-            response = GENERATION_MODEL.generate_content(prompt)
-            return {"answer": response.text, "source_context": "Conversational Fallback"}
-
-        # Nếu có từ khóa, tiến hành tìm kiếm
-        print(f"--- [LOG] Đang tìm kiếm ngữ cảnh cho: '{search_term}' ---")
-        context_string = search_context(search_term)
-        
-        if context_string:
-            print("--- [LOG] Đã tìm thấy ngữ cảnh. Đang tạo phản hồi RAG. ---")
-            prompt_template = f"""
-            You are an expert English tutor. Your task is to provide a comprehensive, bilingual answer based on the context, following a strict format.
-
-            **CRITICAL RULES:**
-            1.  Preserve HTML tags (e.g., `<span class="tts-word">...</span>`) EXACTLY as they appear in the context.
-            2.  DO NOT add new `tts-word` tags.
-            3.  Provide bilingual format (English and Vietnamese) for meanings/examples.
-            4.  Include phonetics if available.
-            5.  Start with a simple intro sentence.
-            6.  Respond in {detected_language}.
-
-            **REQUIRED RESPONSE STRUCTURE EXAMPLE:**
-            Chào bạn! Từ "Superfluous" có ý nghĩa như sau:
-
-            - **Word:** <span class="tts-word">Superfluous</span>
-            - **Phonetic:** /suːˈpɜː.flu.əs/
-            - **Meaning:** Unnecessary, especially through being more than enough. (Không cần thiết, đặc biệt là khi nó nhiều hơn mức đủ.)
-            - **Example:** The report contained superfluous information that confused readers. (Bản báo cáo chứa thông tin thừa thãi làm độc giả bối rối.)
-            ---
-            **Context:**
-            {context_string}
-            ---
-            **User's question:**
-            {query.text}
-            ---
-            **Your answer (in {detected_language}, following all rules and structure):**
-            """
-        else:
-            print(f"--- [LOG] Không tìm thấy ngữ cảnh cho '{search_term}'. Đang tạo phản hồi Fallback. ---")
-            prompt_template = f"You are a friendly English tutor. Inform the user you couldn't find info for '{search_term}'. Respond in {detected_language}."
-        
-        response = GENERATION_MODEL.generate_content(prompt_template)
-        print("--- [LOG] Đã tạo phản hồi từ AI. ---")
-        return {"answer": response.text, "source_context": context_string if context_string else "Fallback"}
+        plan = await plan_answer(query.text, conversation_history(query.session_id))
+        if plan.cached_answer is not None:
+            remember_turn(query, plan.cached_answer)
+            return {"answer": plan.cached_answer, "source_context": plan.source_context}
+
+        with span("generation"):
+            response = await generate(plan.prompt, "answer")
+        logger.info("Đã tạo phản hồi từ AI.")
+        await remember_answer(plan, response.text)
+        remember_turn(query, response.text)
+        return {"answer": response.text, "source_context": plan.source_context}
+    except GeminiOverloaded:
+        raise
     except Exception as e:
-        print(f"---!!! [LỖI] Lỗi máy chủ nội bộ trong /answer: {e} !!!---")
+        logger.exception("Lỗi máy chủ nội bộ trong /answer: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/synthesize-speech")
-def synthesize_speech(request: TTSRequest):
+@app.post("/answer/stream")
+async def stream_answer(query: Query):
     """
-    Kiểm tra cache, tạo file nghe nếu cần, lưu vào Storage và trả về URL.
+    Phiên bản streaming của /answer (Server-Sent Events): gửi từng phần câu trả lời ngay khi Gemini sinh ra.
+    Các sự kiện: "meta" (source_context), "delta" (đoạn văn bản mới), "done" (toàn bộ câu trả lời), "error".
     """
-    AUDIO_BUCKET = 'audio_cache'
-    print(f"\n--- [LOG] Nhận được yêu cầu /synthesize-speech cho: '{request.text}' ---")
+    logger.info("Nhận được yêu cầu /answer/stream: '%s'", query.text)
+
+    async def event_stream():
+        try:
+            plan = await plan_answer(query.text, conversation_history(query.session_id))
+            yield build_sse_event("meta", {"source_context": plan.source_context})
+            if plan.cached_answer is not None:
+                remember_turn(query, plan.cached_answer)
+                yield build_sse_event("delta", {"text": plan.cached_answer})
+                yield build_sse_event("done", {"answer": plan.cached_answer})
+                return
+
+            parts = []
+            started = time.perf_counter()
+            with span("generation.stream"):
+                response = await generate(plan.prompt, "answer_stream", stream=True)
+                async for chunk in response:
+                    text = chunk.text
+                    if text:
+                        if not parts:
+                            observe_stage("generation.first_token", time.perf_counter() - started)
+                        parts.append(text)
+                        yield build_sse_event("delta", {"text": text})
+            answer = "".join(parts)
+            logger.info("Đã stream xong phản hồi từ AI.")
+            await remember_answer(plan, answer)
+            remember_turn(query, answer)
+            yield build_sse_event("done", {"answer": answer})
+        except GeminiOverloaded as e:
+            logger.warning("Từ chối /answer/stream vì hết lượt gọi Gemini: %s", e)
+            yield build_sse_event("error", {"detail": str(e), "retry_after": math.ceil(e.retry_after)})
+        except Exception as e:
+            logger.exception("Lỗi máy chủ nội bộ trong /answer/stream: %s", e)
+            yield build_sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def plan_batch(batch: BatchQuery) -> List[AnswerPlan]:
+    """Phân tích (nếu cần) và truy xuất theo lô cho mọi mục của /answer/batch, giữ nguyên thứ tự."""
+    with span("analysis"):
+        if batch.mode == "keyword":
+            analyses = [QueryAnalysis(intent="Q&A", language=batch.language, keyword=item.strip().replace('"', ''))
+                        for item in batch.items]
+        else:
+            analyses = await gather_bounded([analyze_query(item) for item in batch.items], BATCH_CONCURRENCY)
+    keywords = [analysis.keyword if analysis.intent == "Q&A" else "" for analysis in analyses]
+    with span("retrieval"):
+        retrievals = await retrieve_many(keywords)
+    return [
+        await plan_from_analysis(item, analysis, retrieval=retrieval)
+        for item, analysis, retrieval in zip(batch.items, analyses, retrievals)
+    ]
+
+async def generate_batch_answer(plan: AnswerPlan, semaphore: asyncio.Semaphore) -> str:
+    async with semaphore:
+        with span("generation"):
+            response = await generate(plan.prompt, "answer_batch")
+    await remember_answer(plan, response.text)
+    return response.text
+
+async def answer_batch_item(index: int, item: str, plan: AnswerPlan, generation: Optional[asyncio.Task]) -> dict:
+    """Kết quả của một mục trong /answer/batch; lỗi chỉ ảnh hưởng tới mục đó."""
+    result = {"index": index, "query": item, "source_context": plan.source_context}
+    if plan.cached_answer is not None:
+        return {**result, "answer": plan.cached_answer}
     try:
-        sanitized_text = re.sub(r'[^a-z0-9]', '_', request.text.lower())
-        file_path = f"{sanitized_text}.wav"
+        return {**result, "answer": await generation}
+    except GeminiOverloaded as e:
+        return {**result, "error": str(e), "retry_after": math.ceil(e.retry_after)}
+    except Exception as e:
+        logger.exception("Lỗi khi sinh câu trả lời cho mục %s của /answer/batch: %s", index, e)
+        return {**result, "error": str(e)}
+
+@app.post("/answer/batch")
+async def answer_batch(batch: BatchQuery):
+    """
+    Trả lời nhiều từ khóa/câu hỏi trong một request (ví dụ danh sách từ vựng của tuần cho quiz/flashcard).
+    Embedding và truy xuất được làm theo lô, câu trả lời được sinh với tối đa ANSWER_BATCH_CONCURRENCY lệnh gọi
+    đồng thời ở lớp ưu tiên batch (không chiếm quota của người dùng đang chat).
+    Trả về {"results": [...]} theo đúng thứ tự, hoặc NDJSON theo thứ tự hoàn thành nếu stream=true.
+    Mỗi kết quả có "index", "query", "source_context" và "answer" hoặc "error".
+    """
+    logger.info("Nhận được yêu cầu /answer/batch: %s mục (%s).", len(batch.items), batch.mode)
+    priority_token = priority_var.set(Priority.BATCH)
+    try:
+        plans = await plan_batch(batch)
+        # Các task sao chép ngữ cảnh lúc được tạo, nên cũng chạy ở lớp ưu tiên batch.
+        # Các mục có cùng prompt (ví dụ từ bị lặp lại trong danh sách) dùng chung một lệnh gọi
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        generations = {}
+        for plan in plans:
+            if plan.cached_answer is None and plan.prompt not in generations:
+                generations[plan.prompt] = asyncio.create_task(generate_batch_answer(plan, semaphore))
+        tasks = [asyncio.create_task(answer_batch_item(index, item, plan, generations.get(plan.prompt)))
+                 for index, (item, plan) in enumerate(zip(batch.items, plans))]
+    finally:
+        priority_var.reset(priority_token)
+    if not batch.stream:
+        return {"results": await asyncio.gather(*tasks)}
+
+    async def result_lines():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+        finally:
+            # Client ngắt kết nối giữa chừng: không sinh tiếp các câu trả lời không ai nhận
+            await cancel_pending(tasks + list(generations.values()))
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: tiến trình còn chạy và phản hồi được (không kiểm tra Supabase/Gemini)."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """
+    Readiness: đủ cấu hình và đã làm nóng xong (nếu bật WARMUP_ON_STARTUP); chưa sẵn sàng thì trả về 503
+    để load balancer chưa chuyển request tới. Không gọi mạng nên có thể probe thường xuyên.
+    """
+    missing = missing_settings()
+    ready = not missing and warmup_state["status"] != "running"
+    return JSONResponse(status_code=200 if ready else 503, content={
+        "status": "ready" if ready else "not_ready",
+        "missing_settings": missing,
+        "warmup": warmup_state,
+        "clients": clients_status(),
+        "indexes": {"lexical": lexical_index.loaded, "audio": audio_index.loaded},
+    })
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """Trả về các bộ đếm hit/miss của các cache trong tiến trình."""
+    return {
+        "query_embedding": query_embedding_cache.stats(),
+        "answer": answer_cache.stats(),
+        "tts_index": {"entries": len(audio_index), "loaded": audio_index.loaded},
+        "tts_jobs": tts_jobs.stats(),
+        "conversation_memory": conversation_memory.stats(),
+        "backend": get_cache_backend().stats(),
+        "gemini_scheduler": gemini_scheduler.stats(),
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Số liệu theo định dạng văn bản của Prometheus (thời gian từng giai đoạn, lệnh gọi Gemini, cache hit)."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.post("/cache/invalidate")
+def invalidate_answer_cache(x_admin_token: str = Header(default="")):
+    """
+    Xóa cache câu trả lời, ví dụ sau khi cập nhật dữ liệu kiến thức trong Supabase.
+    Cần header X-Admin-Token khớp với ADMIN_TOKEN; không đặt ADMIN_TOKEN thì endpoint bị tắt.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set).")
+    if not secrets.compare_digest(x_admin_token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+    answer_cache.invalidate()
+    return {"status": "ok"}
 
-        print(f"--- [LOG] Đang kiểm tra cache cho file: '{file_path}' ... ---")
-        file_list = supabase.storage.from_(AUDIO_BUCKET).list(path="", options={"search": file_path})
 
-        if file_list:
-            print(f"--- [LOG] CACHE HIT: Tìm thấy file '{file_path}'. Trả về URL. ---")
-            return {"audioUrl": supabase.storage.from_(AUDIO_BUCKET).get_public_url(file_path)}
+def local_audio_url(http_request: Request, file_name: str) -> str:
+    return str(http_request.url_for("get_cached_audio", file_name=file_name))
 
-        print(f"--- [LOG] CACHE MISS: Không tìm thấy file. Đang tạo mới... ---")
-        
-        max_retries = 2
-        retry_delay = 40
 
-        for attempt in range(max_retries):
-            try:
-                tts_prompt = f"Speak this word clearly and naturally, not too slow, at normal speaking speed: {request.text}"
-                tts_config = {
-                    "response_modalities": ["AUDIO"],
-                    "speech_config": {
-                        "voice_config": {"prebuilt_voice_config": {"voice_name": "Aoede"}},
-                    }
-                }
-                
-                print(f"--- [LOG] Đang gọi API TTS của Google (Lần {attempt + 1})... ---")
-                response = TTS_MODEL.generate_content(tts_prompt, generation_config=tts_config)
-
-                if response.candidates and response.candidates[0].content.parts:
-                    print("--- [LOG] Đã nhận được dữ liệu âm thanh từ API. ---")
-                    audio_part = response.candidates[0].content.parts[0]
-
-                    mime_type = getattr(audio_part.inline_data, "mime_type", "audio/L16;codec=pcm;rate=24000")
-                    audio_raw = getattr(audio_part.inline_data, "data", None)
-                    print(f"--- [DEBUG] MIME Type: {mime_type} ---")
-
-                    if audio_raw is None:
-                        raise ValueError("Không có dữ liệu âm thanh trong phản hồi TTS.")
-
-                    # Xử lý dữ liệu có thể là base64 hoặc bytes
-                    if isinstance(audio_raw, str):
-                        try:
-                            pcm_data = base64.b64decode(audio_raw)
-                        except Exception:
-                            print("--- [WARN] Inline data không phải base64, chuyển sang bytes thô. ---")
-                            pcm_data = audio_raw.encode("latin1")
-                    else:
-                        pcm_data = audio_raw
-
-                    # Kiểm tra độ dài để tránh file “câm”
-                    if len(pcm_data) < 2000:
-                        raise ValueError(f"Dữ liệu âm thanh quá ngắn ({len(pcm_data)} bytes).")
-
-                    # Lấy sample rate từ MIME
-                    sample_rate_match = re.search(r"rate=(\d+)", mime_type)
-                    sample_rate = int(sample_rate_match.group(1)) if sample_rate_match else 24000
-
-                    # Chuyển PCM sang WAV
-                    wav_data = pcm_to_wav_bytes(pcm_data, sample_rate)
-
-                    print(f"--- [LOG] Đang tải file '{file_path}' lên Supabase Storage... ---")
-                    supabase.storage.from_(AUDIO_BUCKET).upload(
-                        file=wav_data,
-                        path=file_path,
-                        file_options={"content-type": "audio/wav", "x-upsert": "true"},
-                    )
-                    print(f"--- [LOG] Đã tải lên file thành công. ---")
-
-                    return {"audioUrl": supabase.storage.from_(AUDIO_BUCKET).get_public_url(file_path)}
-
-                else:
-                    print("--- [LỖI] API TTS không trả về candidate hợp lệ. ---")
-                    if response.prompt_feedback:
-                        print(f"Lý do: {response.prompt_feedback}")
-                    if attempt == max_retries - 1:
-                        raise HTTPException(status_code=500, detail="TTS generation failed.")
-                    print(f"--- [LOG] Đang đợi {retry_delay} giây để thử lại... ---")
-                    time.sleep(retry_delay)
+def is_audio_cached(file_path: str) -> bool:
+    """Kiểm tra file đã có trong Storage: dùng chỉ mục trong bộ nhớ, chỉ gọi list() khi chỉ mục chưa nạp được."""
+    if audio_index.loaded:
+        return audio_index.contains(file_path)
+    logger.info("Chỉ mục cache âm thanh chưa sẵn sàng, kiểm tra trực tiếp trên Storage...")
+    file_list = get_supabase().storage.from_(AUDIO_BUCKET).list(path="", options={"search": file_path})
+    return any(item.get("name") == file_path for item in file_list)
 
-            except Exception as e:
-                is_quota_error = "429" in str(e) or "quota" in str(e).lower()
-                if is_quota_error and attempt < max_retries - 1:
-                    print(f"--- [LỖI] Lỗi Quota 429. Đang đợi {retry_delay} giây để thử lại... ---")
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    raise e
 
-        raise HTTPException(status_code=429, detail="API quota exceeded.")
+@app.get("/audio/{file_name}")
+def get_cached_audio(file_name: str):
+    """Phục vụ file WAV từ cache cục bộ trên đĩa."""
+    local_path = disk_audio_cache.get(file_name) if disk_audio_cache else None
+    if not local_path:
+        raise HTTPException(status_code=404, detail="Audio not found in local cache.")
+    return FileResponse(local_path, media_type="audio/wav")
 
+
+async def generate_audio(file_path: str, text: str) -> str:
+    """
+    Handler của job TTS: tạo file WAV, lưu vào cache đĩa, tải lên Storage và trả về URL.
+    URL dạng đường dẫn tương đối ('/audio/...') nghĩa là file chỉ có trên đĩa.
+    """
+    wav_data = await synthesize_wav(text)
+    if disk_audio_cache:
+        await asyncio.to_thread(disk_audio_cache.put, file_path, wav_data)
+
+    try:
+        await asyncio.to_thread(upload_audio, get_supabase(), file_path, wav_data)
+    except Exception as upload_error:
+        if not disk_audio_cache:
+            raise
+        logger.warning("Không tải lên được Storage (%s), phục vụ file từ đĩa.", upload_error)
+        return app.url_path_for("get_cached_audio", file_name=file_path)
+    await asyncio.to_thread(audio_index.add, file_path)
+    return audio_index.public_url(file_path)
+
+
+tts_jobs = TTSJobQueue(
+    generate_audio,
+    workers=int(os.environ.get("TTS_WORKERS", "2")),
+    max_attempts=int(os.environ.get("TTS_MAX_ATTEMPTS", "4")),
+    retry_base_delay=float(os.environ.get("TTS_RETRY_BASE_DELAY", "10")),
+    retry_max_delay=float(os.environ.get("TTS_RETRY_MAX_DELAY", "120")),
+)
+
+
+def job_response(http_request: Request, job):
+    """Kết quả trả về cho client; đổi URL tương đối của file trên đĩa thành URL đầy đủ."""
+    result = job.to_dict()
+    if job.audio_url and job.audio_url.startswith("/"):
+        result["audioUrl"] = str(http_request.base_url).rstrip("/") + job.audio_url
+    return result
+
+
+def tts_job_result(http_request: Request, job):
+    if job.status == "failed":
+        status_code = 429 if is_rate_limited(job.error) else 500
+        raise HTTPException(status_code=status_code, detail=job.error)
+    if job.status == "pending":
+        return JSONResponse(status_code=202, content=job_response(http_request, job))
+    return job_response(http_request, job)
+
+
+@app.post("/synthesize-speech")
+async def synthesize_speech(request: TTSRequest, http_request: Request):
+    """
+    Trả về URL âm thanh nếu đã có trong cache; nếu chưa, tạo (hoặc gộp vào) một job TTS chạy nền.
+    Job xong trong thời gian chờ thì trả về URL, ngược lại trả về 202 kèm jobId để client hỏi lại.
+    """
+    logger.info("Nhận được yêu cầu /synthesize-speech cho: '%s'", request.text)
+    file_path = audio_file_name(request.text)
+    local_path = disk_audio_cache.get(file_path) if disk_audio_cache else None
+    if local_path and TTS_SERVE_FROM_DISK:
+        logger.info("CACHE HIT (đĩa): Tìm thấy file '%s'.", file_path)
+        TTS_REQUESTS.inc("disk_hit")
+        return {"status": "done", "audioUrl": local_audio_url(http_request, file_path)}
+
+    logger.debug("Đang kiểm tra cache cho file: '%s' ...", file_path)
+    try:
+        with span("tts.storage_check"):
+            cached = await asyncio.to_thread(is_audio_cached, file_path)
     except Exception as e:
-        print(f"---!!! [LỖI] Lỗi khi tạo hoặc lấy âm thanh: {e} !!!---")
+        # Storage gặp sự cố: vẫn phục vụ được nếu file có trên đĩa
+        if local_path:
+            logger.warning("Không kiểm tra được Storage (%s), phục vụ file từ đĩa.", e)
+            TTS_REQUESTS.inc("disk_hit")
+            return {"status": "done", "audioUrl": local_audio_url(http_request, file_path)}
+        logger.error("Lỗi khi kiểm tra cache âm thanh: %s", e)
+        TTS_REQUESTS.inc("error")
         raise HTTPException(status_code=500, detail=str(e))
+
+    if cached:
+        logger.info("CACHE HIT: Tìm thấy file '%s'. Trả về URL.", file_path)
+        TTS_REQUESTS.inc("storage_hit")
+        return {"status": "done", "audioUrl": audio_index.public_url(file_path)}
+
+    if local_path:
+        logger.info("CACHE HIT (đĩa): File '%s' chưa có trên Storage, phục vụ từ đĩa.", file_path)
+        TTS_REQUESTS.inc("disk_hit")
+        return {"status": "done", "audioUrl": local_audio_url(http_request, file_path)}
+
+    if not tts_jobs.has_job(file_path):
+        # Không nhận thêm job khi các job đang chờ đã đủ dùng hết quota TTS trong thời gian chờ cho phép
+        try:
+            gemini_scheduler.limiter(TTS_MODEL_NAME).admit(Priority.TTS, pending=tts_jobs.stats()["queued"])
+        except GeminiOverloaded:
+            TTS_REQUESTS.inc("shed")
+            raise
+    logger.info("CACHE MISS: Không tìm thấy file. Đưa vào hàng đợi tạo âm thanh...")
+    TTS_REQUESTS.inc("queued")
+    job = tts_jobs.submit(file_path, request.text)
+    await tts_jobs.wait(job, min(request.wait, TTS_MAX_WAIT_SECONDS))
+    return tts_job_result(http_request, job)
+
+
+@app.get("/synthesize-speech/jobs/{job_id}")
+async def get_tts_job(job_id: str, http_request: Request, wait: float = 0):
+    """Trạng thái của một job TTS; wait > 0 cho phép chờ (long-poll) đến khi job xong."""
+    job = tts_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="TTS job not found.")
+    await tts_jobs.wait(job, min(max(wait, 0), TTS_MAX_WAIT_SECONDS))
+    return tts_job_result(http_request, job)
+
+
+if SERVE_FRONTEND:
+    # Mount sau cùng để các endpoint API ở trên được khớp trước
+    app.mount("/", StaticAssetsApp(StaticAssets(FRONTEND_DIR)), name="frontend")
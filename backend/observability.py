@@ -0,0 +1,281 @@
+import os
+import re
+import json
+import time
+import uuid
+import bisect
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# --- CẤU HÌNH ---
+load_dotenv()
+# Tỉ lệ request được ghi log mức INFO/DEBUG (lấy mẫu theo trace); WARNING trở lên luôn được ghi
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+# Trả về mã trace của mỗi request trong header X-Trace-Id
+TRACE_HEADER_ENABLED = os.environ.get("TRACE_HEADER_ENABLED", "1") == "1"
+TRACE_HEADER = "x-trace-id"
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# Ngưỡng (giây) của các histogram thời gian
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+trace_sampled_var = contextvars.ContextVar("trace_sampled", default=True)
+
+
+# --- LOGGING ---
+
+class TraceSamplingFilter(logging.Filter):
+    """Gắn trace_id vào mỗi bản ghi và bỏ log mức thấp của các request không được lấy mẫu."""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get() or "-"
+        return record.levelno >= logging.WARNING or trace_sampled_var.get()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key in ("stage", "duration_ms"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_logging_configured = False
+
+def configure_logging():
+    """
+    Cấu hình logger gốc của ứng dụng một lần (gọi khi khởi động server hoặc CLI).
+    LOG_LEVEL (mặc định INFO) và LOG_FORMAT ("text": một dòng dễ đọc; "json": mỗi dòng một object JSON
+    để đưa vào hệ thống thu thập log) được đọc lúc gọi hàm.
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceSamplingFilter())
+    if os.environ.get("LOG_FORMAT", "text") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(trace_id)s] %(name)s: %(message)s"))
+    root = logging.getLogger("backend")
+    root.addHandler(handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+    _logging_configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger của một module backend, ví dụ get_logger(__name__) -> 'backend.retriever'."""
+    return logging.getLogger(name if name.startswith("backend") else f"backend.{name}")
+
+
+logger = get_logger(__name__)
+
+
+# --- METRICS (định dạng văn bản của Prometheus) ---
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [số đếm theo bucket, tổng, số lần]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class GaugeCallback:
+    """Gauge được tính lúc /metrics được gọi, từ hàm callback trả về {labels (tuple): value}."""
+
+    def __init__(self, name, documentation, labelnames, callback):
+        self.name, self.documentation, self.labelnames, self.callback = name, documentation, tuple(labelnames), callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("Không thể tính gauge %s: %s", self.name, e)
+            values = {}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "chatbot_stage_duration_seconds", "Thời gian của từng giai đoạn xử lý.", ["stage"]))
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    "chatbot_http_request_duration_seconds", "Thời gian xử lý request HTTP.", ["method", "route", "status"]))
+LLM_CALLS = registry.register(Counter(
+    "chatbot_llm_calls_total", "Số lệnh gọi Gemini (sinh văn bản, TTS, embedding).", ["model", "purpose", "outcome"]))
+LLM_RATE_LIMITED = registry.register(Counter(
+    "chatbot_llm_rate_limited_total", "Số lệnh gọi Gemini bị từ chối vì quota (429).", ["model", "purpose"]))
+LLM_CALL_SECONDS = registry.register(Histogram(
+    "chatbot_llm_call_duration_seconds", "Thời gian của mỗi lệnh gọi Gemini.", ["model", "purpose"]))
+
+
+def register_cache_metrics(caches: dict):
+    """
+    Xuất số hit/miss và tỉ lệ hit của các cache. caches: tên cache -> hàm trả về dict có 'hits' và 'misses'
+    (ví dụ EmbeddingCache.stats, AnswerCache.stats).
+    """
+    def collect(field):
+        def callback():
+            values = {}
+            for name, stats_fn in caches.items():
+                stats = stats_fn()
+                hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+                if field == "ratio":
+                    values[(name,)] = round(hits / (hits + misses), 4) if hits + misses else 0.0
+                else:
+                    values[(name,)] = stats.get(field, 0)
+            return values
+        return callback
+
+    registry.register(GaugeCallback("chatbot_cache_hits", "Số lần cache hit.", ["cache"], collect("hits")))
+    registry.register(GaugeCallback("chatbot_cache_misses", "Số lần cache miss.", ["cache"], collect("misses")))
+    registry.register(GaugeCallback("chatbot_cache_hit_ratio", "Tỉ lệ cache hit.", ["cache"], collect("ratio")))
+
+
+# --- SPANS ---
+
+def observe_stage(stage: str, duration: float):
+    """Ghi thời gian (giây) của một giai đoạn vào histogram và log ở mức DEBUG."""
+    STAGE_SECONDS.observe(duration, stage)
+    logger.debug("Giai đoạn '%s' mất %.1f ms", stage, duration * 1000,
+                 extra={"stage": stage, "duration_ms": round(duration * 1000, 2)})
+
+
+@contextmanager
+def span(stage: str):
+    """Đo thời gian của khối lệnh bên trong như một giai đoạn (kể cả khi có lỗi)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+# --- TRACE ---
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class TraceMiddleware:
+    """
+    Middleware ASGI: gán mã trace cho mỗi request (dùng lại X-Trace-Id của client nếu hợp lệ), quyết định
+    có lấy mẫu log hay không, đo thời gian tới khi gửi xong body (kể cả response dạng stream)
+    và trả mã trace trong header X-Trace-Id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope.get("headers") or []).get(TRACE_HEADER.encode(), b"").decode("latin-1")
+        trace_id = incoming if TRACE_ID_PATTERN.match(incoming) else new_trace_id()
+        trace_token = trace_id_var.set(trace_id)
+        sampled_token = trace_sampled_var.set(random.random() < LOG_SAMPLE_RATE)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if TRACE_HEADER_ENABLED:
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [(TRACE_HEADER.encode(), trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope.get("method", ""), route_path,
+                                         str(status["code"]))
+            trace_id_var.reset(trace_token)
+            trace_sampled_var.reset(sampled_token)
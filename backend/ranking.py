@@ -0,0 +1,45 @@
+from .lexical_index import LEXICAL_SOURCES, normalize_term
+
+# Trọng số của điểm khớp từ khóa khi cộng vào độ tương đồng cosine
+RERANK_WEIGHT = 0.3
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (~4 ký tự một token với văn bản tiếng Anh), đủ chính xác để chia ngân sách ngữ cảnh."""
+    return max(1, len(text) // 4)
+
+
+def keyword_score(search_term: str, table_key: str, item: dict) -> float:
+    """
+    Điểm khớp rẻ giữa từ khóa và cột khóa của hàng (word/rule/phrase/mistake/situation):
+    1.0 nếu trùng khớp sau chuẩn hóa, 0.5 nếu một bên chứa trọn bên kia, ngược lại là độ trùng Jaccard theo từ.
+    """
+    key_column = LEXICAL_SOURCES[table_key][1]
+    query = normalize_term(search_term)
+    key = normalize_term(item.get(key_column))
+    if not query or not key:
+        return 0.0
+    if query == key:
+        return 1.0
+    query_tokens, key_tokens = set(query.split()), set(key.split())
+    jaccard = len(query_tokens & key_tokens) / len(query_tokens | key_tokens)
+    if f" {query} " in f" {key} " or f" {key} " in f" {query} ":
+        return max(0.5, jaccard)
+    return jaccard
+
+
+def rank_candidates(retrieved_data: dict, search_term: str, rerank: bool = True, weight: float = RERANK_WEIGHT):
+    """
+    Gộp kết quả của mọi bảng thành một danh sách (score, table_key, item) sắp xếp giảm dần.
+    score là độ tương đồng cosine (cùng thang cho mọi bảng vì dùng chung mô hình embedding),
+    cộng thêm weight * keyword_score nếu bật re-rank.
+    """
+    candidates = []
+    for table_key, items in retrieved_data.items():
+        for item in items or []:
+            score = float(item.get("similarity") or 0.0)
+            if rerank:
+                score += weight * keyword_score(search_term, table_key, item)
+            candidates.append((score, table_key, item))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return candidates
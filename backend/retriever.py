@@ -1,114 +1,361 @@
 import os
+import asyncio
 import google.generativeai as genai
-from supabase import create_client, Client
+from supabase import AsyncClient
 from dotenv import load_dotenv
 import re
 import wave
 import io
+from dataclasses import dataclass
+from typing import List, Optional
+from .embedding_cache import EmbeddingCache
+from .cache_backend import get_cache_backend
+from .vector_index import VectorIndex, DEFAULT_INDEX_DIR
+from .lexical_index import LexicalIndex, DEFAULT_DATA_DIR, is_confident
+from .ranking import rank_candidates, estimate_tokens
+from .observability import get_logger, span
+from .gemini_scheduler import gemini_scheduler, priority_var, GeminiOverloaded
+from .clients import get_supabase, get_async_supabase
+
+logger = get_logger(__name__)
 
 # --- CẤU HÌNH ---
 load_dotenv()
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-
-try:
-    # Khởi tạo client để có thể import từ main.py
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    genai.configure(api_key=GOOGLE_API_KEY)
-    EMBEDDING_MODEL = "models/text-embedding-004"
-except Exception as e:
-    print(f"---!!! [LỖI] Không thể khởi tạo client trong retriever.py: {e} !!!---")
-    raise e
+# Client Supabase được tạo khi cần (backend/clients.py), nên import module này không gọi mạng
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+MATCH_THRESHOLD = 0.65
+# Số ứng viên lấy từ mỗi bảng trước khi xếp hạng chung
+TOP_K_PER_TABLE = int(os.environ.get("RETRIEVER_TOP_K", "5"))
+# Ngân sách token tối đa cho phần ngữ cảnh đưa vào prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RETRIEVER_TOKEN_BUDGET", "800"))
+# Chỉ giữ các ứng viên có điểm không thấp hơn điểm cao nhất quá khoảng này (loại hàng xóm yếu từ bảng không liên quan)
+SCORE_MARGIN = float(os.environ.get("RETRIEVER_SCORE_MARGIN", "0.12"))
+# Cộng điểm khớp từ khóa (rẻ, chạy cục bộ) vào độ tương đồng cosine trước khi xếp hạng
+RERANK_ENABLED = os.environ.get("RETRIEVER_RERANK", "1") == "1"
+# Thời gian chờ tối đa cho mỗi bảng, để một bảng chậm không làm treo cả câu trả lời
+RPC_TIMEOUT_SECONDS = float(os.environ.get("RETRIEVER_RPC_TIMEOUT", "2.0"))
+# Số từ khóa tối đa trong một lệnh gọi embedding nhiều nội dung (giới hạn của API batch embedding)
+EMBED_BATCH_SIZE = 100
+# Số từ khóa được truy vấn Supabase đồng thời khi truy xuất hàng loạt (retrieve_many)
+BATCH_SEARCH_CONCURRENCY = int(os.environ.get("RETRIEVER_BATCH_CONCURRENCY", "8"))
+# Dùng hàm match_all (Supabase/match_all.sql) để tìm trên cả 5 bảng trong một round trip
+USE_MATCH_ALL = os.environ.get("RETRIEVER_USE_MATCH_ALL", "0") == "1"
+
+# Cache embedding của từ khóa truy vấn; CACHE_BACKEND=sqlite giúp cache dùng chung giữa các worker
+# và tồn tại sau khi khởi động lại
+query_embedding_cache = EmbeddingCache(
+    backend=get_cache_backend(),
+    ttl_seconds=float(os.environ.get("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600))),
+)
+
+# "supabase": tìm bằng pgvector qua RPC; "local": tìm trên vector index trong tiến trình (backend/vector_index.py)
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "supabase")
+vector_index = VectorIndex(os.environ.get("VECTOR_INDEX_DIR", DEFAULT_INDEX_DIR))
+
+# Tra cứu chính xác theo word/phrase/rule/...: "first" = dùng kết quả chính xác (hoặc dạng biến đổi của từ)
+# nếu có và bỏ qua embedding, "hybrid" = gộp kết quả tra cứu với kết quả tìm kiếm vector, "off" = tắt.
+# Khớp theo tiền tố luôn được gộp với kết quả tìm kiếm vector
+LEXICAL_MODE = os.environ.get("LEXICAL_MODE", "first")
+# Nguồn của chỉ mục: "supabase" = các bảng mà tìm kiếm vector truy vấn (file CSV chỉ là dự phòng),
+# "csv" = các file CSV trong LEXICAL_DATA_DIR
+LEXICAL_SOURCE = os.environ.get("LEXICAL_SOURCE", "supabase")
+lexical_index = LexicalIndex(os.environ.get("LEXICAL_DATA_DIR", DEFAULT_DATA_DIR),
+                             client_factory=get_supabase if LEXICAL_SOURCE == "supabase" else None)
+
+# Khóa trong retrieved_data -> hàm RPC tương ứng trong Supabase
+MATCH_FUNCTIONS = {
+    "vocabulary": "match_vocabulary",
+    "grammar": "match_grammar_rules",
+    "idioms": "match_idioms",
+    "common_mistakes": "match_common_mistakes",
+    "conversations": "match_conversations",
+}
+
+# Khóa trong retrieved_data -> tiêu đề của mục tương ứng trong ngữ cảnh (giữ thứ tự các mục)
+CONTEXT_SECTIONS = {
+    "vocabulary": "Vocabulary Information:",
+    "grammar": "Grammar Information:",
+    "idioms": "Idiom Information:",
+    "common_mistakes": "Common Mistake Information:",
+    "conversations": "Conversation Example:",
+}
+
+def format_item(table_key: str, item: dict) -> str:
+    """Định dạng một hàng dữ liệu; từ vựng được bọc trong thẻ span để frontend thêm nút phát âm."""
+    if table_key == "vocabulary":
+        text = f"- Word: <span class=\"tts-word\">{item.get('word')}</span>\n"
+        if item.get('phonetic'):
+            text += f"  Phonetic: {item.get('phonetic')}\n"
+        text += f"  Meaning: {item.get('meaning')}\n"
+        if item.get('example'):
+            text += f"  Example: {item.get('example')}\n"
+        return text
+    if table_key == "grammar":
+        return f"- Rule: {item.get('rule')}\n  Explanation: {item.get('explanation')}\n  Example: {item.get('example')}\n"
+    if table_key == "idioms":
+        return f"- Phrase: {item.get('phrase')}\n  Meaning: {item.get('meaning')}\n  Example: {item.get('example')}\n"
+    if table_key == "common_mistakes":
+        return f"- Mistake: {item.get('mistake')}\n  Correction: {item.get('correction')}\n  Example: {item.get('example')}\n"
+    return f"- Situation: {item.get('situation')}\n  Dialogue: {item.get('dialogue')}\n"
 
 def format_context(retrieved_data):
     """
     Định dạng dữ liệu tìm được và thêm thẻ span cho từ vựng.
     """
-    context = ""
-    
-    if retrieved_data.get("vocabulary"):
-        print("--- [LOG] Đang định dạng dữ liệu Vocabulary... ---")
-        # Đổi nhãn thành tiếng Anh
-        context += "Vocabulary Information:\n"
-        for item in retrieved_data["vocabulary"]:
-            word = item.get('word')
-            context += f"- Word: <span class=\"tts-word\">{word}</span>\n"
-            if item.get('phonetic'):
-                context += f"  Phonetic: {item.get('phonetic')}\n"
-            context += f"  Meaning: {item.get('meaning')}\n"
-            if item.get('example'):
-                context += f"  Example: {item.get('example')}\n"
-    
-    if retrieved_data.get("grammar"):
-        print("--- [LOG] Đang định dạng dữ liệu Grammar... ---")
-        # Đổi nhãn thành tiếng Anh
-        context += "\nGrammar Information:\n"
-        for item in retrieved_data["grammar"]:
-            context += f"- Rule: {item.get('rule')}\n  Explanation: {item.get('explanation')}\n  Example: {item.get('example')}\n"
-            
-    if retrieved_data.get("idioms"):
-        print("--- [LOG] Đang định dạng dữ liệu Idioms... ---")
-        # Đổi nhãn thành tiếng Anh
-        context += "\nIdiom Information:\n"
-        for item in retrieved_data["idioms"]:
-            context += f"- Phrase: {item.get('phrase')}\n  Meaning: {item.get('meaning')}\n  Example: {item.get('example')}\n"
-    
-    if retrieved_data.get("common_mistakes"):
-        print("--- [LOG] Đang định dạng dữ liệu Common Mistakes... ---")
-        # Đổi nhãn thành tiếng Anh
-        context += "\nCommon Mistake Information:\n"
-        for item in retrieved_data["common_mistakes"]:
-            context += f"- Mistake: {item.get('mistake')}\n  Correction: {item.get('correction')}\n  Example: {item.get('example')}\n"
-
-    if retrieved_data.get("conversations"):
-        print("--- [LOG] Đang định dạng dữ liệu Conversations... ---")
-        # Đổi nhãn thành tiếng Anh
-        context += "\nConversation Example:\n"
-        for item in retrieved_data["conversations"]:
-            context += f"- Situation: {item.get('situation')}\n  Dialogue: {item.get('dialogue')}\n"
-    
-    if not context:
-        print("--- [LOG] Không tìm thấy dữ liệu nào để định dạng. ---")
-        
-    return context.strip()
-
-def search_context(search_term: str) -> str:
+    sections = []
+    for table_key, header in CONTEXT_SECTIONS.items():
+        if retrieved_data.get(table_key):
+            logger.debug("Đang định dạng dữ liệu %s...", table_key)
+            sections.append(header + "\n" + "".join(format_item(table_key, item) for item in retrieved_data[table_key]))
+
+    if not sections:
+        logger.debug("Không tìm thấy dữ liệu nào để định dạng.")
+
+    return "\n".join(sections).strip()
+
+def pack_context(retrieved_data, search_term: str, token_budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Xếp hạng chung các ứng viên của mọi bảng rồi chọn lần lượt theo điểm cho tới khi hết ngân sách token.
+    Ứng viên tốt nhất luôn được giữ; các ứng viên kém hơn nó quá SCORE_MARGIN bị loại.
+    Trả về dict giống retrieved_data, mỗi bảng giữ thứ tự theo điểm.
+    """
+    candidates = rank_candidates(retrieved_data, search_term, rerank=RERANK_ENABLED)
+    packed = {key: [] for key in CONTEXT_SECTIONS}
+    if not candidates:
+        return packed
+
+    best_score = candidates[0][0]
+    used_tokens = 0
+    for score, table_key, item in candidates:
+        if score < best_score - SCORE_MARGIN:
+            break
+        cost = estimate_tokens(format_item(table_key, item))
+        if not packed[table_key]:
+            cost += estimate_tokens(CONTEXT_SECTIONS[table_key])
+        if used_tokens and used_tokens + cost > token_budget:
+            continue
+        packed[table_key].append(item)
+        used_tokens += cost
+
+    kept = sum(len(items) for items in packed.values())
+    logger.debug("Đã chọn %s/%s ứng viên (~%s/%s token).", kept, len(candidates), used_tokens, token_budget)
+    return packed
+
+def get_vector_index():
+    """
+    Vector index cục bộ nếu đã được nạp, ngược lại None (tìm bằng Supabase). Việc nạp và nạp lại snapshot
+    chạy trong nền (lifespan của backend/main.py), không bao giờ trên đường xử lý request.
+    """
+    return vector_index if vector_index.loaded else None
+
+async def match_table(client: AsyncClient, function_name: str, query_embedding, match_count: int = 1):
+    """Gọi một hàm match_* với timeout riêng; lỗi hoặc quá thời gian sẽ trả về danh sách rỗng."""
+    params = {'query_embedding': query_embedding, 'match_threshold': MATCH_THRESHOLD, 'match_count': match_count}
+    try:
+        with span(f"retrieval.rpc.{function_name}"):
+            response = await asyncio.wait_for(client.rpc(function_name, params).execute(), timeout=RPC_TIMEOUT_SECONDS)
+        return response.data or []
+    except asyncio.TimeoutError:
+        logger.warning("%s vượt quá %ss, bỏ qua bảng này.", function_name, RPC_TIMEOUT_SECONDS)
+        return []
+    except Exception as e:
+        logger.warning("Khi gọi %s: %s", function_name, e)
+        return []
+
+async def match_all_tables(client: AsyncClient, query_embedding, match_count: int = 1):
+    """Tìm trên cả 5 bảng bằng MỘT lệnh gọi RPC match_all, nhóm kết quả theo bảng nguồn."""
+    params = {'query_embedding': query_embedding, 'match_threshold': MATCH_THRESHOLD, 'match_count': match_count}
+    with span("retrieval.match_all"):
+        response = await asyncio.wait_for(client.rpc('match_all', params).execute(), timeout=RPC_TIMEOUT_SECONDS)
+    retrieved_data = {key: [] for key in MATCH_FUNCTIONS}
+    for row in response.data or []:
+        source_table = row.get('source_table')
+        if source_table in retrieved_data:
+            item = dict(row.get('payload') or {})
+            item['similarity'] = row.get('similarity')
+            retrieved_data[source_table].append(item)
+    return retrieved_data
+
+async def fan_out_tables(client: AsyncClient, query_embedding, match_count: int = 1):
+    """Gọi đồng thời 5 hàm match_* trên client async dùng chung."""
+    results = await asyncio.gather(*[
+        match_table(client, function_name, query_embedding, match_count)
+        for function_name in MATCH_FUNCTIONS.values()
+    ])
+    return dict(zip(MATCH_FUNCTIONS.keys(), results))
+
+def lookup_lexical(search_term: str):
+    """Tra cứu trên chỉ mục từ vựng (được dựng khi khởi động và làm mới trong nền, xem main.py)."""
+    if LEXICAL_MODE == "off":
+        return None
+    try:
+        with span("retrieval.lexical"):
+            return lexical_index.lookup(search_term, match_count=TOP_K_PER_TABLE)
+    except Exception as e:
+        logger.warning("Khi tra cứu chỉ mục từ vựng: %s", e)
+        return None
+
+def merge_retrieved_data(primary, secondary):
+    """Gộp hai kết quả truy xuất theo từng bảng, ưu tiên primary và bỏ các hàng trùng lặp."""
+    merged = {}
+    for key in MATCH_FUNCTIONS:
+        rows = list(primary.get(key) or [])
+        seen = [{k: v for k, v in row.items() if k not in ("id", "similarity")} for row in rows]
+        for row in secondary.get(key) or []:
+            content = {k: v for k, v in row.items() if k not in ("id", "similarity")}
+            if content not in seen:
+                rows.append(row)
+                seen.append(content)
+        merged[key] = rows
+    return merged
+
+async def search_supabase(query_embedding):
+    """Tìm trên 5 bảng bằng pgvector: dùng match_all nếu được bật, ngược lại gọi song song từng bảng."""
+    client = await get_async_supabase()
+    if USE_MATCH_ALL:
+        logger.debug("Đang truy vấn 5 bảng bằng match_all với ngưỡng: %s", MATCH_THRESHOLD)
+        try:
+            return await match_all_tables(client, query_embedding, TOP_K_PER_TABLE)
+        except Exception as e:
+            logger.warning("match_all thất bại, chuyển sang gọi song song từng bảng: %s", e)
+
+    logger.debug("Đang truy vấn song song 5 bảng với ngưỡng: %s", MATCH_THRESHOLD)
+    return await fan_out_tables(client, query_embedding, TOP_K_PER_TABLE)
+
+async def embed_query(search_term: str):
+    """Tạo embedding cho từ khóa truy vấn, ưu tiên lấy từ cache để bỏ qua round trip tới Google."""
+    cached = await query_embedding_cache.aget(EMBEDDING_MODEL, search_term)
+    if cached is not None:
+        logger.info("CACHE HIT: Embedding cho từ khóa '%s'.", search_term)
+        return cached
+
+    logger.debug("Đang tạo embedding cho từ khóa: '%s'", search_term)
+    with span("retrieval.embed"):
+        embedding_response = await gemini_scheduler.run(
+            EMBEDDING_MODEL, priority_var.get(),
+            lambda: genai.embed_content_async(model=EMBEDDING_MODEL, content=search_term, task_type="RETRIEVAL_QUERY"),
+            purpose="query_embedding",
+        )
+    query_embedding = embedding_response['embedding']
+    await query_embedding_cache.aset(EMBEDDING_MODEL, search_term, query_embedding)
+    return query_embedding
+
+async def embed_queries(search_terms) -> dict:
+    """Embedding cho nhiều từ khóa: lấy từ cache nếu có, phần còn lại được gửi theo lô trong lệnh gọi nhiều nội dung."""
+    embeddings, missing = {}, []
+    for search_term in dict.fromkeys(search_terms):
+        cached = await query_embedding_cache.aget(EMBEDDING_MODEL, search_term)
+        if cached is not None:
+            embeddings[search_term] = cached
+        else:
+            missing.append(search_term)
+    logger.debug("Embedding hàng loạt: %s từ khóa lấy từ cache, %s cần tạo mới.", len(embeddings), len(missing))
+
+    for start in range(0, len(missing), EMBED_BATCH_SIZE):
+        chunk = missing[start:start + EMBED_BATCH_SIZE]
+        with span("retrieval.embed_batch"):
+            embedding_response = await gemini_scheduler.run(
+                EMBEDDING_MODEL, priority_var.get(),
+                lambda: genai.embed_content_async(model=EMBEDDING_MODEL, content=chunk, task_type="RETRIEVAL_QUERY"),
+                purpose="query_embedding_batch",
+            )
+        for search_term, query_embedding in zip(chunk, embedding_response['embedding']):
+            await query_embedding_cache.aset(EMBEDDING_MODEL, search_term, query_embedding)
+            embeddings[search_term] = query_embedding
+    return embeddings
+
+async def search_many(query_embeddings):
+    """
+    Tìm trên 5 bảng cho nhiều embedding (theo RETRIEVER_BACKEND): vector index cục bộ xử lý cả lô bằng phép nhân
+    ma trận, Supabase được gọi cho từng embedding với tối đa BATCH_SEARCH_CONCURRENCY truy vấn đồng thời.
     """
-    Hàm chính để tìm kiếm ngữ cảnh trong Supabase trên cả 5 bảng.
+    if RETRIEVER_BACKEND == "local":
+        index = get_vector_index()
+        if index is not None:
+            logger.debug("Đang tìm trên vector index cục bộ với ngưỡng: %s", MATCH_THRESHOLD)
+            with span("retrieval.vector_local"):
+                return index.search_many(query_embeddings, match_count=TOP_K_PER_TABLE, match_threshold=MATCH_THRESHOLD)
+
+    semaphore = asyncio.Semaphore(BATCH_SEARCH_CONCURRENCY)
+
+    async def search_one(query_embedding):
+        async with semaphore:
+            return await search_supabase(query_embedding)
+
+    return await asyncio.gather(*[search_one(query_embedding) for query_embedding in query_embeddings])
+
+@dataclass
+class RetrievalResult:
+    """Kết quả truy xuất: ngữ cảnh đã định dạng và embedding của từ khóa (None nếu không cần tạo embedding)."""
+    context: str = ""
+    query_embedding: Optional[list] = None
+
+async def retrieve(search_term: str) -> RetrievalResult:
+    """
+    Hàm chính để tìm kiếm ngữ cảnh trên cả 5 bảng (vector index cục bộ hoặc Supabase, theo RETRIEVER_BACKEND).
     """
     if not search_term:
-        print("--- [LOG] Từ khóa tìm kiếm rỗng, bỏ qua truy vấn. ---")
-        return ""
+        logger.info("Từ khóa tìm kiếm rỗng, bỏ qua truy vấn.")
+        return RetrievalResult()
+    query_embedding = None
     try:
-        print(f"--- [LOG] Đang tạo embedding cho từ khóa: '{search_term}' ---")
-        query_embedding = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=search_term,
-            task_type="RETRIEVAL_QUERY"
-        )['embedding']
-        
-        threshold = 0.65
-        
-        print(f"--- [LOG] Đang truy vấn 5 bảng với ngưỡng: {threshold} ---")
-        
-        # Gọi RPC cho cả 5 bảng
-        vocab_res = supabase.rpc('match_vocabulary', {'query_embedding': query_embedding, 'match_threshold': threshold, 'match_count': 1}).execute()
-        grammar_res = supabase.rpc('match_grammar_rules', {'query_embedding': query_embedding, 'match_threshold': threshold, 'match_count': 1}).execute()
-        idioms_res = supabase.rpc('match_idioms', {'query_embedding': query_embedding, 'match_threshold': threshold, 'match_count': 1}).execute()
-        mistakes_res = supabase.rpc('match_common_mistakes', {'query_embedding': query_embedding, 'match_threshold': threshold, 'match_count': 1}).execute()
-        convo_res = supabase.rpc('match_conversations', {'query_embedding': query_embedding, 'match_threshold': threshold, 'match_count': 1}).execute()
-
-        print("--- [LOG] Đã hoàn tất truy vấn 5 bảng. ---")
-
-        retrieved_data = {
-            "vocabulary": vocab_res.data,
-            "grammar": grammar_res.data,
-            "idioms": idioms_res.data,
-            "common_mistakes": mistakes_res.data,
-            "conversations": convo_res.data
-        }
-        return format_context(retrieved_data)
+        lexical_data = lookup_lexical(search_term)
+        if lexical_data and LEXICAL_MODE == "first" and is_confident(lexical_data):
+            logger.info("Khớp chính xác '%s' trong chỉ mục từ vựng, bỏ qua embedding.", search_term)
+            return RetrievalResult(context=format_context(pack_context(lexical_data, search_term)))
+
+        query_embedding = await embed_query(search_term)
+        retrieved_data = (await search_many([query_embedding]))[0]
+
+        if lexical_data:
+            logger.info("Gộp kết quả khớp chính xác với kết quả tìm kiếm vector (hybrid).")
+            retrieved_data = merge_retrieved_data(lexical_data, retrieved_data)
+
+        logger.debug("Đã hoàn tất truy vấn 5 bảng.")
+        return RetrievalResult(context=format_context(pack_context(retrieved_data, search_term)),
+                               query_embedding=query_embedding)
+    except GeminiOverloaded:
+        # Không có embedding thì không trả lời "không tìm thấy" sai: để request nhận 503 và thử lại
+        raise
     except Exception as e:
-        print(f"---!!! [LỖI] Lỗi trong quá trình truy vấn (search_context): {e} !!!---")
-        return ""
\ No newline at end of file
+        logger.exception("Lỗi trong quá trình truy vấn (search_context): %s", e)
+        return RetrievalResult(query_embedding=query_embedding)
+
+async def retrieve_many(search_terms) -> List[RetrievalResult]:
+    """
+    Truy xuất ngữ cảnh cho nhiều từ khóa cùng lúc (dùng cho /answer/batch), trả về kết quả theo đúng thứ tự:
+    từ khóa trùng nhau chỉ được tra một lần, embedding được tạo theo lô (embed_queries) và tìm kiếm theo lô
+    (search_many). Lỗi được xử lý như retrieve(): ngữ cảnh rỗng, trừ GeminiOverloaded.
+    """
+    results, lexical = {}, {}
+    for search_term in dict.fromkeys(term for term in search_terms if term):
+        lexical_data = lookup_lexical(search_term)
+        if lexical_data and LEXICAL_MODE == "first" and is_confident(lexical_data):
+            results[search_term] = RetrievalResult(context=format_context(pack_context(lexical_data, search_term)))
+        else:
+            lexical[search_term] = lexical_data
+    logger.info("Truy xuất hàng loạt: %s từ khóa khớp chính xác, %s cần tìm kiếm vector.", len(results), len(lexical))
+
+    if lexical:
+        pending = list(lexical)
+        try:
+            embeddings = await embed_queries(pending)
+            retrieved = await search_many([embeddings[search_term] for search_term in pending])
+            for search_term, retrieved_data in zip(pending, retrieved):
+                if lexical[search_term]:
+                    retrieved_data = merge_retrieved_data(lexical[search_term], retrieved_data)
+                results[search_term] = RetrievalResult(
+                    context=format_context(pack_context(retrieved_data, search_term)),
+                    query_embedding=embeddings[search_term],
+                )
+        except GeminiOverloaded:
+            raise
+        except Exception as e:
+            logger.exception("Lỗi trong quá trình truy vấn hàng loạt (retrieve_many): %s", e)
+
+    return [results.get(search_term) or RetrievalResult() for search_term in search_terms]
+
+async def search_context(search_term: str) -> str:
+    """Tìm kiếm và chỉ trả về chuỗi ngữ cảnh đã định dạng."""
+    return (await retrieve(search_term)).context
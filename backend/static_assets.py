@@ -0,0 +1,286 @@
+import os
+import re
+import gzip
+import asyncio
+import hashlib
+import argparse
+import mimetypes
+from dataclasses import dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from urllib.parse import unquote
+
+try:
+    import brotli  # tùy chọn (pip install brotli); không có thì chỉ dùng gzip hoặc file .br nén sẵn
+except ImportError:
+    brotli = None
+
+from .observability import get_logger, configure_logging
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+# Thời gian trình duyệt được dùng lại file tĩnh (trừ HTML) mà không cần hỏi lại server
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", "3600"))
+# File nhỏ hơn ngưỡng này không đáng nén
+MIN_COMPRESS_BYTES = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+# Kiểu nén được ưu tiên theo thứ tự khi client chấp nhận nhiều kiểu; phần mở rộng của file nén sẵn tương ứng
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def gzip_compress(data: bytes) -> bytes:
+    # mtime=0 để cùng nội dung luôn cho cùng kết quả nén
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotli_compress(data: bytes) -> bytes:
+    return brotli.compress(data, quality=11)
+
+
+COMPRESSORS = {"br": brotli_compress if brotli else None, "gzip": gzip_compress}
+
+
+@dataclass
+class Asset:
+    """Một file tĩnh đã nạp vào bộ nhớ, kèm các bản nén (encoding -> nội dung)."""
+    content_type: str
+    mtime: float
+    size: int
+    digest: str
+    variants: dict = field(default_factory=dict)
+
+    @property
+    def last_modified(self) -> str:
+        return formatdate(self.mtime, usegmt=True)
+
+    def etag(self, encoding: str) -> str:
+        # ETag mạnh phải khác nhau giữa các bản nén, vì nội dung byte khác nhau
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+@dataclass
+class StaticResponse:
+    status: int
+    headers: list
+    body: bytes = b""
+
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    """Chọn bản nén tốt nhất mà client chấp nhận (theo header Accept-Encoding, có xét q=0)."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        quality = re.search(r"q\s*=\s*([\d.]+)", params)
+        try:
+            accepted[name.strip().lower()] = float(quality.group(1)) if quality else 1.0
+        except ValueError:
+            continue
+    for encoding in ENCODING_SUFFIXES:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+def parse_range(range_header: str, size: int):
+    """
+    (start, end) của một khoảng byte; None nếu header không hợp lệ hoặc có nhiều khoảng (trả về cả file),
+    False nếu khoảng nằm ngoài file (416).
+    """
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        return (max(0, size - length), size - 1) if length and size else False
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+class StaticAssets:
+    """
+    Phục vụ file tĩnh của frontend từ bộ nhớ, không phụ thuộc framework (dùng cho FastAPI và run_frontend.py):
+    - Nén gzip (và brotli nếu có gói brotli) một lần khi nạp file; dùng file .gz/.br nén sẵn bên cạnh nếu có.
+    - ETag mạnh (sha256 nội dung), Last-Modified và Cache-Control ("no-cache" cho HTML để luôn nhận bản mới
+      qua 304, max_age giây cho các file khác).
+    - Request điều kiện (If-None-Match / If-Modified-Since -> 304) và Range (206 / 416, có xét If-Range).
+    File được nạp lại khi mtime hoặc kích thước thay đổi.
+    """
+
+    def __init__(self, directory: str, index_file: str = "index.html", max_age: int = STATIC_MAX_AGE):
+        self.root = os.path.realpath(directory)
+        self.index_file = index_file
+        self.max_age = max_age
+        self._assets = {}
+
+    def resolve(self, url_path: str) -> Optional[str]:
+        """Đường dẫn file trên đĩa cho URL, hoặc None nếu không có hoặc nằm ngoài thư mục gốc."""
+        relative = unquote(url_path.split("?", 1)[0]).lstrip("/")
+        file_path = os.path.realpath(os.path.join(self.root, relative))
+        if file_path != self.root and not file_path.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, self.index_file)
+        return file_path if os.path.isfile(file_path) else None
+
+    def get(self, file_path: str) -> Optional[Asset]:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        asset = self._assets.get(file_path)
+        if asset is None or asset.mtime != stat.st_mtime or asset.size != stat.st_size:
+            asset = self._assets[file_path] = self._load(file_path, stat)
+        return asset
+
+    def _load(self, file_path: str, stat) -> Asset:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        compressible = content_type.startswith(COMPRESSIBLE_TYPES)
+        if compressible and "xml" not in content_type:
+            content_type += "; charset=utf-8"
+        asset = Asset(content_type=content_type, mtime=stat.st_mtime, size=stat.st_size,
+                      digest=hashlib.sha256(data).hexdigest()[:32], variants={"identity": data})
+        if compressible and len(data) >= MIN_COMPRESS_BYTES:
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                body = self._precompressed(file_path + suffix, stat.st_mtime)
+                if body is None and COMPRESSORS[encoding] is not None:
+                    body = COMPRESSORS[encoding](data)
+                if body is not None and len(body) < len(data):
+                    asset.variants[encoding] = body
+        logger.info("Đã nạp file tĩnh '%s': %s", os.path.relpath(file_path, self.root),
+                    ", ".join(f"{encoding} {len(body)} byte" for encoding, body in asset.variants.items()))
+        return asset
+
+    @staticmethod
+    def _precompressed(path: str, source_mtime: float) -> Optional[bytes]:
+        """Nội dung file nén sẵn (tạo bởi `python -m backend.static_assets`) nếu nó không cũ hơn file gốc."""
+        try:
+            if os.stat(path).st_mtime < source_mtime:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def cache_control(self, file_path: str) -> str:
+        if file_path.endswith(".html"):
+            return "no-cache"
+        return f"public, max-age={self.max_age}"
+
+    def respond(self, method: str, url_path: str, headers: dict) -> StaticResponse:
+        """Xử lý một request GET/HEAD; headers là dict với khóa viết thường."""
+        if method not in ("GET", "HEAD"):
+            return StaticResponse(405, [("Allow", "GET, HEAD"), ("Content-Length", "0")])
+        file_path = self.resolve(url_path)
+        asset = self.get(file_path) if file_path else None
+        if asset is None:
+            body = b"Not Found"
+            return StaticResponse(404, [("Content-Type", "text/plain; charset=utf-8"),
+                                        ("Content-Length", str(len(body)))], b"" if method == "HEAD" else body)
+
+        range_header = headers.get("range")
+        # Request Range dùng bản không nén để vị trí byte không phụ thuộc kiểu nén
+        encoding = "identity" if range_header else choose_encoding(headers.get("accept-encoding"), asset.variants)
+        etag = asset.etag(encoding)
+        response_headers = [
+            ("ETag", etag),
+            ("Last-Modified", asset.last_modified),
+            ("Cache-Control", self.cache_control(file_path)),
+            ("Vary", "Accept-Encoding"),
+            ("Accept-Ranges", "bytes"),
+        ]
+        if self._not_modified(headers, asset, etag):
+            return StaticResponse(304, response_headers)
+
+        status, body = 200, asset.variants[encoding]
+        response_headers.append(("Content-Type", asset.content_type))
+        if encoding != "identity":
+            response_headers.append(("Content-Encoding", encoding))
+        if range_header and headers.get("if-range", etag) in (etag, asset.last_modified):
+            byte_range = parse_range(range_header, len(body))
+            if byte_range is False:
+                response_headers.append(("Content-Range", f"bytes */{len(body)}"))
+                status, body = 416, b""
+            elif byte_range is not None:
+                start, end = byte_range
+                response_headers.append(("Content-Range", f"bytes {start}-{end}/{len(body)}"))
+                status, body = 206, body[start:end + 1]
+        response_headers.append(("Content-Length", str(len(body))))
+        return StaticResponse(status, response_headers, b"" if method == "HEAD" else body)
+
+    @staticmethod
+    def _not_modified(headers: dict, asset: Asset, etag: str) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            # If-None-Match so sánh "yếu": bỏ tiền tố W/
+            tags = [tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(asset.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class StaticAssetsApp:
+    """Ứng dụng ASGI cho StaticAssets, để mount vào FastAPI: app.mount("/", StaticAssetsApp(StaticAssets(...)))."""
+
+    def __init__(self, assets: StaticAssets):
+        self.assets = assets
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path, root_path = scope.get("path", "/"), scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        # Lần nạp đầu tiên đọc đĩa và nén file, nên chạy ngoài event loop
+        response = await asyncio.to_thread(self.assets.respond, scope["method"], path, headers)
+        await send({
+            "type": "http.response.start",
+            "status": response.status,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.headers],
+        })
+        await send({"type": "http.response.body", "body": response.body})
+
+
+def precompress_directory(directory: str):
+    """Ghi sẵn file .gz (và .br nếu có gói brotli) bên cạnh các file nén được, ví dụ trong bước build/triển khai."""
+    for folder, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            if file_name.endswith(tuple(ENCODING_SUFFIXES.values())):
+                continue
+            path = os.path.join(folder, file_name)
+            content_type = mimetypes.guess_type(path)[0] or ""
+            if not content_type.startswith(COMPRESSIBLE_TYPES):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                if COMPRESSORS[encoding] is None:
+                    continue
+                with open(path + suffix, "wb") as f:
+                    f.write(COMPRESSORS[encoding](data))
+            logger.info("Đã nén sẵn '%s'.", path)
+    if brotli is None:
+        logger.warning("Chưa cài gói brotli: chỉ tạo file .gz.")
+
+
+if __name__ == "__main__":
+    # Nén sẵn giao diện: python -m backend.static_assets frontend
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Tạo sẵn các bản nén gzip/brotli cho file tĩnh.")
+    parser.add_argument("directory", nargs="?", default="frontend", help="Thư mục chứa file tĩnh")
+    args = parser.parse_args()
+    precompress_directory(args.directory)
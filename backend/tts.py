@@ -0,0 +1,103 @@
+import io
+import re
+import wave
+import base64
+
+import google.generativeai as genai
+
+from .tts_cache import AUDIO_BUCKET
+from .observability import get_logger, span
+from .gemini_scheduler import gemini_scheduler, Priority
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+TTS_MODEL_NAME = 'gemini-2.5-flash-preview-tts'
+TTS_MODEL = genai.GenerativeModel(TTS_MODEL_NAME)
+TTS_VOICE = "Aoede"
+DEFAULT_SAMPLE_RATE = 24000
+# Dữ liệu PCM ngắn hơn ngưỡng này gần như chắc chắn là file "câm"
+MIN_PCM_BYTES = 2000
+
+
+class TTSGenerationError(Exception):
+    """API TTS không trả về dữ liệu âm thanh dùng được."""
+
+
+def pcm_to_wav_bytes(pcm_data, sample_rate):
+    """Chuyển đổi dữ liệu PCM thô thành định dạng WAV trong bộ nhớ."""
+    logger.debug("Đang chuyển đổi PCM sang WAV...")
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(pcm_data)
+    logger.debug("Đã chuyển đổi PCM sang WAV thành công.")
+    return wav_buffer.getvalue()
+
+
+async def synthesize_wav(text: str, priority: Priority = Priority.TTS) -> bytes:
+    """
+    Gọi API TTS của Google một lần (qua bộ điều phối quota) và trả về file WAV;
+    lỗi (kể cả 429 và GeminiOverloaded) được ném ra cho nơi gọi xử lý.
+    """
+    tts_prompt = f"Speak this word clearly and naturally, not too slow, at normal speaking speed: {text}"
+    tts_config = {
+        "response_modalities": ["AUDIO"],
+        "speech_config": {
+            "voice_config": {"prebuilt_voice_config": {"voice_name": TTS_VOICE}},
+        }
+    }
+
+    logger.info("Đang gọi API TTS của Google cho: '%s'...", text)
+    with span("tts.synthesize"):
+        response = await gemini_scheduler.run(
+            TTS_MODEL_NAME, priority,
+            lambda: TTS_MODEL.generate_content_async(tts_prompt, generation_config=tts_config),
+            purpose="tts",
+        )
+
+    if not (response.candidates and response.candidates[0].content.parts):
+        feedback = f" Lý do: {response.prompt_feedback}" if response.prompt_feedback else ""
+        raise TTSGenerationError(f"API TTS không trả về candidate hợp lệ.{feedback}")
+
+    logger.debug("Đã nhận được dữ liệu âm thanh từ API.")
+    audio_part = response.candidates[0].content.parts[0]
+    mime_type = getattr(audio_part.inline_data, "mime_type", "audio/L16;codec=pcm;rate=24000")
+    audio_raw = getattr(audio_part.inline_data, "data", None)
+    logger.debug("MIME Type: %s", mime_type)
+
+    if audio_raw is None:
+        raise TTSGenerationError("Không có dữ liệu âm thanh trong phản hồi TTS.")
+
+    # Xử lý dữ liệu có thể là base64 hoặc bytes
+    if isinstance(audio_raw, str):
+        try:
+            pcm_data = base64.b64decode(audio_raw)
+        except Exception:
+            logger.warning("Inline data không phải base64, chuyển sang bytes thô.")
+            pcm_data = audio_raw.encode("latin1")
+    else:
+        pcm_data = audio_raw
+
+    # Kiểm tra độ dài để tránh file “câm”
+    if len(pcm_data) < MIN_PCM_BYTES:
+        raise TTSGenerationError(f"Dữ liệu âm thanh quá ngắn ({len(pcm_data)} bytes).")
+
+    # Lấy sample rate từ MIME
+    sample_rate_match = re.search(r"rate=(\d+)", mime_type)
+    sample_rate = int(sample_rate_match.group(1)) if sample_rate_match else DEFAULT_SAMPLE_RATE
+    return pcm_to_wav_bytes(pcm_data, sample_rate)
+
+
+def upload_audio(supabase_client, file_path: str, wav_data: bytes, bucket: str = AUDIO_BUCKET):
+    """Tải file WAV lên Supabase Storage (ghi đè nếu đã tồn tại)."""
+    logger.debug("Đang tải file '%s' lên Supabase Storage...", file_path)
+    with span("tts.upload"):
+        supabase_client.storage.from_(bucket).upload(
+            file=wav_data,
+            path=file_path,
+            file_options={"content-type": "audio/wav", "x-upsert": "true"},
+        )
+    logger.debug("Đã tải lên file thành công.")
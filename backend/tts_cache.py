@@ -0,0 +1,146 @@
+import os
+import re
+import time
+import threading
+
+from .observability import get_logger
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+AUDIO_BUCKET = 'audio_cache'
+LIST_PAGE_SIZE = 1000
+
+
+def audio_file_name(text: str) -> str:
+    """Tên file WAV trong bucket cho một từ/cụm từ, ví dụ 'A piece of cake' -> 'a_piece_of_cake.wav'."""
+    sanitized_text = re.sub(r'[^a-z0-9]', '_', text.lower())
+    return f"{sanitized_text}.wav"
+
+
+class AudioCacheIndex:
+    """
+    Tập tên các file âm thanh đã có trong bucket audio_cache, giữ trong bộ nhớ.
+    Được nạp khi khởi động, làm mới định kỳ và cập nhật ngay khi upload,
+    nên việc kiểm tra cache không cần gọi storage.list() cho mỗi request.
+    shared (tùy chọn) là CacheBackend dùng chung: file do worker khác tải lên được nhìn thấy ngay.
+    supabase_client có thể là client hoặc hàm trả về client (để client chỉ được tạo khi cần).
+    """
+
+    NAMESPACE = "tts_audio"
+    # Khóa dùng chung chỉ cần sống lâu hơn chu kỳ làm mới: sau đó file đã nằm trong kết quả list() của mọi worker
+    SHARED_TTL_SECONDS = 7 * 24 * 3600
+
+    def __init__(self, supabase_client, bucket: str = AUDIO_BUCKET, refresh_seconds: float = 300, shared=None):
+        self._supabase = supabase_client
+        self.bucket = bucket
+        self.refresh_seconds = refresh_seconds
+        self.shared = shared
+        self._keys = set()
+        self._added_since_refresh = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def supabase(self):
+        return self._supabase() if callable(self._supabase) else self._supabase
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    @property
+    def stale(self) -> bool:
+        return not self.loaded or time.time() - self._loaded_at > self.refresh_seconds
+
+    def refresh(self):
+        """Liệt kê toàn bộ bucket (phân trang) và thay thế tập khóa trong bộ nhớ."""
+        with self._lock:
+            self._added_since_refresh = set()
+        keys = set()
+        offset = 0
+        while True:
+            page = self.supabase.storage.from_(self.bucket).list(
+                path="",
+                options={"limit": LIST_PAGE_SIZE, "offset": offset, "sortBy": {"column": "name", "order": "asc"}},
+            )
+            keys.update(item["name"] for item in page if item.get("name"))
+            if len(page) < LIST_PAGE_SIZE:
+                break
+            offset += LIST_PAGE_SIZE
+        with self._lock:
+            # Giữ lại các file được upload trong lúc đang liệt kê
+            self._keys = keys | self._added_since_refresh
+            self._loaded_at = time.time()
+        logger.info("Đã nạp chỉ mục cache âm thanh: %s file.", len(keys))
+        return self
+
+    def contains(self, file_name: str) -> bool:
+        if file_name in self._keys:
+            return True
+        if self.shared is not None and self.shared.get(self.NAMESPACE, file_name) is not None:
+            self._add_local(file_name)
+            return True
+        return False
+
+    def add(self, file_name: str):
+        self._add_local(file_name)
+        if self.shared is not None:
+            self.shared.set(self.NAMESPACE, file_name, b"1", self.SHARED_TTL_SECONDS)
+
+    def _add_local(self, file_name: str):
+        with self._lock:
+            self._keys.add(file_name)
+            self._added_since_refresh.add(file_name)
+
+    def public_url(self, file_name: str) -> str:
+        # get_public_url chỉ ghép chuỗi URL, không gọi mạng
+        return self.supabase.storage.from_(self.bucket).get_public_url(file_name)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class DiskAudioCache:
+    """
+    Tầng cache cục bộ trên đĩa cho các file WAV "nóng", giới hạn theo tổng dung lượng
+    (xóa các file ít được dùng gần đây nhất). Cho phép phục vụ âm thanh trực tiếp khi Storage gặp sự cố.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, file_name: str) -> str:
+        return os.path.join(self.directory, os.path.basename(file_name))
+
+    def get(self, file_name: str):
+        """Trả về đường dẫn file nếu có trong cache (và cập nhật thời điểm truy cập), ngược lại None."""
+        path = self.path_for(file_name)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, file_name: str, data: bytes):
+        path = self.path_for(file_name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(".wav"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
@@ -0,0 +1,170 @@
+import time
+import uuid
+import random
+import asyncio
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .gemini_scheduler import is_rate_limited, retry_after_seconds
+from .observability import get_logger, trace_id_var
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class TTSJob:
+    """Một yêu cầu tạo âm thanh; mọi request cho cùng một file dùng chung một job."""
+    id: str
+    key: str
+    text: str
+    status: str = "pending"  # pending | done | failed
+    audio_url: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    trace_id: Optional[str] = None  # mã trace của request đã tạo job, để log của worker gắn đúng request
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    def to_dict(self) -> dict:
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "audioUrl": self.audio_url,
+            "error": self.error,
+            "attempts": self.attempts,
+        }
+
+
+class TTSJobQueue:
+    """
+    Hàng đợi tạo âm thanh chạy nền:
+    - Single-flight: các request cho cùng một khóa (tên file) khi job đang chạy đều nhận lại job đó,
+      nên mỗi từ chỉ được tạo và upload một lần.
+    - Thử lại có backoff: job lỗi (đặc biệt là 429) được đưa lại vào hàng đợi sau một khoảng chờ,
+      không giữ request handler hay worker nào trong lúc chờ.
+    handler(key, text) là coroutine tạo file và trả về URL âm thanh.
+    """
+
+    def __init__(self, handler, workers: int = 2, max_attempts: int = 4,
+                 retry_base_delay: float = 10.0, retry_max_delay: float = 120.0, job_ttl: float = 600):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.job_ttl = job_ttl
+        self._queue = None
+        self._worker_tasks = []
+        self._retry_tasks = set()
+        self._jobs = {}       # job id -> TTSJob (giữ lại job đã xong trong job_ttl giây để client hỏi kết quả)
+        self._in_flight = {}  # key -> TTSJob đang chờ/đang chạy
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks = self._worker_tasks + list(self._retry_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+        self._worker_tasks = []
+
+    def submit(self, key: str, text: str) -> TTSJob:
+        """Trả về job đang chạy cho khóa này, hoặc tạo job mới và đưa vào hàng đợi."""
+        job = self._in_flight.get(key)
+        if job is not None:
+            logger.info("Gộp yêu cầu TTS '%s' vào job đang chạy %s.", key, job.id)
+            return job
+
+        self._ensure_started()
+        self._prune()
+        job = TTSJob(id=uuid.uuid4().hex, key=key, text=text, trace_id=trace_id_var.get())
+        self._jobs[job.id] = job
+        self._in_flight[key] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def has_job(self, key: str) -> bool:
+        """Có job đang chờ/đang chạy cho khóa này (request mới sẽ được gộp vào job đó)."""
+        return key in self._in_flight
+
+    def get(self, job_id: str) -> Optional[TTSJob]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job: TTSJob, timeout: float) -> bool:
+        """Chờ job hoàn tất tối đa timeout giây; trả về True nếu job đã xong (thành công hoặc thất bại)."""
+        if timeout > 0 and not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job.done.is_set()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            trace_token = trace_id_var.set(job.trace_id)
+            try:
+                await self._run(job)
+            finally:
+                trace_id_var.reset(trace_token)
+                self._queue.task_done()
+
+    async def _run(self, job: TTSJob):
+        job.attempts += 1
+        try:
+            audio_url = await self.handler(job.key, job.text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if job.attempts < self.max_attempts:
+                delay = self._retry_delay(job.attempts, e)
+                logger.warning("Tạo âm thanh '%s' thất bại (lần %s): %s. Thử lại sau %.1f giây.",
+                               job.key, job.attempts, e, delay)
+                task = asyncio.create_task(self._requeue_after(job, delay))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+                return
+            logger.error("Bỏ qua job TTS '%s' sau %s lần thử: %s", job.key, job.attempts, e)
+            self._finish(job, error=str(e))
+            return
+        self._finish(job, audio_url=audio_url)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        if is_rate_limited(error):
+            delay = retry_after_seconds(error) or self.retry_base_delay * 2 ** (attempt - 1)
+        else:
+            # Lỗi không phải quota (ví dụ không có candidate hợp lệ) thường hết sau một lần thử lại ngắn
+            delay = 2 ** (attempt - 1)
+        return min(delay, self.retry_max_delay) * random.uniform(1.0, 1.2)
+
+    async def _requeue_after(self, job: TTSJob, delay: float):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(job)
+
+    def _finish(self, job: TTSJob, audio_url: Optional[str] = None, error: Optional[str] = None):
+        job.audio_url = audio_url
+        job.error = error
+        job.status = "failed" if error else "done"
+        job.finished_at = time.time()
+        if self._in_flight.get(job.key) is job:
+            del self._in_flight[job.key]
+        job.done.set()
+
+    def _prune(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "retrying": len(self._retry_tasks),
+            "jobs": len(self._jobs),
+        }
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+from .tts import synthesize_wav, upload_audio, TTS_MODEL_NAME
+from .tts_cache import AudioCacheIndex, audio_file_name
+from .observability import get_logger, configure_logging
+from .gemini_scheduler import gemini_scheduler, is_rate_limited, retry_after_seconds, Priority, RESERVE_FRACTION
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+DEFAULT_CHECKPOINT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "tts_prewarm_checkpoint.json"
+)
+
+# Nguồn từ/cụm từ cần phát âm -> (bảng trong Supabase, cột chứa văn bản)
+PREWARM_SOURCES = {
+    "vocabulary": ("english_vocabulary", "word"),
+    "idioms": ("english_idioms", "phrase"),
+}
+
+PAGE_SIZE = 1000
+# Thời gian tạm dừng mặc định khi gặp 429 mà API không gợi ý thời gian chờ
+DEFAULT_COOLDOWN_SECONDS = 60
+# Số từ hoàn tất giữa hai lần ghi checkpoint
+CHECKPOINT_EVERY = 10
+
+
+def default_rate() -> float:
+    """
+    Tốc độ mặc định (lệnh gọi TTS/giây): giới hạn của mô hình TTS trong bộ điều phối Gemini
+    (GEMINI_RATE_LIMITS), chừa RESERVE_FRACTION cho người dùng bấm nghe trên server đang chạy.
+    """
+    rpm = gemini_scheduler.rate_limits.get(TTS_MODEL_NAME, gemini_scheduler.default_rpm)
+    return rpm * (1 - RESERVE_FRACTION) / 60
+
+
+def fetch_terms(client, table_name, column):
+    """Lấy toàn bộ giá trị của một cột văn bản, phân trang theo id (keyset)."""
+    terms = []
+    last_id = None
+    while True:
+        query = client.table(table_name).select(f"id, {column}").order("id").limit(PAGE_SIZE)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        data = query.execute().data
+        if not data:
+            break
+        terms.extend(row[column] for row in data if row.get(column))
+        last_id = data[-1]["id"]
+    return terms
+
+
+def load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"done": [], "failed": {}}
+
+
+def save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def collect_missing(client, sources, audio_index, checkpoint, retry_failed=False):
+    """
+    Danh sách (tên file, văn bản) còn thiếu âm thanh, đã loại trùng theo tên file.
+    Bỏ qua các file đã có trong bucket, đã xong theo checkpoint, và (mặc định) các từ đã thất bại trước đó.
+    """
+    done = set(checkpoint["done"])
+    failed = set(checkpoint["failed"]) if not retry_failed else set()
+    missing, seen, total = [], set(), 0
+    for source in sources:
+        table_name, column = PREWARM_SOURCES[source]
+        logger.info("Đang đọc bảng '%s'...", table_name)
+        for text in fetch_terms(client, table_name, column):
+            file_name = audio_file_name(text)
+            if file_name in seen:
+                continue
+            seen.add(file_name)
+            total += 1
+            if audio_index.contains(file_name) or file_name in done or file_name in failed:
+                continue
+            missing.append((file_name, text))
+    return total, missing
+
+
+class RatePacer:
+    """Giãn đều các lệnh gọi TTS theo tốc độ cho trước; khi gặp 429 thì tạm dừng mọi worker."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        await asyncio.sleep(max(0.0, slot - now))
+
+    def pause(self, seconds: float):
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+async def prewarm_one(client, file_name, text, pacer, max_retries):
+    """Tạo và tải lên âm thanh cho một từ; lỗi 429 làm tạm dừng toàn bộ rồi thử lại."""
+    for attempt in range(1, max_retries + 1):
+        await pacer.acquire()
+        try:
+            wav_data = await synthesize_wav(text, priority=Priority.BATCH)
+            await asyncio.to_thread(upload_audio, client, file_name, wav_data)
+            return
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            if is_rate_limited(e):
+                cooldown = retry_after_seconds(e) or DEFAULT_COOLDOWN_SECONDS
+                logger.warning("Gặp lỗi 429 với '%s', tạm dừng %.1f giây rồi thử lại.", text, cooldown)
+                pacer.pause(cooldown)
+            else:
+                logger.warning("Lỗi với '%s' (lần %s): %s. Đang thử lại...", text, attempt, e)
+
+
+async def run_prewarm(client, items, checkpoint, checkpoint_path, rate, concurrency, max_retries):
+    pacer = RatePacer(rate)
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    progress = {"ok": 0, "failed": 0}
+    started = time.monotonic()
+
+    async def worker():
+        while True:
+            try:
+                file_name, text = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await prewarm_one(client, file_name, text, pacer, max_retries)
+                checkpoint["done"].append(file_name)
+                checkpoint["failed"].pop(file_name, None)
+                progress["ok"] += 1
+            except Exception as e:
+                checkpoint["failed"][file_name] = str(e)
+                progress["failed"] += 1
+                logger.error("Không tạo được âm thanh cho '%s': %s", text, e)
+
+            finished = progress["ok"] + progress["failed"]
+            elapsed = time.monotonic() - started
+            eta = elapsed / finished * (len(items) - finished)
+            logger.info("[%s/%s] '%s' (thành công %s, lỗi %s, còn khoảng %.1f phút)",
+                        finished, len(items), text, progress["ok"], progress["failed"], eta / 60)
+            if finished % CHECKPOINT_EVERY == 0:
+                save_checkpoint(checkpoint_path, checkpoint)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        # Luôn lưu checkpoint, kể cả khi bị dừng giữa chừng (Ctrl+C), để lần chạy sau tiếp tục
+        save_checkpoint(checkpoint_path, checkpoint)
+    return progress
+
+
+def main():
+    from .clients import get_supabase, configure_genai
+
+    configure_logging()
+    configure_genai()
+    parser = argparse.ArgumentParser(description="Tạo trước âm thanh TTS cho toàn bộ từ vựng (và thành ngữ).")
+    parser.add_argument("--sources", nargs="+", choices=list(PREWARM_SOURCES), default=["vocabulary"],
+                        help="Các nguồn cần tạo âm thanh (mặc định chỉ vocabulary)")
+    parser.add_argument("--rate", type=float, default=default_rate(),
+                        help="Tốc độ tối đa (lệnh gọi TTS/giây, mặc định theo giới hạn TTS của GEMINI_RATE_LIMITS)")
+    parser.add_argument("--concurrency", type=int, default=2, help="Số lệnh gọi TTS chạy song song tối đa")
+    parser.add_argument("--max-retries", type=int, default=5, help="Số lần thử tối đa cho mỗi từ")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="File lưu tiến độ")
+    parser.add_argument("--reset", action="store_true", help="Bỏ qua checkpoint cũ")
+    parser.add_argument("--retry-failed", action="store_true", help="Thử lại cả các từ đã thất bại ở lần chạy trước")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo số từ còn thiếu âm thanh, không gọi API")
+    args = parser.parse_args()
+
+    checkpoint = {"done": [], "failed": {}} if args.reset else load_checkpoint(args.checkpoint)
+    supabase = get_supabase()
+    audio_index = AudioCacheIndex(supabase).refresh()
+    total, missing = collect_missing(supabase, args.sources, audio_index, checkpoint, args.retry_failed)
+    logger.info("%s từ/cụm từ, %s đã có âm thanh hoặc được bỏ qua, %s cần tạo (ước tính %.1f phút).",
+                total, total - len(missing), len(missing), len(missing) / args.rate / 60)
+    if args.dry_run or not missing:
+        return
+
+    progress = asyncio.run(run_prewarm(
+        supabase, missing, checkpoint, args.checkpoint, args.rate, args.concurrency, args.max_retries
+    ))
+    logger.info("Hoàn tất: tạo mới %s file, %s từ thất bại (chạy lại với --retry-failed để thử lại).",
+                progress["ok"], progress["failed"])
+
+
+if __name__ == "__main__":
+    # Ví dụ: python -m backend.tts_prewarm --sources vocabulary idioms --rate 0.1 --concurrency 2
+    main()
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from .observability import get_logger, configure_logging
+
+logger = get_logger(__name__)
+
+# --- CẤU HÌNH ---
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "vector_index")
+
+# Khóa trong retrieved_data -> bảng tương ứng trong Supabase
+INDEX_TABLES = {
+    "vocabulary": "english_vocabulary",
+    "grammar": "english_grammar_rules",
+    "idioms": "english_idioms",
+    "common_mistakes": "english_common_mistakes",
+    "conversations": "english_conversations",
+}
+
+PAGE_SIZE = 1000
+# Cột phiên bản embedding, không đưa vào dữ liệu của snapshot
+EMBEDDING_VERSION_COLUMNS = ("content_hash", "embedding_model")
+
+
+def parse_embedding(value):
+    """pgvector qua PostgREST trả về embedding dạng chuỗi '[0.1,0.2,...]'."""
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def fetch_table_rows(client, table_name):
+    """Lấy toàn bộ các hàng đã có embedding của một bảng, phân trang theo id (keyset)."""
+    rows = []
+    last_id = None
+    while True:
+        query = client.table(table_name).select("*").not_.is_("embedding", "null").order("id").limit(PAGE_SIZE)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        data = query.execute().data
+        if not data:
+            break
+        rows.extend(data)
+        last_id = data[-1]["id"]
+    return rows
+
+
+def build_snapshot(client, out_dir=DEFAULT_INDEX_DIR, dtype="float32", embedding_model=None):
+    """
+    Tải embedding của 5 bảng từ Supabase và lưu thành snapshot:
+    mỗi bảng một file <key>.npy (các vector đã chuẩn hóa L2) và một file <key>.json (dữ liệu các hàng).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {"created_at": time.time(), "dtype": dtype, "embedding_model": embedding_model, "tables": {}}
+
+    for key, table_name in INDEX_TABLES.items():
+        logger.info("Đang tải bảng '%s' để tạo snapshot...", table_name)
+        rows = fetch_table_rows(client, table_name)
+        vectors = [parse_embedding(row.pop("embedding")) for row in rows]
+        for row in rows:
+            for column in EMBEDDING_VERSION_COLUMNS:
+                row.pop(column, None)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if len(rows):
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.maximum(norms, 1e-12)
+
+        # Ghi file tạm rồi đổi tên, để các worker đang mmap snapshot cũ không đọc phải file ghi dở
+        matrix_path = os.path.join(out_dir, f"{key}.npy")
+        np.save(matrix_path + ".tmp.npy", matrix.astype(dtype))
+        os.replace(matrix_path + ".tmp.npy", matrix_path)
+        payload_path = os.path.join(out_dir, f"{key}.json")
+        with open(payload_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(payload_path + ".tmp", payload_path)
+
+        manifest["tables"][key] = {"table": table_name, "rows": len(rows), "dims": int(matrix.shape[1]) if len(rows) else 0}
+        logger.info("Đã lưu %s hàng của bảng '%s'.", len(rows), table_name)
+
+    # Manifest được ghi sau cùng: các worker nạp lại snapshot khi thấy mtime của nó thay đổi
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+class VectorIndex:
+    """
+    Chỉ mục vector trong tiến trình cho 5 bảng kiến thức.
+    Ma trận embedding được mở bằng mmap (chỉ đọc), nên nhiều worker uvicorn dùng chung page cache của hệ điều hành.
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        self.matrices = {}
+        self.payloads = {}
+        self.manifest = {}
+        self._manifest_mtime = None
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self.matrices)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.index_dir, "manifest.json")
+
+    def load(self):
+        """Nạp (hoặc nạp lại) snapshot từ thư mục index_dir."""
+        manifest_mtime = os.path.getmtime(self.manifest_path)
+        with open(self.manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        matrices, payloads = {}, {}
+        for key in manifest["tables"]:
+            matrices[key] = np.load(os.path.join(self.index_dir, f"{key}.npy"), mmap_mode="r")
+            with open(os.path.join(self.index_dir, f"{key}.json"), encoding="utf-8") as f:
+                payloads[key] = json.load(f)
+        self.matrices, self.payloads, self.manifest = matrices, payloads, manifest
+        self._manifest_mtime = manifest_mtime
+        logger.info("Đã nạp vector index từ '%s': %s hàng.",
+                    self.index_dir, sum(len(rows) for rows in payloads.values()))
+        return self
+
+    def reload_if_changed(self):
+        """Nạp snapshot nếu chưa nạp hoặc manifest đã đổi (snapshot mới được tạo); lỗi giữ nguyên bản đang dùng."""
+        if not self.loaded or os.path.getmtime(self.manifest_path) != self._manifest_mtime:
+            self.load()
+        return self
+
+    def search(self, query_embedding, match_count: int = 1, match_threshold: float = 0.65):
+        """
+        Tìm top-k theo độ tương đồng cosine trên từng bảng, cùng ngữ nghĩa với các hàm match_*:
+        chỉ giữ các hàng có similarity > match_threshold. Trả về dict giống retrieved_data.
+        """
+        return self.search_many([query_embedding], match_count, match_threshold)[0]
+
+    def search_many(self, query_embeddings, match_count: int = 1, match_threshold: float = 0.65):
+        """Như search() cho nhiều truy vấn cùng lúc: một phép nhân ma trận cho mỗi bảng. Trả về list retrieved_data."""
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        results = [{} for _ in range(queries.shape[0])]
+        for key, matrix in self.matrices.items():
+            if matrix.shape[0] == 0:
+                for retrieved_data in results:
+                    retrieved_data[key] = []
+                continue
+            all_scores = matrix @ queries.T.astype(matrix.dtype, copy=False)  # (số hàng, số truy vấn)
+            k = min(match_count, matrix.shape[0])
+            for column, retrieved_data in enumerate(results):
+                scores = all_scores[:, column]
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top])]
+                retrieved_data[key] = [
+                    dict(self.payloads[key][i], similarity=float(scores[i]))
+                    for i in top if scores[i] > match_threshold
+                ]
+        return results
+
+if __name__ == "__main__":
+    # Tạo snapshot: python -m backend.vector_index --out data/vector_index --dtype float32
+    from .retriever import EMBEDDING_MODEL
+    from .clients import get_supabase
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Tạo snapshot vector index từ các bảng Supabase.")
+    parser.add_argument("--out", default=DEFAULT_INDEX_DIR, help="Thư mục lưu snapshot")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Kiểu dữ liệu của ma trận")
+    args = parser.parse_args()
+    build_snapshot(get_supabase(), args.out, args.dtype, EMBEDDING_MODEL)
+    print("🎉 Hoàn tất tạo snapshot vector index!")
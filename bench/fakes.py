@@ -0,0 +1,389 @@
+import re
+import json
+import math
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+from google.api_core.exceptions import ResourceExhausted
+
+from backend.lexical_index import LEXICAL_SOURCES, normalize_term
+from .fixtures import load_keys
+
+EMBEDDING_DIMS = 768
+QUERY_PATTERN = re.compile(r'Query: "(.*)"')
+CONTEXT_WORD_PATTERN = re.compile(r'<span class="tts-word">[^<]*</span>')
+
+
+@dataclass
+class Latency:
+    """Phân phối độ trễ của một phụ thuộc bên ngoài (mili giây)."""
+    mean_ms: float
+    dist: str = "lognormal"  # fixed | uniform | lognormal
+    sigma: float = 0.5
+
+    def sample(self, rng: random.Random) -> float:
+        """Một mẫu độ trễ, tính bằng giây. Phân phối lognormal được chỉnh để giữ nguyên giá trị trung bình."""
+        if self.mean_ms <= 0:
+            return 0.0
+        if self.dist == "fixed":
+            value = self.mean_ms
+        elif self.dist == "uniform":
+            value = rng.uniform(0.5 * self.mean_ms, 1.5 * self.mean_ms)
+        else:
+            value = self.mean_ms * math.exp(rng.gauss(0, self.sigma) - self.sigma ** 2 / 2)
+        return value / 1000
+
+
+class StageRecorder:
+    """Ghi lại thời gian và số lỗi của từng lệnh gọi tới phụ thuộc giả, nhóm theo giai đoạn."""
+
+    def __init__(self):
+        self._samples = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, error: bool = False):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds * 1000)
+            if error:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._errors.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            result = {}
+            for stage, samples in sorted(self._samples.items()):
+                values = np.asarray(samples)
+                result[stage] = {
+                    "calls": len(samples),
+                    "errors_429": self._errors.get(stage, 0),
+                    "mean_ms": round(float(values.mean()), 2),
+                    "p50_ms": round(float(np.percentile(values, 50)), 2),
+                    "p95_ms": round(float(np.percentile(values, 95)), 2),
+                    "total_ms": round(float(values.sum()), 2),
+                }
+            return result
+
+
+@dataclass
+class FakeEnvironment:
+    """Cấu hình dùng chung cho mọi phụ thuộc giả: độ trễ theo giai đoạn, tỉ lệ lỗi 429 và bộ ghi thời gian."""
+    latencies: dict
+    rate_429: float = 0.0
+    retry_hint_seconds: float = 1.0
+    answer_chars: int = 900
+    stream_chunks: int = 8
+    seed: int = 0
+    oracle: dict = field(default_factory=dict)  # câu hỏi -> kết quả phân tích mong đợi
+    recorder: StageRecorder = field(default_factory=StageRecorder)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+        self._rng_lock = threading.Lock()
+
+    def delay(self, stage: str) -> float:
+        with self._rng_lock:
+            return self.latencies[stage].sample(self.rng)
+
+    def should_fail(self) -> bool:
+        with self._rng_lock:
+            return self.rate_429 > 0 and self.rng.random() < self.rate_429
+
+    def quota_error(self):
+        return ResourceExhausted(f"429 Resource has been exhausted (e.g. check quota). "
+                                 f"Please retry in {self.retry_hint_seconds}s")
+
+    async def call(self, stage: str, quota_limited: bool = True):
+        """Mô phỏng một lệnh gọi async: chờ theo phân phối độ trễ, có thể ném lỗi 429."""
+        seconds = self.delay(stage)
+        await asyncio.sleep(seconds)
+        failed = quota_limited and self.should_fail()
+        self.recorder.record(stage, seconds, error=failed)
+        if failed:
+            raise self.quota_error()
+
+    def call_sync(self, stage: str):
+        seconds = self.delay(stage)
+        time.sleep(seconds)
+        self.recorder.record(stage, seconds)
+
+
+# --- Gemini ---
+
+class FakeResponse:
+    def __init__(self, text=None, candidates=None):
+        self._text = text
+        self.candidates = candidates or []
+        self.prompt_feedback = None
+
+    @property
+    def text(self):
+        return self._text
+
+
+class FakeStream:
+    """Phản hồi stream: lần lượt trả về các đoạn văn bản, mỗi đoạn cách nhau một khoảng trễ."""
+
+    def __init__(self, env: FakeEnvironment, text: str):
+        self.env = env
+        size = max(1, math.ceil(len(text) / env.stream_chunks))
+        self.chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            await self.env.call("llm.stream_chunk", quota_limited=False)
+            yield FakeResponse(text=chunk)
+
+
+class FakeAudioPart:
+    class inline_data:
+        mime_type = "audio/L16;codec=pcm;rate=24000"
+        # 0,25 giây im lặng, đủ dài để vượt kiểm tra file "câm"
+        data = base64.b64encode(b"\0" * 12000).decode()
+
+
+class FakeGenerativeModel:
+    """Thay cho genai.GenerativeModel: trả lời prompt phân tích, sinh câu trả lời (kể cả stream) và TTS."""
+
+    env: FakeEnvironment = None
+    # genai.GenerativeModel thật (install_fakes gán trước khi thay thế), dùng để kiểm tra request
+    sdk_model_class = None
+
+    def __init__(self, model_name, *args, **kwargs):
+        self.model_name = model_name
+        self.sdk_model = self.sdk_model_class(model_name) if self.sdk_model_class else None
+
+    def check_request(self, prompt, generation_config):
+        """
+        Dựng request bằng SDK thật (không gọi mạng), để cấu hình mà API thật sẽ từ chối
+        (ví dụ response_schema không hợp lệ) làm benchmark lỗi ngay thay vì bị bản giả bỏ qua.
+        """
+        if self.sdk_model is not None:
+            self.sdk_model._prepare_request(contents=prompt, generation_config=generation_config,
+                                            tools=None, tool_config=None)
+
+    def analysis_for(self, prompt: str) -> dict:
+        match = QUERY_PATTERN.search(prompt)
+        query = match.group(1) if match else ""
+        expected = self.env.oracle.get(query)
+        if expected:
+            return {key: expected[key] for key in ("intent", "language", "keyword")}
+        return {"intent": "Q&A", "language": "Vietnamese", "keyword": query}
+
+    def answer_for(self, prompt: str) -> str:
+        words = " ".join(CONTEXT_WORD_PATTERN.findall(prompt)[:3])
+        filler = "Đây là câu trả lời mô phỏng cho benchmark. "
+        body = filler * max(1, self.env.answer_chars // len(filler))
+        return f"Chào bạn! {words}\n\n{body}"[:max(self.env.answer_chars, len(words) + 12)]
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False, **kwargs):
+        self.check_request(prompt, generation_config)
+        if "tts" in self.model_name:
+            await self.env.call("tts")
+            return FakeResponse(candidates=[type("Candidate", (), {
+                "content": type("Content", (), {"parts": [FakeAudioPart]})
+            })])
+        if isinstance(generation_config, dict) and "response_schema" in generation_config:
+            await self.env.call("llm.analysis")
+            return FakeResponse(text=json.dumps(self.analysis_for(prompt), ensure_ascii=False))
+        if "Update the running summary" in prompt:
+            await self.env.call("llm.summary")
+            return FakeResponse(text="The learner asked about several English words.")
+        if stream:
+            await self.env.call("llm.first_token")
+            return FakeStream(self.env, self.answer_for(prompt))
+        await self.env.call("llm.answer")
+        return FakeResponse(text=self.answer_for(prompt))
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        return asyncio.run(self.generate_content_async(prompt, generation_config=generation_config, **kwargs))
+
+
+# --- Embedding ---
+
+class FakeEmbedder:
+    """
+    Embedding giả, xác định theo nội dung văn bản (vector ngẫu nhiên sinh từ SHA-256 của văn bản đã chuẩn hóa).
+    Ghi nhớ vector -> văn bản để Supabase giả có thể chọn các hàng liên quan.
+    """
+
+    def __init__(self, env: FakeEnvironment):
+        self.env = env
+        self.texts = {}
+
+    def vector(self, text: str):
+        seed = int.from_bytes(hashlib.sha256(normalize_term(text).encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMS).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        values = vector.tolist()
+        self.texts[self.fingerprint(values)] = text
+        return values
+
+    @staticmethod
+    def fingerprint(values):
+        return tuple(round(float(v), 5) for v in values[:4])
+
+    async def embed_content_async(self, model=None, content=None, task_type=None, **kwargs):
+        await self.env.call("embed")
+        if isinstance(content, list):
+            return {"embedding": [self.vector(text) for text in content]}
+        return {"embedding": self.vector(content)}
+
+    def embed_content(self, model=None, content=None, task_type=None, **kwargs):
+        self.env.call_sync("embed")
+        if isinstance(content, list):
+            return {"embedding": [self.vector(text) for text in content]}
+        return {"embedding": self.vector(content)}
+
+
+# --- Supabase ---
+
+# Hàm RPC -> khóa bảng trong retrieved_data
+RPC_TABLES = {
+    "match_vocabulary": "vocabulary",
+    "match_grammar_rules": "grammar",
+    "match_idioms": "idioms",
+    "match_common_mistakes": "common_mistakes",
+    "match_conversations": "conversations",
+}
+
+
+class FakeCorpus:
+    """Các hàng dữ liệu từ CSV, có chỉ mục theo từ để chọn ứng viên "gần" với từ khóa truy vấn."""
+
+    def __init__(self, data_dir=None):
+        keys = load_keys(data_dir) if data_dir else load_keys()
+        self.rows = {}
+        self.tokens = {}
+        for table_key, values in keys.items():
+            key_column = LEXICAL_SOURCES[table_key][1]
+            self.rows[table_key] = [{"id": i + 1, key_column: value, "meaning": "...", "example": "..."}
+                                    for i, value in enumerate(values)]
+            index = {}
+            for i, value in enumerate(values):
+                for token in normalize_term(value).split():
+                    index.setdefault(token, []).append(i)
+            self.tokens[table_key] = index
+
+    def search(self, table_key, text, match_count, match_threshold):
+        key_column = LEXICAL_SOURCES[table_key][1]
+        term = normalize_term(text or "")
+        scores = {}
+        for token in term.split():
+            for i in self.tokens[table_key].get(token, [])[:200]:
+                scores[i] = scores.get(i, 0) + 1
+        results = []
+        for i, hits in sorted(scores.items(), key=lambda item: -item[1])[:match_count]:
+            row = self.rows[table_key][i]
+            similarity = 0.95 if normalize_term(row[key_column]) == term else min(0.9, 0.62 + 0.08 * hits)
+            if similarity > match_threshold:
+                results.append(dict(row, similarity=similarity))
+        return results
+
+
+class FakeQuery:
+    def __init__(self, coroutine_factory):
+        self._factory = coroutine_factory
+
+    def execute(self):
+        return self._factory()
+
+
+class FakeAsyncSupabase:
+    def __init__(self, env: FakeEnvironment, corpus: FakeCorpus, embedder: FakeEmbedder):
+        self.env, self.corpus, self.embedder = env, corpus, embedder
+
+    def rpc(self, function_name, params):
+        async def execute():
+            await self.env.call("supabase.rpc", quota_limited=False)
+            text = self.embedder.texts.get(self.embedder.fingerprint(params["query_embedding"]))
+            if function_name == "match_all":
+                data = [
+                    {"source_table": table_key, "payload": {k: v for k, v in row.items() if k != "similarity"},
+                     "similarity": row["similarity"]}
+                    for table_key in RPC_TABLES.values()
+                    for row in self.corpus.search(table_key, text, params["match_count"], params["match_threshold"])
+                ]
+            else:
+                data = self.corpus.search(RPC_TABLES[function_name], text,
+                                          params["match_count"], params["match_threshold"])
+            return type("Response", (), {"data": data})
+        return FakeQuery(execute)
+
+
+class FakeBucket:
+    def __init__(self, env: FakeEnvironment, files: set):
+        self.env, self.files = env, files
+
+    def list(self, path="", options=None):
+        self.env.call_sync("storage.list")
+        options = options or {}
+        names = sorted(self.files)
+        if options.get("search"):
+            names = [name for name in names if options["search"] in name]
+        offset = options.get("offset", 0)
+        return [{"name": name} for name in names[offset:offset + options.get("limit", 100)]]
+
+    def upload(self, file=None, path=None, file_options=None):
+        self.env.call_sync("storage.upload")
+        self.files.add(path)
+
+    def get_public_url(self, path):
+        return f"https://storage.invalid/audio_cache/{path}"
+
+
+class FakeStorage:
+    def __init__(self, env: FakeEnvironment):
+        self.env = env
+        self.files = set()
+
+    def from_(self, bucket):
+        return FakeBucket(self.env, self.files)
+
+
+class FakeSupabase:
+    """Client đồng bộ giả: chỉ cần Storage cho đường TTS (danh sách file, upload, URL công khai)."""
+
+    def __init__(self, env: FakeEnvironment):
+        self.storage = FakeStorage(env)
+
+
+def install_fakes(env: FakeEnvironment, data_dir=None):
+    """
+    Thay genai.GenerativeModel, genai.embed_content(_async) và các hàm tạo client Supabase bằng bản giả.
+    Phải gọi TRƯỚC khi import backend.main, vì các model và client được tạo lúc import.
+    """
+    import supabase
+    import google.generativeai as genai
+
+    FakeGenerativeModel.env = env
+    embedder = FakeEmbedder(env)
+    corpus = FakeCorpus(data_dir)
+    sync_client = FakeSupabase(env)
+    async_client = FakeAsyncSupabase(env, corpus, embedder)
+
+    async def acreate_client(*args, **kwargs):
+        return async_client
+
+    if FakeGenerativeModel.sdk_model_class is None:
+        FakeGenerativeModel.sdk_model_class = genai.GenerativeModel
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.embed_content_async = embedder.embed_content_async
+    genai.embed_content = embedder.embed_content
+    genai.configure = lambda *args, **kwargs: None
+    supabase.create_client = lambda *args, **kwargs: sync_client
+    supabase.acreate_client = acreate_client
+    return sync_client, async_client
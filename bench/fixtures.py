@@ -0,0 +1,113 @@
+import os
+import csv
+import json
+import random
+import argparse
+
+from backend.lexical_index import DEFAULT_DATA_DIR, LEXICAL_SOURCES
+
+# Mẫu câu hỏi cho từng bảng: (mẫu, ngôn ngữ). {key} là giá trị cột khóa của hàng
+QUESTION_TEMPLATES = {
+    "vocabulary": [
+        ("{key} nghĩa là gì", "Vietnamese"),
+        ("What does {key} mean?", "English"),
+        ("{key} có nghĩa là gì và cho câu ví dụ", "Vietnamese"),
+    ],
+    "idioms": [
+        ("cho tôi ví dụ về '{key}'", "Vietnamese"),
+        ("What does the idiom '{key}' mean?", "English"),
+    ],
+    "grammar": [
+        ("giải thích {key}", "Vietnamese"),
+        ("{key}", "Vietnamese"),
+    ],
+    "common_mistakes": [
+        ("'{key}' sai ở đâu?", "Vietnamese"),
+    ],
+    "conversations": [
+        ("hội thoại {key}", "Vietnamese"),
+    ],
+}
+
+SMALL_TALK = [
+    ("xin chào", "Vietnamese"),
+    ("hello", "English"),
+    ("cảm ơn bạn", "Vietnamese"),
+    ("bạn là ai?", "Vietnamese"),
+    ("tôi muốn học tiếng anh", "Vietnamese"),
+]
+
+# Tỉ lệ mặc định của từng loại câu hỏi trong bộ câu hỏi
+DEFAULT_MIX = {
+    "vocabulary": 0.45,
+    "idioms": 0.15,
+    "grammar": 0.1,
+    "common_mistakes": 0.05,
+    "conversations": 0.05,
+    "small_talk": 0.2,
+}
+
+
+def load_keys(data_dir=DEFAULT_DATA_DIR):
+    """Đọc giá trị cột khóa (word/phrase/rule/...) của từng bảng từ các file CSV, bỏ trùng."""
+    keys = {}
+    for table_key, (file_name, key_column) in LEXICAL_SOURCES.items():
+        with open(os.path.join(data_dir, file_name), encoding="utf-8", newline="") as f:
+            values = [row[key_column].strip() for row in csv.DictReader(f) if (row.get(key_column) or "").strip()]
+        keys[table_key] = list(dict.fromkeys(values))
+    return keys
+
+
+def pick(rng, values, hot_ratio, hot_size):
+    """Chọn một giá trị: với xác suất hot_ratio lấy từ nhóm "nóng" nhỏ (mô phỏng các từ được hỏi lặp lại)."""
+    if rng.random() < hot_ratio:
+        return values[rng.randrange(min(hot_size, len(values)))]
+    return rng.choice(values)
+
+
+def build_question_mix(count, seed=0, data_dir=DEFAULT_DATA_DIR, mix=None, hot_ratio=0.5, hot_size=50):
+    """
+    Sinh bộ câu hỏi từ dữ liệu CSV. Mỗi câu hỏi kèm kết quả phân tích mong đợi (intent, language, keyword),
+    được mô hình giả dùng để trả lời prompt phân tích.
+    """
+    rng = random.Random(seed)
+    keys = load_keys(data_dir)
+    for values in keys.values():
+        rng.shuffle(values)
+    mix = mix or DEFAULT_MIX
+    kinds, weights = zip(*mix.items())
+
+    questions = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "small_talk":
+            text, language = rng.choice(SMALL_TALK)
+            questions.append({"kind": kind, "text": text, "intent": "Conversational", "language": language, "keyword": ""})
+            continue
+        key = pick(rng, keys[kind], hot_ratio, hot_size)
+        template, language = rng.choice(QUESTION_TEMPLATES[kind])
+        questions.append({"kind": kind, "text": template.format(key=key), "intent": "Q&A", "language": language, "keyword": key})
+    return questions
+
+
+def build_tts_words(count, seed=0, data_dir=DEFAULT_DATA_DIR, hot_ratio=0.7, hot_size=50):
+    """Danh sách từ vựng cần phát âm; phần lớn là các từ "nóng" nên cache âm thanh được dùng lại."""
+    rng = random.Random(seed)
+    words = load_keys(data_dir)["vocabulary"]
+    rng.shuffle(words)
+    return [pick(rng, words, hot_ratio, hot_size) for _ in range(count)]
+
+
+if __name__ == "__main__":
+    # Ví dụ: python -m bench.fixtures --count 500 --out bench/fixtures/questions.json
+    parser = argparse.ArgumentParser(description="Sinh bộ câu hỏi benchmark từ các file CSV trong Supabase/.")
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hot-ratio", type=float, default=0.5, help="Tỉ lệ câu hỏi lặp lại các từ 'nóng'")
+    parser.add_argument("--out", required=True)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(build_question_mix(args.count, args.seed, hot_ratio=args.hot_ratio), f, ensure_ascii=False, indent=2)
+    print(f"✅ Đã ghi {args.count} câu hỏi vào '{args.out}'.")
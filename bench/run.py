@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+import warnings
+import contextlib
+
+import numpy as np
+
+from .fakes import FakeEnvironment, Latency, install_fakes
+from .fixtures import build_question_mix, build_tts_words
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SCENARIOS = ["answer", "stream", "tts", "mixed"]
+# Các mô hình backend gọi (sinh văn bản, TTS, embedding)
+BENCH_MODELS = ("gemini-2.5-flash", "gemini-2.5-flash-preview-tts", "models/text-embedding-004")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark /answer, /answer/stream và /synthesize-speech với Gemini/Supabase giả.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="answer")
+    parser.add_argument("--requests", type=int, default=300, help="Tổng số request (không tính warm-up)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Số client chạy đồng thời")
+    parser.add_argument("--warmup", type=int, default=0, help="Số request chạy trước, không tính vào kết quả")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", help="File JSON câu hỏi (bench.fixtures); mặc định sinh từ CSV")
+    parser.add_argument("--hot-ratio", type=float, default=0.5, help="Tỉ lệ câu hỏi lặp lại các từ 'nóng'")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi",
+                        help="asgi: gọi app trực tiếp; http: chạy uvicorn cục bộ (cần để đo thời gian tới byte đầu của stream)")
+    parser.add_argument("--dist", choices=["fixed", "uniform", "lognormal"], default="lognormal", help="Phân phối độ trễ")
+    parser.add_argument("--llm-ms", type=float, default=600, help="Độ trễ trung bình của một lệnh gọi Gemini (phân tích/trả lời)")
+    parser.add_argument("--first-token-ms", type=float, default=350, help="Độ trễ tới đoạn đầu tiên khi stream")
+    parser.add_argument("--chunk-ms", type=float, default=60, help="Độ trễ giữa các đoạn khi stream")
+    parser.add_argument("--embed-ms", type=float, default=120)
+    parser.add_argument("--rpc-ms", type=float, default=50)
+    parser.add_argument("--tts-ms", type=float, default=1500)
+    parser.add_argument("--storage-ms", type=float, default=80)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Xác suất một lệnh gọi Gemini trả về 429")
+    parser.add_argument("--no-answer-cache", action="store_true", help="Tắt cache câu trả lời của backend")
+    parser.add_argument("--lexical-mode", choices=["first", "hybrid", "off"], default="first",
+                        help="LEXICAL_MODE của backend; 'off' để mọi câu hỏi Q&A đi qua embedding + RPC")
+    parser.add_argument("--cache-backend", choices=["memory", "sqlite"], default="memory",
+                        help="Tầng lưu trữ cache; sqlite dùng một file tạm mới cho mỗi lần chạy")
+    parser.add_argument("--gemini-rpm", type=float, default=0,
+                        help="Quota (lệnh/phút) của bộ điều phối Gemini cho mọi mô hình; 0 = không giới hạn")
+    parser.add_argument("--no-memory", action="store_true", help="Không gửi session_id (mỗi câu hỏi độc lập)")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log của backend (mặc định bị ẩn khi chạy tải)")
+    parser.add_argument("--out", help="File JSON kết quả (mặc định bench/results/<thời điểm>-<scenario>.json)")
+    parser.add_argument("--compare", help="File JSON kết quả trước đó để so sánh")
+    return parser.parse_args(argv)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    array = np.asarray(values)
+    return {
+        "mean": round(float(array.mean()), 2),
+        "p50": round(float(np.percentile(array, 50)), 2),
+        "p95": round(float(np.percentile(array, 95)), 2),
+        "p99": round(float(np.percentile(array, 99)), 2),
+        "max": round(float(array.max()), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class LoadResult:
+    """Kết quả của một loại request: độ trễ đầu–cuối, thời gian tới byte đầu (stream) và mã trạng thái."""
+
+    def __init__(self):
+        self.latencies_ms = []
+        self.ttfb_ms = []
+        self.status_counts = {}
+        self.errors = 0
+
+    def add(self, status, latency, ttfb=None):
+        self.status_counts[str(status)] = self.status_counts.get(str(status), 0) + 1
+        if status == 200:
+            self.latencies_ms.append(latency * 1000)
+            if ttfb is not None:
+                self.ttfb_ms.append(ttfb * 1000)
+        else:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        count = sum(self.status_counts.values())
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "status_counts": self.status_counts,
+            "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": percentiles(self.latencies_ms),
+            "ttfb_ms": percentiles(self.ttfb_ms),
+        }
+
+
+async def run_answer(client, question, session_id):
+    started = time.perf_counter()
+    response = await client.post("/answer", json={"text": question["text"], "session_id": session_id})
+    return "answer", response.status_code, time.perf_counter() - started, None
+
+
+async def run_stream(client, question, session_id):
+    started = time.perf_counter()
+    ttfb = None
+    status = None
+    async with client.stream("POST", "/answer/stream", json={"text": question["text"], "session_id": session_id}) as response:
+        status = response.status_code
+        async for line in response.aiter_lines():
+            if ttfb is None and line.startswith("event: delta"):
+                ttfb = time.perf_counter() - started
+            if line.startswith("event: error"):
+                status = 500
+    return "stream", status, time.perf_counter() - started, ttfb
+
+
+async def run_tts(client, word, wait_seconds=10):
+    """Một lượt phát âm như frontend: gửi yêu cầu, nếu nhận 202 thì chờ job (long-poll) tới khi có URL."""
+    started = time.perf_counter()
+    response = await client.post("/synthesize-speech", json={"text": word, "wait": wait_seconds})
+    while response.status_code == 202:
+        job_id = response.json()["jobId"]
+        response = await client.get(f"/synthesize-speech/jobs/{job_id}", params={"wait": wait_seconds})
+    return "tts", response.status_code, time.perf_counter() - started, None
+
+
+def build_workload(args, questions, words):
+    """Danh sách các hàm tạo request theo kịch bản; mixed = 70% answer, 30% tts."""
+    question_cycle = itertools.cycle(questions)
+    word_cycle = itertools.cycle(words)
+    total = args.warmup + args.requests
+    workload = []
+    for i in range(total):
+        scenario = args.scenario
+        if scenario == "mixed":
+            scenario = "tts" if i % 10 >= 7 else "answer"
+        session_id = None if args.no_memory else f"bench-{i % max(1, args.concurrency)}"
+        if scenario == "answer":
+            workload.append(lambda c, q=next(question_cycle), s=session_id: run_answer(c, q, s))
+        elif scenario == "stream":
+            workload.append(lambda c, q=next(question_cycle), s=session_id: run_stream(c, q, s))
+        else:
+            workload.append(lambda c, w=next(word_cycle): run_tts(c, w))
+    return workload
+
+
+async def drive(client, workload, concurrency):
+    """Bộ sinh tải vòng kín: concurrency client, mỗi client gửi request tiếp theo ngay khi request trước xong."""
+    results = {}
+    queue = asyncio.Queue()
+    for job in workload:
+        queue.put_nowait(job)
+
+    async def worker():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                kind, status, latency, ttfb = await job(client)
+            except Exception as e:
+                kind, status, latency, ttfb = "client_error", type(e).__name__, 0.0, None
+            results.setdefault(kind, LoadResult()).add(status, latency, ttfb)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+@contextlib.asynccontextmanager
+async def open_client(app, lifespan, transport):
+    import httpx
+
+    if transport == "asgi":
+        async with lifespan(app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench",
+                                         timeout=120) as client:
+                yield client
+        return
+
+    import uvicorn
+    config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+            yield client
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+async def benchmark(args, env):
+    from backend import main
+
+    questions = build_question_mix(max(args.requests, 100), seed=args.seed, hot_ratio=args.hot_ratio)
+    if args.fixtures:
+        with open(args.fixtures, encoding="utf-8") as f:
+            questions = json.load(f)
+    env.oracle.update({question["text"]: question for question in questions})
+    words = build_tts_words(max(args.requests, 100), seed=args.seed)
+
+    workload = build_workload(args, questions, words)
+    async with open_client(main.app, main.lifespan, args.transport) as client:
+        if args.warmup:
+            await drive(client, workload[:args.warmup], args.concurrency)
+            env.recorder.reset()
+        results, elapsed = await drive(client, workload[args.warmup:], args.concurrency)
+        cache_stats = (await client.get("/cache/stats")).json()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("out", "compare")},
+        },
+        "elapsed_s": round(elapsed, 3),
+        "endpoints": {kind: result.summary(elapsed) for kind, result in results.items()},
+        "stages": env.recorder.summary(),
+        "cache": cache_stats,
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"\n=== Benchmark ({report['meta']['args']['scenario']}, {report['meta']['git_commit'] or 'no git'}) ===")
+    for kind, summary in report["endpoints"].items():
+        latency = summary["latency_ms"] or {}
+        line = (f"{kind:>8}: {summary['requests']} req, {summary['errors']} lỗi, {summary['throughput_rps']} req/s, "
+                f"p50 {latency.get('p50')} ms, p95 {latency.get('p95')} ms, p99 {latency.get('p99')} ms")
+        if summary["ttfb_ms"]:
+            line += f", TTFB p50 {summary['ttfb_ms']['p50']} ms"
+        print(line)
+        previous = (baseline or {}).get("endpoints", {}).get(kind)
+        if previous and previous.get("latency_ms") and latency:
+            deltas = ", ".join(
+                f"{key} {100 * (latency[key] - previous['latency_ms'][key]) / previous['latency_ms'][key]:+.1f}%"
+                for key in ("p50", "p95", "p99") if previous["latency_ms"][key]
+            )
+            rps_delta = summary["throughput_rps"] - previous["throughput_rps"]
+            print(f"{'':>10}so với {baseline['meta'].get('git_commit')}: {deltas}, req/s {rps_delta:+.2f}")
+    print("\n  Giai đoạn (phụ thuộc giả):")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:>18}: {stats['calls']:>5} lệnh gọi, tb {stats['mean_ms']} ms, p95 {stats['p95_ms']} ms, "
+              f"429: {stats['errors_429']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Cấu hình backend trước khi import: không dùng file cache trên đĩa, không cần khóa API thật
+    rpm = str(args.gemini_rpm or 1_000_000)
+    os.environ.update({
+        "SUPABASE_URL": "https://bench.invalid", "SUPABASE_SERVICE_KEY": "bench", "GOOGLE_API_KEY": "bench",
+        "EMBEDDING_CACHE_PATH": "", "TTS_DISK_CACHE_DIR": "", "TTS_RETRY_BASE_DELAY": "1",
+        "CACHE_BACKEND": args.cache_backend,
+        "CACHE_SQLITE_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-cache-"), "cache.sqlite3"),
+        # Mặc định bản giả không có quota: nới giới hạn để chỉ đo độ trễ của app (bộ điều phối vẫn chạy)
+        "GEMINI_RATE_LIMITS": ",".join(f"{model}={rpm}" for model in BENCH_MODELS), "GEMINI_DEFAULT_RPM": rpm,
+        "ANSWER_CACHE_ENABLED": "0" if args.no_answer_cache else "1", "LEXICAL_MODE": args.lexical_mode,
+        # Bảng Supabase giả không hỗ trợ select(): chỉ mục từ vựng dựng từ CSV (cùng dữ liệu với FakeCorpus)
+        "LEXICAL_SOURCE": "csv",
+        # Log của backend (ra stderr) chỉ được giữ khi --verbose; lỗi 429 giả lập không làm nhiễu báo cáo
+        "LOG_LEVEL": "DEBUG" if args.verbose else "CRITICAL",
+    })
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    latency = lambda ms: Latency(ms, args.dist)
+    env = FakeEnvironment(
+        latencies={
+            "llm.analysis": latency(args.llm_ms), "llm.answer": latency(args.llm_ms),
+            "llm.summary": latency(args.llm_ms), "llm.first_token": latency(args.first_token_ms),
+            "llm.stream_chunk": latency(args.chunk_ms), "embed": latency(args.embed_ms),
+            "supabase.rpc": latency(args.rpc_ms), "tts": latency(args.tts_ms),
+            "storage.list": latency(args.storage_ms), "storage.upload": latency(args.storage_ms),
+        },
+        rate_429=args.rate_429,
+        seed=args.seed,
+    )
+    install_fakes(env)
+
+    report = asyncio.run(benchmark(args, env))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.scenario}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ Đã lưu kết quả vào '{out}'.")
+
+
+if __name__ == "__main__":
+    # Ví dụ: python -m bench.run --scenario answer --requests 500 --concurrency 32 --rate-429 0.02
+    main(sys.argv[1:])
@@ -1,25 +1,40 @@
-import http.server
-import socketserver
 import os
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from backend.static_assets import StaticAssets
 
 # --- CẤU HÌNH ---
-PORT = 8080  # Cổng để chạy giao diện, ví dụ: http://localhost:8080
-# THAY ĐỔI: Trỏ đến thư mục 'frontend' nơi chứa file index.html
-DIRECTORY = "frontend" 
+PORT = int(os.environ.get("FRONTEND_PORT", "8080"))  # Cổng để chạy giao diện, ví dụ: http://localhost:8080
+# Thư mục 'frontend' nơi chứa file index.html
+DIRECTORY = os.environ.get("FRONTEND_DIR", "frontend")
+
+assets = StaticAssets(DIRECTORY)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Giữ kết nối (keep-alive) để trình duyệt dùng lại cho các request tiếp theo
+    protocol_version = "HTTP/1.1"
+
+    def serve(self):
+        response = assets.respond(self.command, self.path, {name.lower(): value for name, value in self.headers.items()})
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if response.body:
+            self.wfile.write(response.body)
+
+    do_GET = serve
+    do_HEAD = serve
 
-class Handler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=DIRECTORY, **kwargs)
 
 # --- KHỞI CHẠY SERVER ---
-# SỬA LỖI: Đưa 'Handler' vào làm đối số thứ hai của TCPServer
-with socketserver.TCPServer(("", PORT), Handler) as httpd:
-    # Kiểm tra xem thư mục có tồn tại không
-    if not os.path.isdir(DIRECTORY):
-        print(f"❌ LỖI: Không tìm thấy thư mục '{DIRECTORY}'. Vui lòng tạo thư mục và đặt file index.html vào trong đó.")
-    else:
+if not os.path.isdir(DIRECTORY):
+    print(f"❌ LỖI: Không tìm thấy thư mục '{DIRECTORY}'. Vui lòng tạo thư mục và đặt file index.html vào trong đó.")
+else:
+    # Mỗi kết nối được xử lý trong một thread riêng: một client chậm không chặn các client khác
+    with ThreadingHTTPServer(("", PORT), Handler) as httpd:
         print(f"✅ Giao diện đang được phục vụ từ thư mục '{DIRECTORY}' tại http://localhost:{PORT}")
         print("Mở trình duyệt và truy cập vào địa chỉ trên.")
         print("Nhấn Ctrl+C để dừng server.")
         httpd.serve_forever()
-